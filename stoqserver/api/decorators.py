@@ -24,7 +24,7 @@
 
 import functools
 
-from kiwi.component import provide_utility
+from kiwi.component import get_utility, provide_utility
 from flask import abort, request
 
 from stoqlib.api import api
@@ -32,6 +32,38 @@ from stoqlib.database.interfaces import ICurrentUser
 from stoqlib.domain.person import LoginUser
 from stoqlib.domain.token import AccessToken
 
+from stoqserver.lib.auth import (get_identity_for_token, set_request_identity,
+                                 token_cache)
+
+_STORE_KEY = 'stoqserver.store'
+
+
+def get_request_store():
+    """Get the store opened by :func:`store_provider` for the current request
+
+    :returns: the store or ``None`` if no store was opened for this request
+    """
+    return request.environ.get(_STORE_KEY)
+
+
+def _get_identity(store, token):
+    access_token = AccessToken.get_by_token(store=store, token=token)
+    if not access_token:
+        abort(403, "invalid token")
+    if not access_token.is_valid():
+        abort(403, "token {}".format(access_token.status))
+
+    return get_identity_for_token(access_token)
+
+
+def _provide_current_user(store, user_id):
+    # FIXME: the user utility acts as a singleton and since we'd like to have stoqserver API
+    # accepting requests from different stations (users), we cannot use this pattern as it
+    # can lead to racing problems. For now we are willing to put a lock in every request,
+    # but the final solution should be a refactor that makes every endpoint use the user
+    # provided in the token payload instead of this 'global' one.
+    provide_utility(ICurrentUser, store.get(LoginUser, user_id), replace=True)
+
 
 def login_required(f):
     @functools.wraps(f)
@@ -41,31 +73,51 @@ def login_required(f):
         if len(auth) != 2:
             abort(401)
 
-        with api.new_store() as store:
-            access_token = AccessToken.get_by_token(store=store, token=auth[1])
-            if not access_token.is_valid():
-                abort(403, "token {}".format(access_token.status))
-
-            # FIXME: the user utility acts as a singleton and since we'd like to have stoqserver API
-            # accepting requests from different stations (users), we cannot use this pattern as it
-            # can lead to racing problems. For now we are willing to put a lock in every request,
-            # but the final solution should be a refactor that makes every endpoint use the user
-            # provided in the token payload instead of this 'global' one.
-            user = store.get(LoginUser, access_token.payload['user_id'])
-            provide_utility(ICurrentUser, user, replace=True)
+        store = get_request_store()
+        identity = token_cache.get(auth[1])
+        if identity is None:
+            if store is not None:
+                identity = _get_identity(store, auth[1])
+            else:
+                with api.new_store() as new_store:
+                    identity = _get_identity(new_store, auth[1])
+            token_cache.add(identity)
+
+        set_request_identity(identity)
+
+        current_user = get_utility(ICurrentUser, None)
+        if current_user is None or current_user.id != identity.user_id:
+            if store is not None:
+                _provide_current_user(store, identity.user_id)
+            else:
+                with api.new_store() as new_store:
+                    _provide_current_user(new_store, identity.user_id)
 
         return f(*args, **kwargs)
     return wrapper
 
 
 def store_provider(f):
+    """Provide the request store to the decorated function
+
+    The store is opened once per request and shared by everything that runs inside it, including
+    :func:`login_required`. It is committed when the outermost call returns, or rolled back if
+    it raises an exception.
+    """
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
+        store = get_request_store()
+        if store is not None:
+            return f(store, *args, **kwargs)
+
         with api.new_store() as store:
+            request.environ[_STORE_KEY] = store
             try:
                 return f(store, *args, **kwargs)
             except Exception as e:
                 store.retval = False
                 raise e
+            finally:
+                del request.environ[_STORE_KEY]
 
     return wrapper
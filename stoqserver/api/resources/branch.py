@@ -3,6 +3,7 @@ from flask import make_response, jsonify
 from stoqlib.domain.person import Branch
 
 from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.catalog import get_te_signature
 from stoqserver.api.decorators import login_required, store_provider
 
 
@@ -11,6 +12,10 @@ class BranchResource(BaseResource):
     routes = ['/branch']
 
     def get(self, store):
+        etag = self.get_etag(get_te_signature(store, ['branch']))
+        if self.is_not_modified(etag):
+            return self.make_not_modified_response(etag)
+
         branches = []
         for branch in list(store.find(Branch)):
             branches.append({
@@ -21,6 +26,8 @@ class BranchResource(BaseResource):
                 "crt": branch.crt
             })
 
-        return make_response(jsonify({
+        response = make_response(jsonify({
             'data': branches
         }), 200)
+        response.set_etag(etag)
+        return response
@@ -0,0 +1,16 @@
+from stoqserver.api.decorators import login_required
+from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.lock import locks
+
+
+class LocksResource(BaseResource):
+    """The current state of the device locks
+
+    Their wait and hold times are in ``/metrics``.
+    """
+
+    method_decorators = [login_required]
+    routes = ['/locks']
+
+    def get(self):
+        return {name: lock.dump() for name, lock in sorted(locks.items())}
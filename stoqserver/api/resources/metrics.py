@@ -0,0 +1,11 @@
+from stoqserver.api.decorators import login_required
+from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.metrics import registry
+
+
+class MetricsResource(BaseResource):
+    method_decorators = [login_required]
+    routes = ['/metrics']
+
+    def get(self):
+        return registry.dump()
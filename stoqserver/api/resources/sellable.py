@@ -1,7 +1,8 @@
 import logging
 
 from decimal import Decimal, DecimalException
-from flask import abort, make_response, jsonify
+from flask import abort, make_response, jsonify, request
+from stoqlib.api import api
 
 from stoqlib.domain.image import Image
 from stoqlib.domain.overrides import SellableBranchOverride
@@ -10,6 +11,8 @@ from stoqlib.domain.product import Product
 from stoqlib.domain.sellable import Sellable
 
 from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.catalog import get_te_signature
+from stoqserver.utils import is_stream_requested, make_json_stream_response
 
 from stoqserver.api.decorators import login_required, store_provider
 
@@ -24,6 +27,9 @@ class SellableResource(BaseResource):
         '/sellable/<uuid:sellable_id>/override/<uuid:branch_id>'
     ]
 
+    # How many sellables are read from the database at once when streaming
+    STREAM_PAGE_SIZE = 500
+
     def _price_validation(self, data):
         try:
             base_price = Decimal(data.get('base_price', 0))
@@ -39,15 +45,41 @@ class SellableResource(BaseResource):
 
         return base_price
 
-    def _create_sellable_dict(self, sellable, image):
+    def _create_sellable_dict(self, sellable, image_id):
         return {
             'id': sellable.id,
             'barcode': sellable.barcode,
             'description': sellable.description,
             'notes': sellable.notes,
-            'image_id': image.id if image else None
+            'image_id': image_id,
         }
 
+    def _iter_sellables(self):
+        # This runs after the request returned, so it needs its own store
+        with api.new_store() as store:
+            # Nothing should be changed here
+            store.retval = False
+
+            # Paginate by id so that only a chunk of the sellables is in memory at a time
+            last_id = None
+            while True:
+                query = []
+                if last_id is not None:
+                    query.append(Sellable.id > last_id)
+                sellables = list(store.find(Sellable, *query)
+                                 .order_by(Sellable.id)[:self.STREAM_PAGE_SIZE])
+                if not sellables:
+                    break
+
+                sellable_ids = [sellable.id for sellable in sellables]
+                # Don't load the images themselves, we only need their ids
+                image_ids = dict(store.find((Image.sellable_id, Image.id),
+                                            Image.sellable_id.is_in(sellable_ids)))
+                for sellable in sellables:
+                    yield self._create_sellable_dict(sellable, image_ids.get(sellable.id))
+
+                last_id = sellable_ids[-1]
+
     def post(self, store):
         data = self.get_json()
 
@@ -140,16 +172,30 @@ class SellableResource(BaseResource):
                 log.error(message)
                 abort(404, message)
 
-            image = store.find(Image, sellable_id=sellable.id).any()
-
-            return make_response(jsonify({
-                "data": self._create_sellable_dict(sellable, image)
-            }), 200)
-
-        sellables = []
-        for sellable in store.find(Sellable):
-            image = store.find(Image, sellable_id=sellable.id).one()
-            sellables.append(self._create_sellable_dict(sellable, image))
-
-        # TODO: Maybe add pagination
-        return make_response(jsonify({'data': sellables}), 200)
+            image_id = store.find(Image.id, Image.sellable_id == sellable.id).any()
+            data = self._create_sellable_dict(sellable, image_id)
+            etag = self.get_etag(data)
+            if self.is_not_modified(etag):
+                return self.make_not_modified_response(etag)
+
+            response = make_response(jsonify({"data": data}), 200)
+            response.set_etag(etag)
+            return response
+
+        etag = self.get_etag(get_te_signature(store, ['sellable', 'image']))
+        if self.is_not_modified(etag):
+            return self.make_not_modified_response(etag)
+
+        if is_stream_requested(request):
+            response = make_json_stream_response({'data': self._iter_sellables()})
+        else:
+            sellables = []
+            for sellable in store.find(Sellable):
+                image = store.find(Image, sellable_id=sellable.id).one()
+                sellables.append(self._create_sellable_dict(sellable, image and image.id))
+
+            # TODO: Maybe add pagination
+            response = make_response(jsonify({'data': sellables}), 200)
+
+        response.set_etag(etag)
+        return response
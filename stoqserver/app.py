@@ -32,6 +32,7 @@ import gevent
 from blinker import signal
 from flask import Flask, Response, request
 from flask_restful import Api
+from gevent.pool import Pool
 from gevent.pywsgi import WSGIServer
 from raven.contrib.flask import Sentry
 from werkzeug.serving import run_with_reloader
@@ -44,7 +45,7 @@ from stoqlib.lib.translation import dgettext
 
 from stoqserver import sentry
 from stoqserver.sentry import raven_client, sentry_report, SENTRY_URL
-from stoqserver.utils import get_user_hash
+from stoqserver.utils import get_cors_headers, get_user_hash
 
 logger = logging.getLogger(__name__)
 
@@ -105,7 +106,12 @@ def _gtk_main_loop():
         gevent.sleep(0.1)
 
 
-def run_flaskserver(port, debug=False, multiclient=False):
+def run_flaskserver(port, debug=False, multiclient=False, listener=None):
+    """Run the flask server
+
+    :param listener: a socket already bound to the port, shared by all the workers when the
+        server runs with more than one of them
+    """
     from stoqlib.lib.environment import configure_locale
     # Force pt_BR for now.
     configure_locale('pt_BR')
@@ -113,13 +119,22 @@ def run_flaskserver(port, debug=False, multiclient=False):
     global is_multiclient
     is_multiclient = multiclient
 
+    from .lib.dbpool import install_pool
+    install_pool()
+
     from .workers import WORKERS
     # For now we're disabling workers when stoqserver is serving multiple clients (multiclient mode)
     # FIXME: a proper solution would be to modify the workflow so that the clients ask the server
     # about devices health, the till status, etc. instead of the other way around.
+    station = None if is_multiclient else get_current_station(api.get_default_store())
     if not is_multiclient:
         for function in WORKERS:
-            gevent.spawn(function, get_current_station(api.get_default_store()))
+            gevent.spawn(function, station)
+
+    # Receive events from plugin tasks and, when there are other workers serving the same port,
+    # from them too
+    from .lib.eventbus import listen_messages
+    gevent.spawn(listen_messages, has_peers=listener is not None)
 
     try:
         from stoqserver.lib import stacktracer
@@ -129,6 +144,18 @@ def run_flaskserver(port, debug=False, multiclient=False):
 
     app = bootstrap_app()
     app.debug = debug
+
+    # Only after the app is created, so that all the resources are already subscribed to them
+    from .lib.changes import listen_changes
+    gevent.spawn(listen_changes)
+    # Unlike the workers above, in every mode. In multiclient mode, for the stations without a
+    # server of their own. Processes serving the same database share the jobs
+    from .lib.emissionqueue import emission_queue
+    from .lib.idempotency import cleanup_loop
+    from .lib.printqueue import print_queue
+    gevent.spawn(print_queue.run, station)
+    gevent.spawn(emission_queue.run, station)
+    gevent.spawn(cleanup_loop)
     if not is_developer_mode():
         sentry.raven_client = Sentry(app, dsn=SENTRY_URL, client=raven_client)
 
@@ -139,16 +166,19 @@ def run_flaskserver(port, debug=False, multiclient=False):
         origin = request.headers.get('origin')
         if not origin:
             origin = request.args.get('origin', request.form.get('origin', '*'))
-        response.headers['Access-Control-Allow-Origin'] = origin
-        response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS, DELETE'
-        response.headers['Access-Control-Allow-Headers'] = 'Authorization, Content-Type'
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        for name, value in get_cors_headers(origin):
+            response.headers[name] = value
         return response
 
+    from .lib.admission import get_max_connections, install_admission_control
+    install_admission_control(app)
+
     from stoqserver.lib.restful import has_sat, has_nfe
     logger.info('Starting wsgi server (has_sat=%s, has_nfe=%s)', has_sat, has_nfe)
-    http_server = WSGIServer(('0.0.0.0', port), app, spawn=gevent.spawn_raw, log=logger,
-                             error_log=logger)
+    # The pool limits how many connections are handled at once. The admission control above
+    # decides which of them can run
+    http_server = WSGIServer(listener or ('0.0.0.0', port), app, spawn=Pool(get_max_connections()),
+                             log=logger, error_log=logger)
 
     if debug:
         gevent.spawn(_gtk_main_loop)
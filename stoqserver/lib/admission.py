@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Admission control for the requests of the flask server
+
+Requests are split in classes, each one with its own limit of concurrent requests, so that
+selling never waits behind catalog downloads. When a class is full the request waits briefly in a
+bounded queue, and it is answered with 503 and ``Retry-After`` when it doesn't get a slot in time
+or when the queue is full too.
+"""
+
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+from gevent.lock import Semaphore
+from werkzeug.wsgi import ClosingIterator
+
+from ..utils import get_cors_headers, get_int_config
+from .metrics import registry
+
+log = logging.getLogger(__name__)
+
+# Long lived or trivial requests that should never be refused
+EXEMPT_ROUTES = ('/stream', '/ping')
+
+# Requests that are part of selling and must not wait behind the others
+PRIORITY_ROUTES = ('/sale', '/tef', '/till', '/advance_payment', '/drawer', '/login', '/logout',
+                   '/auth')
+# Under the priority routes, but long and not needed to keep selling. The sales a station queued
+# while offline must not take the slots of the checkouts
+NON_PRIORITY_ROUTES = ('/sale/batch', )
+
+PRIORITY = 'priority'
+NORMAL = 'normal'
+
+DEFAULT_MAX_CONNECTIONS = 1000
+DEFAULT_MAX_REQUESTS = 20
+DEFAULT_MAX_PRIORITY_REQUESTS = 20
+DEFAULT_MAX_QUEUED_REQUESTS = 50
+# In milliseconds. Waiting any longer only holds the greenlet of a request that should be refused,
+# the client retries after RETRY_AFTER seconds anyway
+DEFAULT_QUEUE_TIMEOUT_MS = 500
+RETRY_AFTER = 2
+
+
+def _route_matches(path, routes):
+    return any(path == route or path.startswith(route + '/') for route in routes)
+
+
+def get_request_class(path):
+    """Get the class of a request by its path, or ``None`` if it is exempt"""
+    if _route_matches(path, EXEMPT_ROUTES):
+        return None
+    if _route_matches(path, NON_PRIORITY_ROUTES):
+        return NORMAL
+    if _route_matches(path, PRIORITY_ROUTES):
+        return PRIORITY
+    return NORMAL
+
+
+class _RequestClass:
+    def __init__(self, name, max_requests, max_queued):
+        self.name = name
+        self.max_queued = max_queued
+        self.queued = 0
+        self.slots = Semaphore(max_requests)
+        self.wait_time = registry.histogram(
+            'admission_{}_wait_seconds'.format(name),
+            'Time {} requests waited to be admitted'.format(name))
+        self.rejected = registry.counter(
+            'admission_{}_rejected'.format(name),
+            '{} requests answered with 503'.format(name.capitalize()))
+        registry.gauge('admission_{}_queued'.format(name),
+                       '{} requests waiting to be admitted'.format(name.capitalize()),
+                       func=lambda: self.queued)
+
+    def acquire(self, timeout):
+        # Don't even wait if there are too many requests waiting already
+        if self.slots.locked() and self.queued >= self.max_queued:
+            return False
+
+        start = time.monotonic()
+        self.queued += 1
+        try:
+            acquired = self.slots.acquire(timeout=timeout)
+        finally:
+            self.queued -= 1
+        self.wait_time.observe(time.monotonic() - start)
+        return acquired
+
+
+class AdmissionControl:
+    """A WSGI middleware limiting the number of concurrent requests of each class
+
+    A request keeps its slot until its response is closed, which for streamed responses is
+    after all of it was sent.
+    """
+
+    def __init__(self, app, max_requests=DEFAULT_MAX_REQUESTS,
+                 max_priority_requests=DEFAULT_MAX_PRIORITY_REQUESTS,
+                 max_queued=DEFAULT_MAX_QUEUED_REQUESTS,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT_MS / 1000):
+        self.app = app
+        self.queue_timeout = queue_timeout
+        self._classes = {
+            NORMAL: _RequestClass(NORMAL, max_requests, max_queued),
+            PRIORITY: _RequestClass(PRIORITY, max_priority_requests, max_queued),
+        }
+
+    def __call__(self, environ, start_response):
+        request_class = self._classes.get(get_request_class(environ.get('PATH_INFO', '')))
+        if request_class is None:
+            return self.app(environ, start_response)
+
+        if not request_class.acquire(self.queue_timeout):
+            request_class.rejected.inc()
+            log.warning('Too many %s requests. Refusing %s', request_class.name,
+                        environ.get('PATH_INFO'))
+            return self._service_unavailable(environ, start_response)
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                request_class.slots.release()
+
+        try:
+            return ClosingIterator(self.app(environ, start_response), release)
+        except BaseException:
+            release()
+            raise
+
+    def _service_unavailable(self, environ, start_response):
+        body = json.dumps({'message': 'Server too busy, try again later'}).encode()
+        # Like the flask responses, otherwise the browser doesn't let the POS read this one
+        origin = (environ.get('HTTP_ORIGIN') or
+                  parse_qs(environ.get('QUERY_STRING', '')).get('origin', ['*'])[0])
+        start_response('503 Service Unavailable', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(RETRY_AFTER)),
+        ] + get_cors_headers(origin))
+        return [body]
+
+
+def get_max_connections():
+    """The maximum number of connections the server handles at once"""
+    return get_int_config('http_max_connections', DEFAULT_MAX_CONNECTIONS)
+
+
+def install_admission_control(app):
+    """Limit the concurrent requests of a flask app according to the config
+
+    This is configured by the ``http_max_requests``, ``http_max_priority_requests``,
+    ``http_max_queued_requests`` and ``http_queue_timeout_ms`` keys of the General section.
+    """
+    app.wsgi_app = AdmissionControl(
+        app.wsgi_app,
+        max_requests=get_int_config('http_max_requests', DEFAULT_MAX_REQUESTS),
+        max_priority_requests=get_int_config('http_max_priority_requests',
+                                             DEFAULT_MAX_PRIORITY_REQUESTS),
+        max_queued=get_int_config('http_max_queued_requests', DEFAULT_MAX_QUEUED_REQUESTS),
+        queue_timeout=get_int_config('http_queue_timeout_ms', DEFAULT_QUEUE_TIMEOUT_MS) / 1000)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Access token resolution
+
+Resolving an access token takes a few queries and it happens at least once for each request, so
+the result is cached for a short time. Tokens revoked by :func:`revoke_token` are removed from the
+cache of all the workers of the flask server, but a token revoked by another process will still be
+accepted here for at most :data:`TOKEN_CACHE_TTL` seconds. A token is never accepted after it
+expires.
+"""
+
+import collections
+import time
+
+from flask import request
+
+from . import eventbus
+
+# For how long, in seconds, a token is trusted without checking the database again
+TOKEN_CACHE_TTL = 60
+# The oldest tokens are dropped when the cache has more than this
+TOKEN_CACHE_MAX_SIZE = 10000
+
+_IDENTITY_KEY = 'stoqserver.identity'
+
+# expires_at is the ``exp`` claim of the token, in seconds since the epoch (UTC), or ``None``
+TokenIdentity = collections.namedtuple(
+    'TokenIdentity', ['token', 'user_id', 'station_id', 'branch_id', 'expires_at'])
+
+
+class TokenCache:
+    """A cache of the identities of valid access tokens"""
+
+    def __init__(self, ttl=TOKEN_CACHE_TTL, max_size=TOKEN_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # In the order they were added, so that the oldest ones are the first
+        self._entries = {}
+
+    def get(self, token):
+        """Get the identity for *token* or ``None`` if it is not cached"""
+        try:
+            identity, expires_at = self._entries[token]
+        except KeyError:
+            return None
+
+        if time.monotonic() >= expires_at:
+            self._entries.pop(token, None)
+            return None
+        return identity
+
+    def add(self, identity):
+        now = time.monotonic()
+        ttl = self.ttl
+        if identity.expires_at is not None:
+            ttl = min(ttl, identity.expires_at - time.time())
+        if ttl <= 0:
+            return
+
+        self._entries.pop(identity.token, None)
+        if len(self._entries) >= self.max_size:
+            self._evict(now)
+        self._entries[identity.token] = (identity, now + ttl)
+
+    def _evict(self, now):
+        for token, (identity, expires_at) in list(self._entries.items()):
+            if now >= expires_at:
+                del self._entries[token]
+        while len(self._entries) >= self.max_size:
+            del self._entries[next(iter(self._entries))]
+
+    def invalidate(self, token=None):
+        """Remove *token* from the cache, or all tokens if it is ``None``"""
+        if token is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(token, None)
+
+
+token_cache = TokenCache()
+eventbus.subscribe('token_revoked', token_cache.invalidate)
+
+
+def revoke_token(token):
+    """Stop trusting the cached identity of *token* in all the workers"""
+    token_cache.invalidate(token)
+    if eventbus.has_peers():
+        eventbus.publish('token_revoked', token)
+
+
+def get_identity_for_token(access_token):
+    """Create a :class:`TokenIdentity` for a valid ``AccessToken``"""
+    station = access_token.station
+    payload = access_token.payload
+    return TokenIdentity(token=access_token.token, user_id=payload['user_id'],
+                         station_id=station.id, branch_id=station.branch_id,
+                         expires_at=payload.get('exp'))
+
+
+def set_request_identity(identity):
+    request.environ[_IDENTITY_KEY] = identity
+
+
+def get_request_identity():
+    """Get the identity resolved by ``login_required`` for the current request
+
+    :returns: a :class:`TokenIdentity` or ``None`` if the request was not authenticated
+    """
+    return request.environ.get(_IDENTITY_KEY)
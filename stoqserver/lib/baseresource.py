@@ -23,20 +23,25 @@
 #
 
 import decimal
-import gevent
+import hashlib
 import json
 import logging
 
-from flask import request
+from flask import make_response, request
 from flask_restful import Resource
 from serial.serialutil import SerialException
 
 from stoqdrivers.exceptions import InvalidReplyException
 from stoqlib.api import api
 from stoqlib.domain.devices import DeviceSettings
+from stoqlib.domain.person import LoginUser
+from stoqlib.domain.station import BranchStation
 from stoqlib.domain.token import AccessToken
 from stoqlib.lib.pluginmanager import get_plugin_manager, PluginError
 from ..app import is_multiclient
+from ..utils import JsonEncoder
+from .auth import get_request_identity, token_cache
+from .devicehealth import DEFAULT_MAX_AGE, printer_health
 from .lock import printer_lock
 
 log = logging.getLogger(__name__)
@@ -66,12 +71,40 @@ class BaseResource(Resource):
 
         return request.form.get(attr, request.args.get(attr, default))
 
+    def get_etag(self, *values):
+        """Get a strong ETag for a response that depends only on values"""
+        data = json.dumps(values, cls=JsonEncoder)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def is_not_modified(self, etag):
+        """Check if the client already has the response identified by etag"""
+        return request.if_none_match.contains(etag)
+
+    def make_not_modified_response(self, etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    def _get_identity(self, token=None):
+        identity = get_request_identity()
+        if token is None or (identity is not None and identity.token == token):
+            return identity
+        return token_cache.get(token)
+
     def get_current_user(self, store):
+        identity = self._get_identity()
+        if identity is not None:
+            return store.get(LoginUser, identity.user_id)
+
         auth = request.headers.get('Authorization', '').split('Bearer ')
         token = AccessToken.get_by_token(store=store, token=auth[1])
         return token and token.user
 
     def get_current_station(self, store, token=None):
+        identity = self._get_identity(token)
+        if identity is not None:
+            return store.get(BranchStation, identity.station_id)
+
         if not token:
             auth = request.headers.get('Authorization', '').split('Bearer ')
             token = auth[1]
@@ -83,7 +116,13 @@ class BaseResource(Resource):
         return station and station.branch
 
     @classmethod
-    def ensure_printer(cls, station, retries=20):
+    def ensure_printer(cls, station, max_age=DEFAULT_MAX_AGE):
+        """Make sure the printer is working, returning if the drawer is open
+
+        The result of a check made in the last *max_age* seconds is used instead of checking the
+        printer again, and a failed printer is only reopened after a backoff. When it is not
+        working, the exception of the last check is raised.
+        """
         # In multiclient mode there is no local printer
         if is_multiclient:
             return
@@ -97,6 +136,19 @@ class BaseResource(Resource):
             # If we have no printer configured, there's nothing to ensure
             return
 
+        if printer_health.is_fresh(max_age):
+            return printer_health.get()
+
+        try:
+            is_drawer_open = cls._check_printer()
+        except (SerialException, InvalidReplyException) as e:
+            printer_health.record_failure(e)
+            raise
+        printer_health.record_success(is_drawer_open)
+        return is_drawer_open
+
+    @classmethod
+    def _check_printer(cls):
         # There is no need to lock the printer here, since it should already be locked by the
         # calling site of this method.
         # Test the printer to see if its working properly.
@@ -105,20 +157,16 @@ class BaseResource(Resource):
             printer = api.device_manager.printer
             return printer.is_drawer_open()
         except (SerialException, InvalidReplyException):
+            if not printer_health.can_reconnect():
+                raise
+
             if printer:
                 printer._port.close()
             api.device_manager._printer = None
-            for i in range(retries):
-                log.info('Printer check failed. Reopening')
-                try:
-                    printer = api.device_manager.printer
-                    printer.is_drawer_open()
-                    break
-                except SerialException:
-                    gevent.sleep(1)
-            else:
-                # Reopening printer failed. re-raise the original exception
-                raise
+            log.info('Printer check failed. Reopening')
+            printer_health.record_reconnect()
+            printer = api.device_manager.printer
+            is_drawer_open = printer.is_drawer_open()
 
             # Invalidate the printer in the plugins so that it re-opens it
             manager = get_plugin_manager()
@@ -132,4 +180,4 @@ class BaseResource(Resource):
             if nonfiscal and nonfiscal.ui:
                 nonfiscal.ui.printer = printer
 
-            return printer.is_drawer_open()
+            return is_drawer_open
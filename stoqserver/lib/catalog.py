@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Catalog versioning and caching helpers
+
+The catalog version is the most recent transaction entry time of all the rows that compose the
+catalog the POS receives. Every domain object in stoq points to a transaction entry that has its
+te_time updated on each modification, which allows us to find what changed since a given version.
+
+A deleted row leaves nothing behind to be found that way, so the deletions from the catalog tables
+are recorded by a trigger in ``stoqserver_catalog_deletion``.
+"""
+
+import collections
+import datetime
+import logging
+import time
+
+from gevent.lock import Semaphore
+
+from stoqlib.domain.overrides import SellableBranchOverride
+from stoqlib.domain.product import Product, ProductComponent, ProductStockItem
+from stoqlib.domain.sellable import ClientCategoryPrice, Sellable
+
+from .changes import change_listener
+from .schema import register_table
+
+log = logging.getLogger(__name__)
+
+VERSION_FORMAT = '%Y%m%d%H%M%S%f'
+
+# A transaction that started before the version was read may commit rows with an older te_time
+# than the version itself. Deltas overlap the previous one by this much so those are not lost.
+DELTA_OVERLAP = datetime.timedelta(minutes=1)
+
+# Clients with a version older than this receive a full snapshot, since the deletions are only
+# recorded for a little longer than that
+DELTA_MAX_AGE = datetime.timedelta(days=1)
+
+# In seconds. The cached signatures are read again after this, since deleting a row is not
+# notified to the change listener
+SIGNATURE_MAX_AGE = 60
+
+# All the tables that affect a sellable in the catalog, mapped to the column that references it
+SELLABLE_TABLES = [
+    ('sellable', 'id'),
+    ('product', 'id'),
+    ('storable', 'id'),
+    ('product_stock_item', 'storable_id'),
+    ('sellable_branch_override', 'sellable_id'),
+    ('product_branch_override', 'product_id'),
+    ('client_category_price', 'sellable_id'),
+    ('image', 'sellable_id'),
+]
+
+CATALOG_TABLES = [table for table, column in SELLABLE_TABLES] + ['sellable_category']
+
+# Changes in those tables invalidate the cached snapshots. The branch is here because
+# sellable prices depend on its default client category
+CACHE_TABLES = set(CATALOG_TABLES) | {'branch'}
+
+_MAX_TE_TIME_QUERY = """
+    SELECT MAX(te.te_time) FROM {table}
+      JOIN transaction_entry te ON te.id = {table}.te_id"""
+
+_CHANGED_IDS_QUERY = """
+    SELECT {table}.{column} FROM {table}
+      JOIN transaction_entry te ON te.id = {table}.te_id
+     WHERE te.te_time > ?"""
+
+
+_TE_IDS_QUERY = """
+    SELECT {table}.{column} FROM {table} WHERE {table}.te_id = ANY(?)"""
+
+_DELETED_IDS_QUERY = """
+    SELECT deleted_id FROM stoqserver_catalog_deletion WHERE kind = ? AND deleted_at > ?"""
+
+# The deletions are kept for DELTA_MAX_AGE, plus DELTA_OVERLAP. The trigger also notifies the
+# deletion like stoq notifies the other changes, so the caches are invalidated by it
+_CREATE_DELETION_TABLE = """
+    CREATE TABLE IF NOT EXISTS stoqserver_catalog_deletion (
+        kind text NOT NULL,
+        deleted_id text NOT NULL,
+        deleted_at timestamp NOT NULL DEFAULT NOW());
+    CREATE INDEX IF NOT EXISTS stoqserver_catalog_deletion_deleted_at_idx
+        ON stoqserver_catalog_deletion (deleted_at);
+    CREATE OR REPLACE FUNCTION stoqserver_record_catalog_deletion() RETURNS trigger AS $$
+    DECLARE
+        deleted_id text;
+    BEGIN
+        EXECUTE 'SELECT ($1).' || quote_ident(TG_ARGV[1]) || '::text' USING OLD INTO deleted_id;
+        INSERT INTO stoqserver_catalog_deletion (kind, deleted_id) VALUES (TG_ARGV[0], deleted_id);
+        DELETE FROM stoqserver_catalog_deletion
+         WHERE deleted_at < NOW() - INTERVAL '{max_age} seconds';
+        PERFORM pg_notify('update_te', OLD.te_id::text || ',' || TG_TABLE_NAME);
+        RETURN OLD;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+_CREATE_DELETION_TRIGGER = """
+    DROP TRIGGER IF EXISTS stoqserver_catalog_deletion ON {table};
+    CREATE TRIGGER stoqserver_catalog_deletion AFTER DELETE ON {table}
+        FOR EACH ROW EXECUTE PROCEDURE stoqserver_record_catalog_deletion('{kind}', '{column}')
+"""
+
+register_table(_CREATE_DELETION_TABLE.format(
+    max_age=int((DELTA_MAX_AGE + DELTA_OVERLAP).total_seconds())))
+for _table, _column in SELLABLE_TABLES:
+    register_table(_CREATE_DELETION_TRIGGER.format(table=_table, kind='sellable', column=_column))
+register_table(_CREATE_DELETION_TRIGGER.format(table='sellable_category', kind='category',
+                                               column='id'))
+
+
+class TableStateCache:
+    """Values read from some tables, kept until the change listener hears about a change in them
+
+    The signatures and versions scan all the rows of their tables, so they are only read again
+    when one of their tables changed, or after :data:`SIGNATURE_MAX_AGE`. Like
+    :class:`CatalogCache`, this is only enabled while the change listener is listening.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # Mapping keys to tuples of (tables, value, read_at)
+        self._entries = {}
+        self._generation = 0
+
+    def get(self, key, tables, read):
+        """Get the value of *key*, calling *read* to read it from *tables* if needed"""
+        if not self.enabled:
+            return read()
+
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[2] < SIGNATURE_MAX_AGE:
+            return entry[1]
+
+        generation = self._generation
+        read_at = time.monotonic()
+        value = read()
+        # Don't keep something that might have changed while we were reading it
+        if self.enabled and generation == self._generation:
+            self._entries[key] = (frozenset(tables), value, read_at)
+        return value
+
+    def invalidate(self, tables=None):
+        """Forget the values read from *tables*, or all of them if ``None``"""
+        self._generation += 1
+        if tables is None:
+            self._entries.clear()
+            return
+        for key, entry in list(self._entries.items()):
+            if entry[0] & tables:
+                del self._entries[key]
+
+
+table_state_cache = TableStateCache()
+
+
+def get_te_version(store, tables):
+    """Get the most recent te_time of all rows in the given tables
+
+    :returns: the te_time as a datetime or ``None`` if the tables are empty
+    """
+    query = 'SELECT MAX(te_time) FROM ({}) AS versions'.format(
+        ' UNION ALL '.join(_MAX_TE_TIME_QUERY.format(table=table) for table in tables))
+    return store.execute(query).get_one()[0]
+
+
+def _read_te_signature(store, tables):
+    count = store.execute('SELECT {}'.format(
+        ' + '.join('(SELECT COUNT(*) FROM {})'.format(table) for table in tables))).get_one()[0]
+    return '{}-{}'.format(format_version(get_te_version(store, tables)), count)
+
+
+def get_te_signature(store, tables):
+    """Get a string that changes whenever a row in the given tables changes
+
+    Besides the most recent te_time, this takes the number of rows into account, since deleting
+    a row does not update any te_time. See :class:`TableStateCache`.
+    """
+    tables = tuple(sorted(tables))
+    return table_state_cache.get(('signature', tables), tables,
+                                 lambda: _read_te_signature(store, tables))
+
+
+def _read_catalog_version(store):
+    deleted_at = store.execute(
+        "SELECT MAX(deleted_at) FROM stoqserver_catalog_deletion").get_one()[0]
+    versions = [v for v in [get_te_version(store, CATALOG_TABLES), deleted_at] if v is not None]
+    return max(versions, default=None)
+
+
+def get_catalog_version(store):
+    """Get the version of the catalog, as a datetime. See :class:`TableStateCache`
+
+    Deleting a row from the catalog also makes it newer.
+    """
+    return table_state_cache.get(('version', ), CATALOG_TABLES,
+                                 lambda: _read_catalog_version(store))
+
+
+def format_version(version):
+    return version and version.strftime(VERSION_FORMAT)
+
+
+def parse_version(value):
+    """Parse a version received from a client
+
+    :returns: the version as a datetime or ``None`` if it is not valid
+    """
+    if not value:
+        return None
+
+    try:
+        return datetime.datetime.strptime(value, VERSION_FORMAT)
+    except ValueError:
+        log.info('Invalid catalog version received: %r', value)
+        return None
+
+
+def can_send_delta(since, version):
+    """Check if a client on version *since* can be updated with a delta"""
+    if since is None or version is None:
+        return False
+    # A client ahead of us probably saw a database that was restored since then
+    return since <= version and version - since <= DELTA_MAX_AGE
+
+
+def _get_changed_ids(store, since, tables):
+    query = ' UNION '.join(_CHANGED_IDS_QUERY.format(table=table, column=column)
+                           for table, column in tables)
+    since = since - DELTA_OVERLAP
+    return set(row[0] for row in store.execute(query, params=[since] * len(tables)))
+
+
+def get_deleted_ids(store, since, kind):
+    """Get the ids of the sellables or categories (*kind*) affected by deletions after *since*
+
+    For sellables, those are the ones deleted and the ones that had a row referencing them
+    deleted, like a branch override or a category price.
+    """
+    rows = store.execute(_DELETED_IDS_QUERY, params=[kind, since - DELTA_OVERLAP])
+    return set(row[0] for row in rows)
+
+
+def get_changed_sellable_ids(store, since):
+    """Get the ids of the sellables that changed or were deleted after *since*"""
+    changed = _get_changed_ids(store, since, SELLABLE_TABLES)
+    return changed | get_deleted_ids(store, since, 'sellable')
+
+
+def get_ids_for_changes(store, changes):
+    """Get the sellables and categories affected by changes from the :class:`ChangeListener`
+
+    Rows that were deleted can't be found anymore, so their sellables are not included.
+
+    :returns: a tuple with the set of sellable ids and the set of category ids
+    """
+    sellable_ids = set()
+    for table, column in SELLABLE_TABLES:
+        if table in changes:
+            sellable_ids.update(row[0] for row in store.execute(_TE_IDS_QUERY.format(
+                table=table, column=column), params=[list(changes[table])]))
+
+    category_ids = set()
+    if 'sellable_category' in changes:
+        category_ids.update(row[0] for row in store.execute(_TE_IDS_QUERY.format(
+            table='sellable_category', column='id'), params=[list(changes['sellable_category'])]))
+    return sellable_ids, category_ids
+
+
+def get_changed_category_ids(store, since):
+    """Get the ids of the sellable categories that changed or were deleted after *since*"""
+    changed = _get_changed_ids(store, since, [('sellable_category', 'id')])
+    return changed | get_deleted_ids(store, since, 'category')
+
+
+class SellableDataLoader:
+    """Prefetch the branch data needed to dump the sellables of the catalog
+
+    ``Sellable.get_price`` and the other branch aware accessors do a few queries each, which adds
+    up to several queries per sellable when dumping the whole catalog. This loads all of it for the
+    branch in a constant number of queries.
+
+    :param sellable_ids: restrict what is loaded to those sellables, or load all of them
+        if ``None``
+    """
+
+    def __init__(self, store, branch, sellable_ids=None):
+        self.branch = branch
+
+        overrides = [SellableBranchOverride.branch_id == branch.id]
+        stock_items = []
+        prices = [ClientCategoryPrice.category_id == branch.default_client_category_id]
+        if sellable_ids is not None:
+            sellable_ids = list(sellable_ids)
+            overrides.append(SellableBranchOverride.sellable_id.is_in(sellable_ids))
+            # The storable shares its id with the product and the sellable
+            stock_items.append(ProductStockItem.storable_id.is_in(sellable_ids))
+            prices.append(ClientCategoryPrice.sellable_id.is_in(sellable_ids))
+
+        self._overrides = set(store.find(SellableBranchOverride.sellable_id, *overrides))
+
+        self._stock = {}
+        for item in store.find(ProductStockItem, *stock_items):
+            self._stock.setdefault(item.storable_id, {})[item.branch_id] = str(item.quantity)
+
+        self._prices = {}
+        if branch.default_client_category_id is not None:
+            self._prices = dict(store.find((ClientCategoryPrice.sellable_id,
+                                            ClientCategoryPrice.price), *prices))
+
+    def get_price(self, sellable):
+        """The same as ``sellable.get_price(branch)``"""
+        # Overrides are rare and have rules of their own, so let the domain handle them
+        if sellable.id in self._overrides:
+            return sellable.get_price(self.branch)
+        if sellable.is_on_sale():
+            return sellable.on_sale_price
+        # Not sellable.price, which uses the DEFAULT_TABLE_PRICE parameter instead of the branch
+        return self._prices.get(sellable.id, sellable.base_price)
+
+    def get_requires_kitchen_production(self, sellable):
+        """The same as ``sellable.get_requires_kitchen_production(branch)``"""
+        if sellable.id in self._overrides:
+            return sellable.get_requires_kitchen_production(self.branch)
+        return sellable.requires_kitchen_production
+
+    def get_availability(self, storable):
+        """Get the stock quantity of the storable in each branch"""
+        if storable is None:
+            return None
+        return self._stock.get(storable.id, {})
+
+
+class SaleSellableLoader:
+    """Prefetch the sellables being sold, with their products and package components
+
+    Adding each item to a sale gets its sellable, its product and, for packages, the components
+    and their sellables, which is a chain of queries per item. This loads all of them in a
+    constant number of queries, leaving them in the store cache.
+    """
+
+    def __init__(self, store, sellable_ids):
+        sellable_ids = list(set(sellable_ids))
+        self._sellables = {sellable.id: sellable
+                           for sellable in store.find(Sellable, Sellable.id.is_in(sellable_ids))}
+
+        # The product shares its id with the sellable
+        package_ids = [product.id for product in store.find(Product, Product.id.is_in(sellable_ids))
+                       if product.is_package]
+
+        self._components = {}
+        for component in store.find(ProductComponent,
+                                    ProductComponent.product_id.is_in(package_ids)):
+            self._components.setdefault(component.product_id, []).append(component)
+
+        component_ids = list({component.component_id
+                              for components in self._components.values()
+                              for component in components})
+        if component_ids:
+            list(store.find(Product, Product.id.is_in(component_ids)))
+            list(store.find(Sellable, Sellable.id.is_in(component_ids)))
+
+    def get_sellable(self, sellable_id):
+        """Get the sellable with the given id, or ``None`` if it does not exist"""
+        return self._sellables.get(sellable_id)
+
+    def get_components(self, product):
+        """The same as ``product.get_components()``"""
+        return self._components.get(product.id, [])
+
+
+CatalogSnapshot = collections.namedtuple('CatalogSnapshot', ['signature', 'version', 'categories'])
+CatalogSnapshot.__doc__ = """The categories tree, with the signature and version it was built at
+
+The cache is only invalidated after the change listener hears about a change, so whatever is sent
+with a cached tree must describe it, not what is in the database by then.
+"""
+
+
+class CatalogCache:
+    """An in-process cache of catalog snapshots
+
+    Building the catalog is expensive and its result is the same for all the stations that share
+    the same key, so concurrent requests for the same key wait for a single computation.
+
+    The cache is only enabled while the change listener is listening for database changes, since
+    that is what invalidates it.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._entries = {}
+        self._locks = {}
+        self._generation = 0
+
+    def get(self, key, build):
+        """Get the snapshot for *key*, calling *build* to create it if needed"""
+        if not self.enabled:
+            return build()
+
+        with self._locks.setdefault(key, Semaphore()):
+            try:
+                return self._entries[key]
+            except KeyError:
+                pass
+
+            generation = self._generation
+            value = build()
+            # Don't cache something that was invalidated while we were building it
+            if self.enabled and generation == self._generation:
+                self._entries[key] = value
+            return value
+
+    def invalidate(self):
+        self._generation += 1
+        self._entries.clear()
+
+
+catalog_cache = CatalogCache()
+
+
+def _on_database_changes(changes):
+    # The caches can only be trusted while we are being notified of the changes
+    catalog_cache.enabled = table_state_cache.enabled = change_listener.listening
+    if changes is None:
+        table_state_cache.invalidate()
+    elif changes:
+        table_state_cache.invalidate(set(changes))
+    if changes is None or CACHE_TABLES & set(changes):
+        catalog_cache.invalidate()
+
+
+change_listener.subscribe(_on_database_changes)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Changes made to the database by any process
+
+Stoq notifies the ``update_te`` channel with ``te_id,table`` whenever a row is changed.
+:class:`ChangeListener` listens to it without blocking the other greenlets and gives the changes
+to its subscribers in batches, since a single transaction usually changes lots of rows.
+"""
+
+import logging
+import socket
+import time
+
+import gevent
+import psycopg2
+import psycopg2.extensions
+from gevent.socket import wait_read
+from stoqlib.api import api
+
+from .metrics import registry
+
+log = logging.getLogger(__name__)
+
+# In seconds. Changes are sent after no new ones arrive for DEBOUNCE_WINDOW, but never later
+# than MAX_DEBOUNCE_DELAY after the first one
+DEBOUNCE_WINDOW = 0.2
+MAX_DEBOUNCE_DELAY = 1
+LISTEN_RETRY_INTERVAL = 10
+
+notifications_received = registry.counter('changes_notifications',
+                                          'Rows changed in the database')
+batches_dispatched = registry.counter('changes_batches', 'Batches of changes sent to subscribers')
+
+
+class ChangeListener:
+    """Listen to the changes made to the database
+
+    The subscribers are called with a dict mapping the tables that changed to the set of te_ids of
+    their changed rows. They are called with ``None`` when anything might have changed without
+    being notified, which is when we start listening and when we stop.
+    """
+
+    def __init__(self):
+        self.listening = False
+        self._handlers = []
+
+    def subscribe(self, handler):
+        self._handlers.append(handler)
+
+    def run(self):
+        """Listen forever, reconnecting to the database when needed"""
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                log.exception('Change listener failed. Trying again in %s seconds',
+                              LISTEN_RETRY_INTERVAL)
+            gevent.sleep(LISTEN_RETRY_INTERVAL)
+
+    def _listen(self):
+        store = api.new_store()
+        try:
+            conn = store._connection._raw_connection
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = store._connection.build_raw_cursor()
+            cursor.execute("LISTEN update_te;")
+
+            self.listening = True
+            log.info('Listening for database changes')
+            # Something might have changed before we started listening
+            self._dispatch(None)
+            self._loop(conn)
+        finally:
+            if self.listening:
+                self.listening = False
+                self._dispatch(None)
+            store.close()
+
+    def _loop(self, conn):
+        changes = {}
+        first_at = last_at = None
+        while True:
+            timeout = None
+            if changes:
+                timeout = min(last_at + DEBOUNCE_WINDOW,
+                              first_at + MAX_DEBOUNCE_DELAY) - time.monotonic()
+
+            if timeout is None or timeout > 0:
+                try:
+                    wait_read(conn.fileno(), timeout=timeout)
+                except socket.timeout:
+                    pass
+                else:
+                    conn.poll()
+                    last_at = time.monotonic()
+                    first_at = first_at or last_at
+                    while conn.notifies:
+                        te_id, table = conn.notifies.pop(0).payload.split(',')
+                        changes.setdefault(table, set()).add(int(te_id))
+                        notifications_received.inc()
+                    continue
+
+            self._dispatch(changes)
+            changes = {}
+            first_at = last_at = None
+
+    def _dispatch(self, changes):
+        if changes is not None:
+            batches_dispatched.inc()
+        for handler in self._handlers:
+            try:
+                handler(changes)
+            except Exception:
+                log.exception('Failed to handle database changes')
+
+
+change_listener = ChangeListener()
+
+
+def listen_changes():
+    """Keep listening to the database changes
+
+    This should be spawned in its own greenlet and will run forever.
+    """
+    change_listener.run()
@@ -28,19 +28,22 @@ from stoqdrivers.exceptions import InvalidReplyException
 from stoqlib.database.runtime import get_current_station
 
 from ..signals import CheckPinpadStatusEvent, CheckSatStatusEvent
-from .lock import lock_pinpad, lock_printer, lock_sat
+from .lock import LOW, lock_pinpad, lock_printer, lock_sat
 
 
-@lock_printer
-def check_drawer():
+# Those are background checks, so they give up when the device is being used
+@lock_printer(block=False, priority=LOW)
+def check_drawer(max_age=0):
     from .restful import DrawerResource
     try:
-        return DrawerResource.ensure_printer(get_current_station(), retries=1)
+        # The drawer poller is what keeps the printer health up to date, so by default this
+        # always checks the printer
+        return DrawerResource.ensure_printer(get_current_station(), max_age=max_age)
     except (SerialException, InvalidReplyException):
         return None
 
 
-@lock_pinpad(block=False)
+@lock_pinpad(block=False, priority=LOW)
 def check_pinpad():
     responses = CheckPinpadStatusEvent.send()
     if len(responses) > 0:
@@ -48,7 +51,7 @@ def check_pinpad():
     return True
 
 
-@lock_sat(block=False)
+@lock_sat(block=False, priority=LOW)
 def check_sat():
     if len(CheckSatStatusEvent.receivers) == 0:
         # No SAT was found, what means there is no need to warn front-end there is a missing
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""A pool of database connections for the stores
+
+Each ``api.new_store()`` creates a storm connection, which used to open a new postgres backend
+and close it when the store was closed. :func:`install_pool` makes storm get its raw connections
+from a :class:`ConnectionPool` and give them back to it when they are closed.
+"""
+
+import logging
+import time
+
+import gevent
+import psycopg2
+import psycopg2.extensions
+from gevent.lock import BoundedSemaphore
+from storm.database import Connection
+from storm.databases.postgres import Postgres
+
+from ..utils import get_int_config
+from .metrics import registry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 20
+# In seconds
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_TIMEOUT = 30
+# Connections idle for more than this many seconds are checked before being used again
+HEALTH_CHECK_INTERVAL = 30
+
+pool_wait_time = registry.histogram('dbpool_wait_seconds',
+                                    'Time waited to get a connection from the pool')
+pool_timeouts = registry.counter('dbpool_timeouts',
+                                 'Times a connection was not available in time')
+pool_discarded = registry.counter('dbpool_discarded',
+                                  'Connections closed because they were broken or modified')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """A bounded pool of psycopg2 connections
+
+    At most *max_size* connections are open at any time and at least *min_size* are kept open
+    even when idle. Other idle connections are closed after *idle_timeout* seconds.
+
+    :param connect: a callable that opens a new connection
+    :param timeout: how long, in seconds, to wait for a connection before raising
+        :exc:`PoolTimeout`
+    """
+
+    def __init__(self, connect, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT):
+        assert 0 <= min_size <= max_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._connect = connect
+        self._slots = BoundedSemaphore(max_size)
+        # Connections being used, mapped to their original isolation level
+        self._in_use = {}
+        # Idle connections and when they were released, the most recent last
+        self._idle = []
+
+    @property
+    def size(self):
+        return len(self._in_use) + len(self._idle)
+
+    @property
+    def in_use(self):
+        return len(self._in_use)
+
+    def owns(self, conn):
+        return conn in self._in_use
+
+    def acquire(self):
+        """Get a connection from the pool, opening a new one if needed"""
+        start = time.monotonic()
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            # Storm forgets about connections that were broken by a disconnection, without
+            # closing them. Check if any of those are still taking a slot before waiting, or
+            # every request would wait for the timeout after the database is restarted
+            self._reclaim_closed()
+            acquired = self._slots.acquire(timeout=self.timeout)
+        pool_wait_time.observe(time.monotonic() - start)
+
+        if not acquired:
+            pool_timeouts.inc()
+            raise PoolTimeout('No database connection available after {} seconds'.format(
+                self.timeout))
+
+        try:
+            conn = self._get_idle_connection()
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._in_use[conn] = conn.isolation_level
+        return conn
+
+    def release(self, conn):
+        """Give a connection back to the pool"""
+        isolation_level = self._in_use.pop(conn)
+        try:
+            if self._reset(conn, isolation_level):
+                self._idle.append((conn, time.monotonic()))
+            else:
+                pool_discarded.inc()
+                self._close(conn)
+        finally:
+            self._slots.release()
+
+    def close_idle(self, keep=0):
+        """Close the idle connections that timed out, keeping at least *keep* of them"""
+        now = time.monotonic()
+        # The oldest ones are in the beginning of the list
+        while len(self._idle) > keep and now - self._idle[0][1] >= self.idle_timeout:
+            conn, released_at = self._idle.pop(0)
+            self._close(conn)
+
+    def fill(self):
+        """Open connections until there are at least min_size of them"""
+        while self.size < self.min_size:
+            if not self._slots.acquire(blocking=False):
+                break
+            try:
+                conn = self._connect()
+            finally:
+                self._slots.release()
+            self._idle.insert(0, (conn, time.monotonic()))
+
+    def maintain(self, interval=10):
+        """Keep the pool within its limits. This runs forever"""
+        while True:
+            try:
+                self.close_idle(keep=self.min_size)
+                self.fill()
+            except Exception:
+                log.exception('Failed to maintain the connection pool')
+            gevent.sleep(interval)
+
+    def _get_idle_connection(self):
+        while self._idle:
+            # Use the most recent one, so that the oldest ones can time out
+            conn, released_at = self._idle.pop()
+            if time.monotonic() - released_at < HEALTH_CHECK_INTERVAL or self._check(conn):
+                return conn
+            pool_discarded.inc()
+            self._close(conn)
+        return None
+
+    def _check(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _reset(self, conn, isolation_level):
+        if conn.closed:
+            return False
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        # Someone changed the connection (e.g. to LISTEN in autocommit mode), so it is not
+        # what the next user would expect
+        if conn.isolation_level != isolation_level:
+            return False
+        return conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def _reclaim_closed(self):
+        for conn in list(self._in_use):
+            if conn.closed:
+                del self._in_use[conn]
+                pool_discarded.inc()
+                self._slots.release()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+def install_pool():
+    """Make the storm connections of this process use a :class:`ConnectionPool`
+
+    This is configured by the ``dbpool_min_size``, ``dbpool_max_size``,
+    ``dbpool_idle_timeout`` and ``dbpool_timeout`` keys of the General section of the config.
+    A max size of 0 disables the pool.
+    """
+    max_size = get_int_config('dbpool_max_size', DEFAULT_MAX_SIZE)
+    if not max_size:
+        log.info('Database connection pool disabled')
+        return
+
+    min_size = min(get_int_config('dbpool_min_size', DEFAULT_MIN_SIZE), max_size)
+    idle_timeout = get_int_config('dbpool_idle_timeout', DEFAULT_IDLE_TIMEOUT)
+    timeout = get_int_config('dbpool_timeout', DEFAULT_TIMEOUT)
+
+    original_raw_connect = Postgres.raw_connect
+    original_close = Connection.close
+    pools = {}
+
+    def get_pool(database):
+        pool = pools.get(database)
+        if pool is None:
+            pool = pools[database] = ConnectionPool(
+                lambda: original_raw_connect(database), min_size=min_size, max_size=max_size,
+                idle_timeout=idle_timeout, timeout=timeout)
+            registry.gauge('dbpool_size', 'Open connections in the pool', func=lambda: pool.size)
+            registry.gauge('dbpool_in_use', 'Connections being used', func=lambda: pool.in_use)
+            gevent.spawn(pool.maintain)
+        return pool
+
+    def raw_connect(self):
+        return get_pool(self).acquire()
+
+    def close(self):
+        pool = pools.get(self._database)
+        raw_connection = self._raw_connection
+        if pool is not None and raw_connection is not None and pool.owns(raw_connection):
+            self._raw_connection = None
+            pool.release(raw_connection)
+        original_close(self)
+
+    Postgres.raw_connect = raw_connect
+    Connection.close = close
+    log.info('Database connection pool installed (min_size=%s, max_size=%s)',
+             min_size, max_size)
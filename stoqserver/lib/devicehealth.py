@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""The last known health of the printer
+
+The drawer poller checks the printer regularly, so the requests use the result of its last
+check instead of doing a round-trip to the printer themselves. They only check it when the poller
+is not running or is late. When the printer fails, reopening it is only tried again after an
+exponential backoff.
+"""
+
+import time
+
+from .drawer import MAX_POLL_INTERVAL
+from .metrics import registry
+
+# In seconds. How old the last check can be to be trusted by the requests: the longest the poller
+# waits between its checks, plus some time for the check itself
+DEFAULT_MAX_AGE = MAX_POLL_INTERVAL + 5
+# In seconds. Reopening the printer is tried again after RECONNECT_INTERVAL, doubling after each
+# failure up to MAX_RECONNECT_INTERVAL
+RECONNECT_INTERVAL = 1
+MAX_RECONNECT_INTERVAL = 60
+
+printer_checks = registry.counter('printer_checks', 'Round-trips made to check the printer')
+printer_cache_hits = registry.counter('printer_health_cache_hits',
+                                      'Printer checks answered with the last known health')
+printer_reconnects = registry.counter('printer_reconnects', 'Attempts to reopen the printer')
+
+
+class PrinterHealth:
+    def __init__(self):
+        self.is_drawer_open = None
+        # The exception of the last check, if it failed
+        self.error = None
+        self.failures = 0
+        self._checked_at = None
+        self._next_reconnect_at = 0
+
+    @property
+    def ok(self):
+        """If the printer was working in the last check, or ``None`` if it was never checked"""
+        if self._checked_at is None:
+            return None
+        return self.error is None
+
+    def is_fresh(self, max_age):
+        return self._checked_at is not None and time.monotonic() - self._checked_at < max_age
+
+    def can_reconnect(self):
+        return time.monotonic() >= self._next_reconnect_at
+
+    def record_reconnect(self):
+        printer_reconnects.inc()
+
+    def record_success(self, is_drawer_open):
+        printer_checks.inc()
+        self.is_drawer_open = is_drawer_open
+        self.error = None
+        self.failures = 0
+        self._checked_at = time.monotonic()
+        self._next_reconnect_at = 0
+
+    def record_failure(self, error):
+        printer_checks.inc()
+        self.error = error
+        self.failures += 1
+        self._checked_at = time.monotonic()
+        self._next_reconnect_at = self._checked_at + min(
+            RECONNECT_INTERVAL * 2 ** (self.failures - 1), MAX_RECONNECT_INTERVAL)
+
+    def get(self):
+        """Get the last known drawer status, raising the error of the last check if it failed"""
+        printer_cache_hits.inc()
+        if self.error is not None:
+            raise self.error.with_traceback(None)
+        return self.is_drawer_open
+
+
+printer_health = PrinterHealth()
+
+registry.gauge('printer_ok', 'If the printer was working in the last check',
+               func=lambda: printer_health.ok)
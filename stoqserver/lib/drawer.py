@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Adaptive polling of the cash drawer status
+
+Checking the drawer is a round-trip to the printer while holding its lock, so it competes with the
+print jobs. The drawer is only checked every second while it is open and for a while after
+something that could open it, like a sale or a drawer open command. Otherwise the interval backs
+off up to MAX_POLL_INTERVAL.
+"""
+
+import time
+
+from gevent.event import Event
+
+from .metrics import registry
+
+# In seconds
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 30
+FAST_POLL_PERIOD = 60
+
+polls = registry.counter('drawer_polls', 'Times the drawer status was checked')
+polls_skipped = registry.counter('drawer_polls_skipped',
+                                 'Drawer checks postponed because the printer was busy')
+poll_duration = registry.histogram('drawer_poll_seconds',
+                                   'How long checking the drawer took, including the printer lock')
+
+
+class DrawerPoller:
+    def __init__(self):
+        self.interval = MIN_POLL_INTERVAL
+        self._fast_until = 0
+        self._woken = Event()
+
+    def wake(self):
+        """Check the drawer now and often for a while
+
+        Call this when something might open the drawer.
+        """
+        self._fast_until = time.monotonic() + FAST_POLL_PERIOD
+        self._woken.set()
+
+    def poll(self, check):
+        """Check the drawer status with *check*"""
+        # Wakes from now on are for the next check
+        self._woken.clear()
+        with poll_duration.time():
+            is_open = check()
+        polls.inc()
+        return is_open
+
+    def wait(self, is_open):
+        """Wait until the drawer should be checked again"""
+        if is_open or time.monotonic() < self._fast_until:
+            self.interval = MIN_POLL_INTERVAL
+        else:
+            self.interval = min(self.interval * 2, MAX_POLL_INTERVAL)
+        self._woken.wait(self.interval)
+
+
+drawer_poller = DrawerPoller()
+
+registry.gauge('drawer_poll_interval', 'Seconds between the drawer checks',
+               func=lambda: drawer_poller.interval)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""The queue of the fiscal documents to be emitted
+
+Emitting a NFC-e or a SAT coupon talks to SEFAZ or to the SAT device and can take several seconds.
+The sales with ``postpone_emission`` are answered as soon as they are committed and have their
+documents emitted in the background, in the same order each station sold them, by the server of
+the station or, when it has none, by the multiclient servers. The station is told about each job
+with ``EMISSION_JOB_STATUS`` events, besides the usual ``NFE_PROGRESS`` ones.
+
+The handlers are registered by :mod:`stoqserver.lib.restful`, which knows the fiscal plugins.
+"""
+
+from .jobqueue import JobQueue
+from .lock import lock_printer, lock_sat
+
+# SEFAZ might be unavailable for a while
+MAX_ATTEMPTS = 10
+
+emission_queue = JobQueue('emission', 'EMISSION_JOB_STATUS',
+                          decorators=[lock_printer, lock_sat(block=True)],
+                          ordered=True, max_attempts=MAX_ATTEMPTS)
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Messages between the processes of stoqserver
+
+State kept in the memory of a flask worker (e.g. the event stream of a station) is not visible by
+the other processes: the other workers, when the server runs with more than one of them, or the
+plugin tasks started by the task manager. Messages published here are sent through a
+:class:`Transport` and handled by all the flask workers, except the one that sent them.
+
+The flask server batches the messages it publishes within :data:`BATCH_WINDOW` seconds in a
+single payload. Other processes send each message right away, since they might not be running a
+gevent loop to flush them later.
+"""
+
+import abc
+import json
+import logging
+import os
+
+import gevent
+import psycopg2
+import psycopg2.extensions
+from gevent.socket import wait_read
+from stoqlib.api import api
+
+from ..utils import JsonEncoder
+from .metrics import registry
+from .schema import register_table
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'stoqserver_bus'
+# Postgres refuses NOTIFY payloads with this many bytes or more
+MAX_PAYLOAD_SIZE = 8000
+# In seconds
+BATCH_WINDOW = 0.01
+SPILL_MAX_AGE = 300
+LISTEN_RETRY_INTERVAL = 10
+
+register_table("""
+    CREATE UNLOGGED TABLE IF NOT EXISTS stoqserver_bus_spill (
+        id bigserial PRIMARY KEY,
+        payload text NOT NULL,
+        created_at timestamp NOT NULL DEFAULT NOW())
+""")
+
+messages_published = registry.counter('eventbus_published',
+                                      'Messages sent to the other processes')
+messages_received = registry.counter('eventbus_received',
+                                     'Messages received from other processes')
+payloads_sent = registry.counter('eventbus_payloads_sent', 'Batches of messages sent')
+payloads_spilled = registry.counter('eventbus_payloads_spilled',
+                                    'Batches too big to be sent without using a table')
+send_failures = registry.counter('eventbus_send_failures', 'Batches that failed to be sent')
+
+
+class Transport(abc.ABC):
+    """How the messages get to the other processes"""
+
+    @abc.abstractmethod
+    def send(self, payloads):
+        """Send a list of payloads, which are strings"""
+
+    @abc.abstractmethod
+    def listen(self, receive):
+        """Call *receive* with each payload sent by any process. This runs forever"""
+
+
+class PostgresTransport(Transport):
+    """Send the payloads through postgres NOTIFY
+
+    Postgres refuses payloads with :data:`MAX_PAYLOAD_SIZE` bytes or more, so those are stored in
+    a table and only their id is notified. They are kept there for :data:`SPILL_MAX_AGE` seconds.
+    """
+
+    SPILL_PREFIX = 'spill:'
+
+    def __init__(self, channel=CHANNEL):
+        self.channel = channel
+
+    def send(self, payloads):
+        # Use a store of its own, since the notifications are only sent when the transaction is
+        # committed, and the caller might still be in the middle of one
+        with api.new_store() as store:
+            for payload in payloads:
+                if len(payload.encode()) >= MAX_PAYLOAD_SIZE:
+                    payload = self._spill(store, payload)
+                store.execute('SELECT pg_notify(?, ?)', (self.channel, payload))
+
+    def listen(self, receive):
+        store = api.new_store()
+        try:
+            conn = store._connection._raw_connection
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = store._connection.build_raw_cursor()
+            cursor.execute('LISTEN {};'.format(self.channel))
+            log.info('Listening for messages from the other processes')
+
+            while True:
+                wait_read(conn.fileno())
+                conn.poll()
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    if payload.startswith(self.SPILL_PREFIX):
+                        payload = self._unspill(cursor, payload)
+                    if payload is not None:
+                        receive(payload)
+        finally:
+            store.close()
+
+    def _spill(self, store, payload):
+        payloads_spilled.inc()
+        # Every listener already had plenty of time to read those
+        store.execute("DELETE FROM stoqserver_bus_spill "
+                      "WHERE created_at < NOW() - ? * INTERVAL '1 second'", (SPILL_MAX_AGE, ))
+        spill_id = store.execute("INSERT INTO stoqserver_bus_spill (payload) VALUES (?) "
+                                 "RETURNING id", (payload, )).get_one()[0]
+        return self.SPILL_PREFIX + str(spill_id)
+
+    def _unspill(self, cursor, payload):
+        spill_id = int(payload[len(self.SPILL_PREFIX):])
+        cursor.execute("SELECT payload FROM stoqserver_bus_spill WHERE id = %s", (spill_id, ))
+        row = cursor.fetchone()
+        if row is None:
+            log.warning('Message %s expired before being read', spill_id)
+            return None
+        return row[0]
+
+
+_transport = PostgresTransport()
+_handlers = {}
+_has_peers = False
+_batching = False
+_pending = []
+_flusher = None
+
+
+def set_transport(transport):
+    global _transport
+    _transport = transport
+
+
+def has_peers():
+    """If there are other flask workers serving the API together with this one"""
+    return _has_peers
+
+
+def subscribe(kind, handler):
+    """Call *handler* with the data of the messages of *kind* sent by other processes"""
+    _handlers.setdefault(kind, []).append(handler)
+
+
+def publish(kind, data):
+    """Send a message to the flask workers
+
+    *data* must be serializable by :class:`stoqserver.utils.JsonEncoder`.
+    """
+    global _flusher
+    messages_published.inc()
+    message = json.dumps({'kind': kind, 'data': data}, cls=JsonEncoder)
+    if not _batching:
+        _send([message])
+        return
+
+    _pending.append(message)
+    if _flusher is None:
+        _flusher = gevent.spawn_later(BATCH_WINDOW, flush)
+
+
+def publish_event(data, station_id=None):
+    """Send an event to the stream of a station, or to all of them if *station_id* is ``None``
+
+    This is meant for processes that are not serving the API, like the plugin tasks, since the
+    flask server itself should just use ``EventStream.add_event``.
+    """
+    publish('event', {'station_id': station_id, 'data': data})
+
+
+def flush():
+    """Send the messages waiting for the batch window to end"""
+    global _flusher
+    _flusher = None
+    messages = _pending[:]
+    del _pending[:]
+    if messages:
+        _send(messages)
+
+
+def pack(messages, origin=None):
+    """Join encoded messages in as few payloads as possible
+
+    Each payload has less than :data:`MAX_PAYLOAD_SIZE` bytes, unless it has a single message
+    bigger than that.
+    """
+    prefix = '{{"origin": {}, "messages": ['.format(origin or os.getpid())
+    suffix = ']}'
+    payloads = []
+    batch = []
+    size = len(prefix) + len(suffix)
+    for message in messages:
+        message_size = len(message.encode()) + 2
+        if batch and size + message_size >= MAX_PAYLOAD_SIZE:
+            payloads.append(prefix + ', '.join(batch) + suffix)
+            batch = []
+            size = len(prefix) + len(suffix)
+        batch.append(message)
+        size += message_size
+
+    if batch:
+        payloads.append(prefix + ', '.join(batch) + suffix)
+    return payloads
+
+
+def _send(messages):
+    payloads = pack(messages)
+    try:
+        _transport.send(payloads)
+    except Exception:
+        # The caller is probably in the middle of something more important, like a sale
+        send_failures.inc(len(payloads))
+        log.exception('Failed to send %s messages to the other processes', len(messages))
+    else:
+        payloads_sent.inc(len(payloads))
+
+
+def dispatch(payload):
+    batch = json.loads(payload)
+    # We already handled the messages we sent
+    if batch['origin'] == os.getpid():
+        return
+
+    for message in batch['messages']:
+        messages_received.inc()
+        for handler in _handlers.get(message['kind'], []):
+            try:
+                handler(message['data'])
+            except Exception:
+                log.exception('Failed to handle message %s', message['kind'])
+
+
+def listen_messages(has_peers=False):
+    """Receive the messages of the other processes
+
+    This should be spawned by the flask server in its own greenlet and will run forever,
+    reconnecting to the database when needed.
+
+    :param has_peers: if there are other flask workers serving the API together with this one
+    """
+    global _has_peers, _batching
+    _has_peers = has_peers
+    _batching = True
+    while True:
+        try:
+            _transport.listen(dispatch)
+        except Exception:
+            log.exception('Message listener failed. Trying again in %s seconds',
+                          LISTEN_RETRY_INTERVAL)
+        gevent.sleep(LISTEN_RETRY_INTERVAL)
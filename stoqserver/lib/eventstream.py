@@ -25,19 +25,27 @@
 from contextlib import suppress
 from enum import Enum
 from typing import Dict
+import collections
+import itertools
 import json
 import logging
+import os
+import time
 
+import gevent
 from flask import make_response, request, Response
 from gevent.event import Event
 from gevent.queue import Queue, Empty
 from psycopg2 import DataError
 
 from ..signals import EventStreamEstablishedEvent, TefCheckPendingEvent
-from ..utils import JsonEncoder
+from ..utils import JsonEncoder, is_gzip_requested, iter_gzip
 from stoqlib.api import api
 from stoqlib.domain.station import BranchStation
+from stoqlib.lib.configparser import get_config
+from stoqserver.lib import eventbus
 from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.metrics import registry
 
 log = logging.getLogger(__name__)
 
@@ -46,6 +54,50 @@ log = logging.getLogger(__name__)
 Dict
 
 
+# In seconds
+HEARTBEAT_INTERVAL = 10
+COALESCE_WINDOW = 0.02
+DEFAULT_MAX_QUEUE_SIZE = 100
+# How many of the last events of each station are kept to be sent again after a reconnection
+REPLAY_BUFFER_SIZE = 50
+
+_STARTED_AT = int(time.time())
+
+# What to do with an event when the queue of its station is full
+DROP_OLDEST = 'drop_oldest'
+# Replace the queued event with the same key (see get_coalesce_key), or drop the oldest if there
+# is none
+COALESCE = 'coalesce'
+# Close the stream, so the station connects again and fetches everything
+DISCONNECT = 'disconnect'
+
+OVERFLOW_POLICIES = {
+    'DEVICE_STATUS_CHANGED': COALESCE,
+    'DRAWER_ALERT_OPEN': COALESCE,
+    'DRAWER_ALERT_CLOSE': COALESCE,
+    'DRAWER_ALERT_ERROR': COALESCE,
+    # Those can't be lost without the station getting out of sync
+    'SERVER_UPDATE_DATA': DISCONNECT,
+    'DATA_CHANGED': DISCONNECT,
+    'TEF_ASK_QUESTION': DISCONNECT,
+    'CLEAR_SALE': DISCONNECT,
+}
+
+# Events that expect a reply. Nobody waits for it anymore after a reconnection (see
+# _break_waiting_reply), so those are not sent again
+NOT_REPLAYED = {'TEF_ASK_QUESTION'}
+
+events_superseded = registry.counter('eventstream_superseded',
+                                     'Device status events dropped for a newer one')
+events_dropped = registry.counter('eventstream_dropped',
+                                  'Events dropped because the queue of the station was full')
+streams_disconnected = registry.counter('eventstream_disconnected',
+                                        'Streams closed because their queue overflowed')
+
+# Put in the queue to make the stream close
+_CLOSE_STREAM = object()
+
+
 DRAWER_STATUS_TO_EVENT_TYPE_MAP = {
     True: 'DRAWER_ALERT_OPEN',
     False: 'DRAWER_ALERT_CLOSE',
@@ -68,6 +120,120 @@ class EventStreamBrokenException(Exception):
     pass
 
 
+class StreamEvent(dict):
+    """An event sent to a station, identified by a sequence number of this process
+
+    The id sent to the station also identifies the process, since a reconnection can only resume
+    from events that were sent by the same one.
+    """
+
+    def __init__(self, data, seq):
+        super().__init__(data)
+        self.seq = seq
+
+    @property
+    def event_id(self):
+        return '{}-{}'.format(_get_event_id_prefix(), self.seq)
+
+
+def _get_event_id_prefix():
+    # The pid changes in each of the forked workers, unlike anything computed on import
+    return '{}.{}'.format(_STARTED_AT, os.getpid())
+
+
+def parse_event_id(event_id):
+    """Get the sequence number of an event id sent by this process, or ``None``"""
+    prefix, sep, seq = (event_id or '').rpartition('-')
+    if prefix != _get_event_id_prefix():
+        return None
+    try:
+        return int(seq)
+    except ValueError:
+        return None
+
+
+def get_coalesce_key(data):
+    """Get a key shared by the events that supersede each other, or ``None``"""
+    if not isinstance(data, dict):
+        return None
+    if data.get('type') in DRAWER_STATUS_TO_EVENT_TYPE_MAP.values():
+        return DeviceType.DRAWER.value
+    if data.get('type') == 'DEVICE_STATUS_CHANGED':
+        return data['device']
+    return None
+
+
+class EventQueue(Queue):
+    """The queue of events waiting to be sent to a station
+
+    When the queue is full, the :data:`OVERFLOW_POLICIES` of the event being added decides what
+    to do to make room for it.
+    """
+
+    def __init__(self, maxsize=None):
+        super().__init__(maxsize)
+        # When each of the queued events was added, in the same order
+        self._times = collections.deque()
+        self.disconnected = False
+
+    @property
+    def lag(self):
+        """For how long, in seconds, the oldest queued event is waiting"""
+        return time.monotonic() - self._times[0] if self._times else 0
+
+    def put(self, item, block=True, timeout=None):
+        if self.disconnected:
+            return
+        if self.full() and not self._make_room(item):
+            return
+        super().put(item, block, timeout)
+
+    def disconnect(self):
+        """Drop the queued events and close the stream, so that the station connects again"""
+        events_dropped.inc(self.qsize())
+        streams_disconnected.inc()
+        self.queue.clear()
+        self._times.clear()
+        self.disconnected = True
+        # Wake up the stream if it is waiting
+        super().put(_CLOSE_STREAM, block=False)
+
+    def _get_policy(self, item):
+        event_type = item.get('type') if isinstance(item, dict) else None
+        return OVERFLOW_POLICIES.get(event_type, DROP_OLDEST)
+
+    def _make_room(self, item):
+        policy = self._get_policy(item)
+        if policy == COALESCE:
+            key = get_coalesce_key(item)
+            for i, data in enumerate(self.queue):
+                if get_coalesce_key(data) == key:
+                    # Keep its time, since the station is waiting for it since then
+                    self.queue[i] = item
+                    events_dropped.inc()
+                    return False
+
+        # Neither the new event nor the oldest one can be lost
+        if policy == DISCONNECT or self._get_policy(self.queue[0]) == DISCONNECT:
+            log.warning('Event queue full. Disconnecting the stream')
+            self.disconnect()
+            return False
+
+        self.queue.popleft()
+        self._times.popleft()
+        events_dropped.inc()
+        return True
+
+    def _put(self, item):
+        super()._put(item)
+        self._times.append(time.monotonic())
+
+    def _get(self):
+        item = super()._get()
+        self._times.popleft()
+        return item
+
+
 class EventStream(BaseResource):
     """A stream of events from this server to the application.
 
@@ -76,6 +242,11 @@ class EventStream(BaseResource):
 
     Note that there should be only one client connected at a time. If more than one are connected,
     all of them will receive all events
+
+    When the server runs with more than one worker, the stream of a station is held by just one of
+    them. Events and replies for stations connected to other workers are sent through the
+    :mod:`eventbus <stoqserver.lib.eventbus>`, which is also how other processes (e.g. plugin
+    tasks) send events, by calling its ``publish_event``.
     """
 
     # Some queues that messages will be added to and latter be sent to the connected stations in the
@@ -88,6 +259,12 @@ class EventStream(BaseResource):
     # Indicates if there is a payment process waiting for a reply from a station.
     _waiting_reply = {}  # type: Dict[str, Event]
 
+    # The last events of each station, to be sent again when it reconnects after missing them
+    _history = {}  # type: Dict[str, collections.deque]
+    # The sequence number of the last event removed from the history of each station
+    _evicted_seq = {}  # type: Dict[str, int]
+    _event_seqs = itertools.count(1)
+
     routes = ['/stream']
 
     @classmethod
@@ -99,13 +276,30 @@ class EventStream(BaseResource):
         if station:
             if station.is_api:
                 return
-            if not station.id in cls._streams:
+            if station.id in cls._streams:
+                return cls._put_event(station.id, data)
+            # The station might be connected to another worker
+            if not eventbus.has_peers():
                 raise EventStreamUnconnectedStation
+            return eventbus.publish_event(data, station_id=station.id)
 
-            return cls._streams[station.id].put(data)
+        cls.add_local_event(data)
+        if eventbus.has_peers():
+            eventbus.publish_event(data)
+
+    @classmethod
+    def add_local_event(cls, data):
+        """Put an event in all the streams connected to this process only
+
+        This is for events that every worker produces by itself, like the database changes.
+        """
+        for station_id in list(cls._streams):
+            cls._put_event(station_id, data)
 
-        for stream in cls._streams.values():
-            stream.put(data)
+    @classmethod
+    def has_streams(cls):
+        """If any station is connected to this process"""
+        return bool(cls._streams)
 
     @classmethod
     def ask_question(cls, station, question):
@@ -117,9 +311,12 @@ class EventStream(BaseResource):
         }, station=station)
 
         log.info('Waiting tef reply')
-        cls._waiting_reply[station.id].set()
-        reply = cls._replies[station.id].get()
-        cls._waiting_reply[station.id].clear()
+        # The stream might be connected to another worker, which would not have created those
+        replies = cls._replies.setdefault(station.id, Queue(maxsize=1))
+        waiting_reply = cls._waiting_reply.setdefault(station.id, Event())
+        waiting_reply.set()
+        reply = replies.get()
+        waiting_reply.clear()
         log.info('Got tef reply: %s', reply)
         return reply
 
@@ -127,11 +324,77 @@ class EventStream(BaseResource):
     def add_event_reply(cls, station_id, reply):
         """Puts a reply from the frontend"""
         log.info('Got reply from %s: %s', station_id, reply)
+        waiting_reply = cls._waiting_reply.get(station_id)
+        # The question might have been asked by another worker
+        if (waiting_reply is None or not waiting_reply.is_set()) and eventbus.has_peers():
+            return eventbus.publish('event_reply', {'station_id': station_id, 'reply': reply})
+
         assert cls._replies[station_id].empty()
         assert cls._waiting_reply[station_id].is_set()
 
         return cls._replies[station_id].put(reply)
 
+    @classmethod
+    def _put_event(cls, station_id, data):
+        if isinstance(data, dict):
+            data = StreamEvent(data, next(cls._event_seqs))
+            history = cls._history.setdefault(station_id,
+                                              collections.deque(maxlen=REPLAY_BUFFER_SIZE))
+            if len(history) == history.maxlen:
+                cls._evicted_seq[station_id] = history[0].seq
+            history.append(data)
+        cls._streams[station_id].put(data)
+
+    @classmethod
+    def _get_missed_events(cls, station_id, last_event_id):
+        """Get the events sent after *last_event_id*, or ``None`` if some of them were lost"""
+        last_seq = parse_event_id(last_event_id)
+        history = cls._history.get(station_id)
+        if last_seq is None or history is None:
+            return None
+
+        # Some events after the last one were already removed from the history
+        if last_seq < cls._evicted_seq.get(station_id, 0):
+            return None
+        return [event for event in history
+                if event.seq > last_seq and event.get('type') not in NOT_REPLAYED]
+
+    @classmethod
+    def _break_waiting_reply(cls, station_id):
+        waiting_reply = cls._waiting_reply.get(station_id)
+        if waiting_reply is not None and waiting_reply.is_set():
+            # There is a new stream for this station, but we were currently waiting for a reply from
+            # the same station in the previous event stream. Put an invalid reply there, and clear
+            # the flag so that the station can continue working
+            cls._replies[station_id].put(EventStreamBrokenException)
+            waiting_reply.clear()
+
+    @classmethod
+    def _on_bus_event(cls, message):
+        station_id = message['station_id']
+        if station_id is None:
+            for station_id in list(cls._streams):
+                cls._put_event(station_id, message['data'])
+        elif station_id in cls._streams:
+            cls._put_event(station_id, message['data'])
+
+    @classmethod
+    def _on_bus_event_reply(cls, message):
+        station_id = message['station_id']
+        waiting_reply = cls._waiting_reply.get(station_id)
+        if waiting_reply is None or not waiting_reply.is_set():
+            return
+        if cls._replies[station_id].empty():
+            cls._replies[station_id].put(message['reply'])
+
+    @classmethod
+    def _on_bus_stream_established(cls, message):
+        # The station connected to another worker, so the stream we have is not used anymore
+        station_id = message['station_id']
+        if cls._streams.pop(station_id, None) is not None:
+            log.info('Station %s connected to another worker', station_id)
+        cls._break_waiting_reply(station_id)
+
     @classmethod
     def _get_event_for_device(cls, device_type: DeviceType, device_status: bool):
         if device_type == DeviceType.DRAWER:
@@ -156,23 +419,61 @@ class EventStream(BaseResource):
         with suppress(EventStreamUnconnectedStation):
             cls.add_event(event, station=station)
 
+    @classmethod
+    def _coalesce(cls, events):
+        """Drop the events superseded by a later one, keeping the order of the others"""
+        seen = set()
+        coalesced = []
+        for data in reversed(events):
+            key = get_coalesce_key(data)
+            if key is not None:
+                if key in seen:
+                    events_superseded.inc()
+                    continue
+                seen.add(key)
+            coalesced.append(data)
+        coalesced.reverse()
+        return coalesced
+
+    @classmethod
+    def _format_event(cls, data):
+        message = "data: " + json.dumps(data, cls=JsonEncoder) + "\n\n"
+        if isinstance(data, StreamEvent):
+            # The browser sends the last one back in the Last-Event-ID header when reconnecting
+            message = "id: " + data.event_id + "\n" + message
+        return message
+
     def _loop(self, stream: Queue, station_id):
         while True:
             try:
-                data = stream.get(timeout=10)
+                events = [stream.get(timeout=HEARTBEAT_INTERVAL)]
             except Empty:
-                if self._streams[station_id] != stream:
+                if self._streams.get(station_id) != stream:
                     log.info('Stream for station %s changed. Closing old stream', station_id)
                     break
 
                 yield "data: null\n\n"
                 continue
 
-            yield "data: " + json.dumps(data, cls=JsonEncoder) + "\n\n"
+            # Events usually come in bursts (e.g. TEF and NFe progress messages). Wait a little
+            # for the rest of it to send everything in a single write
+            gevent.sleep(COALESCE_WINDOW)
+            while True:
+                try:
+                    events.append(stream.get_nowait())
+                except Empty:
+                    break
+
+            if _CLOSE_STREAM in events:
+                log.warning('Event queue for station %s overflowed. Closing stream', station_id)
+                break
+
+            yield ''.join(self._format_event(data) for data in self._coalesce(events))
         log.info('Closed event stream for %s', station_id)
 
     def get(self):
-        stream = Queue()
+        max_queue_size = get_config().get('General', 'eventstream_max_queue_size')
+        stream = EventQueue(int(max_queue_size or DEFAULT_MAX_QUEUE_SIZE))
         station = self.get_current_station(api.get_default_store(), token=request.args['token'])
         log.info('Estabilished event stream for %s', station.id)
         self._streams[station.id] = stream
@@ -181,16 +482,23 @@ class EventStream(BaseResource):
         self._replies.setdefault(station.id, Queue(maxsize=1))
         self._waiting_reply.setdefault(station.id, Event())
 
-        if self._waiting_reply[station.id].is_set():
-            # There is a new stream for this station, but we were currently waiting for a reply from
-            # the same station in the previous event stream. Put an invalid reply there, and clear
-            # the flag so that the station can continue working
-            self._replies[station.id].put(EventStreamBrokenException)
-            self._waiting_reply[station.id].clear()
+        self._break_waiting_reply(station.id)
+        if eventbus.has_peers():
+            eventbus.publish('stream_established', {'station_id': station.id})
 
         # If we dont put one event, the event stream does not seem to get stabilished in the browser
         stream.put(json.dumps({}))
 
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        missed = self._get_missed_events(station.id, last_event_id) if last_event_id else None
+        if missed is not None:
+            log.info('Resuming event stream for %s with %s missed events', station.id,
+                     len(missed))
+            for event in missed:
+                stream.put(event)
+            # Tell the station that it doesn't need to fetch everything again
+            self._put_event(station.id, {'type': 'EVENT_STREAM_RESUMED', 'missed': len(missed)})
+
         EventStreamEstablishedEvent.send(station)
 
         # This is the best time to check if there are pending transactions, since the frontend just
@@ -202,7 +510,14 @@ class EventStream(BaseResource):
                                                ' Favor reter o Cupom.')},
                                   station=station)
             EventStream.add_event({'type': 'CLEAR_SALE'}, station=station)
-        return Response(self._loop(stream, station.id), mimetype="text/event-stream")
+        events = self._loop(stream, station.id)
+        if not is_gzip_requested(request):
+            return Response(events, mimetype="text/event-stream")
+
+        response = Response(iter_gzip(events), mimetype="text/event-stream")
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
 
     def post(self):
         station_id = request.values.get('station_id')
@@ -229,3 +544,16 @@ class EventStream(BaseResource):
             return make_response('event put in stream from station %s' % station_id, 200)
         except EventStreamUnconnectedStation as err:
             return make_response(str(err), 400)
+
+
+eventbus.subscribe('event', EventStream._on_bus_event)
+eventbus.subscribe('event_reply', EventStream._on_bus_event_reply)
+eventbus.subscribe('stream_established', EventStream._on_bus_stream_established)
+
+registry.gauge('eventstream_queue_depth', 'Events waiting to be sent to each station',
+               func=lambda: {station_id: stream.qsize()
+                             for station_id, stream in EventStream._streams.items()})
+registry.gauge('eventstream_lag_seconds', 'How long the oldest event of each station is waiting',
+               func=lambda: {station_id: stream.lag
+                             for station_id, stream in EventStream._streams.items()
+                             if isinstance(stream, EventQueue)})
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Idempotent submission of sales
+
+The stations send the id of the sale they are submitting and retry when they don't get an answer.
+The response of each submission is saved by the same transaction that saves the sale, so a retry
+is answered with it right away, without doing anything else. A retry with a different payload for
+the same id is refused.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+
+import gevent
+from flask import abort
+from stoqlib.api import api
+
+from ..utils import JsonEncoder
+from .metrics import registry
+from .schema import register_table
+
+log = logging.getLogger(__name__)
+
+# In days. The stations don't retry for longer than that
+SUBMISSION_MAX_AGE = 7
+# In seconds. How often the submissions older than SUBMISSION_MAX_AGE are removed
+CLEANUP_INTERVAL = 60 * 60
+# How the submission is answered, which a retry can change without submitting something else, like
+# not printing the receipts again after the printer failed
+RETRY_OPTIONS = ('print_receipts', 'postpone_emission')
+
+_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS stoqserver_submission (
+        kind text NOT NULL,
+        id text NOT NULL,
+        request_hash text NOT NULL,
+        options text NOT NULL,
+        status_code integer NOT NULL,
+        response text NOT NULL,
+        created_at timestamp NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (kind, id));
+    CREATE INDEX IF NOT EXISTS stoqserver_submission_created_at_idx
+        ON stoqserver_submission (created_at)
+"""
+register_table(_CREATE_TABLE)
+
+replayed = registry.counter('submissions_replayed',
+                            'Retried submissions answered with the saved response')
+conflicts = registry.counter('submissions_conflicts',
+                             'Submissions refused for reusing an id with a different payload')
+
+
+def get_request_hash(data):
+    """Get the hash of what *data* submits, leaving out the :data:`RETRY_OPTIONS`"""
+    data = {k: v for k, v in data.items() if k not in RETRY_OPTIONS}
+    return hashlib.sha256(json.dumps(data, sort_keys=True, cls=JsonEncoder).encode()).hexdigest()
+
+
+def get_request_options(data):
+    return json.dumps({k: data[k] for k in RETRY_OPTIONS if k in data}, sort_keys=True)
+
+
+class SubmissionIndex:
+    def get(self, store, kind, obj_id):
+        """Get the request hash, the options, the status code and the response of a submission
+
+        :returns: a tuple with them, or ``None`` if it was not submitted
+        """
+        row = store.execute("SELECT request_hash, options, status_code, response "
+                            "  FROM stoqserver_submission "
+                            " WHERE kind = ? AND id = ?", (kind, obj_id)).get_one()
+        if row is None:
+            return None
+        request_hash, options, status_code, response = row
+        return request_hash, options, status_code, json.loads(response)
+
+    def add(self, store, kind, obj_id, request_hash, options, status_code, response):
+        store.execute("INSERT INTO stoqserver_submission "
+                      "(kind, id, request_hash, options, status_code, response) "
+                      "VALUES (?, ?, ?, ?, ?, ?)",
+                      (kind, obj_id, request_hash, options, status_code,
+                       json.dumps(response, cls=JsonEncoder)))
+
+    def remove_old(self, store):
+        """Remove the submissions older than :data:`SUBMISSION_MAX_AGE`"""
+        store.execute("DELETE FROM stoqserver_submission "
+                      " WHERE created_at < NOW() - ? * INTERVAL '1 day'", (SUBMISSION_MAX_AGE, ))
+
+
+submission_index = SubmissionIndex()
+
+
+def cleanup_loop():
+    """Remove the old submissions every :data:`CLEANUP_INTERVAL`, forever"""
+    while True:
+        try:
+            with api.new_store() as store:
+                submission_index.remove_old(store)
+        except Exception:
+            log.exception('Failed to remove the old submissions')
+        gevent.sleep(CLEANUP_INTERVAL)
+
+
+def submit(store, kind, data, func):
+    """Call *func* to submit the object of *data*, unless it was already submitted
+
+    The object id is the ``sale_id`` of *data*. The response returned by *func* is saved in
+    *store*, so it is only kept if *store* is committed.
+
+    A retry that only changes the :data:`RETRY_OPTIONS` is not answered with the saved response,
+    which was for other options. *func* is called again instead, and must find out by itself that
+    the object was already saved.
+
+    :returns: what *func* returned, or the saved response if the object was already submitted
+    """
+    obj_id = data.get('sale_id')
+    if not obj_id:
+        return func()
+
+    request_hash = get_request_hash(data)
+    options = get_request_options(data)
+    submission = submission_index.get(store, kind, obj_id)
+    if submission is not None:
+        saved_hash, saved_options, status_code, response = submission
+        if saved_hash != request_hash:
+            conflicts.inc()
+            log.warning('Refusing %s %s submitted again with a different payload', kind, obj_id)
+            abort(409, '{} {} was already submitted with different data'.format(
+                kind.capitalize(), obj_id))
+        if saved_options != options:
+            log.info('%s %s already submitted with other options', kind, obj_id)
+            return func()
+        replayed.inc()
+        log.info('%s %s already submitted. Sending the same response', kind, obj_id)
+        return response, status_code
+
+    retval = func()
+    response, status_code = retval if isinstance(retval, tuple) else (retval, 200)
+    submission_index.add(store, kind, obj_id, request_hash, options, status_code, response)
+    return retval
+
+
+def idempotent(kind):
+    """Make a resource method that submits an object idempotent, using :func:`submit`
+
+    The decorated method must be called with the request store.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, store, *args, **kwargs):
+            return submit(store, kind, self.get_json(),
+                          lambda: func(self, store, *args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Persistent queues of jobs done in the background
+
+What doesn't need to be done before answering a request, like printing, can be added to a
+:class:`JobQueue` and is done in the background by :meth:`JobQueue.run`, which every server
+process runs, whatever its mode. The jobs are saved in the database by the same transaction that
+creates them, so they are only done if it is committed, and they survive restarts. Each job is
+claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` by the process that does it, so processes
+sharing the database never do the same job twice.
+
+The jobs need the devices of their station, so a server running for a single station only does
+the jobs of that station, and says so in ``stoqserver_station_server``. The multiclient servers
+only do the jobs of the stations without a server of their own, or whose server stopped.
+
+The station is told about the progress of each job with events on its stream.
+"""
+
+import collections
+import json
+import logging
+
+from flask import after_this_request, has_request_context
+from gevent.event import Event
+from stoqlib.api import api
+from stoqlib.domain.station import BranchStation
+
+from ..utils import JsonEncoder
+from .eventstream import EventStream, EventStreamUnconnectedStation
+from .metrics import registry
+from .schema import register_table
+
+log = logging.getLogger(__name__)
+
+# Attempts before a job is given up
+DEFAULT_MAX_ATTEMPTS = 5
+# In seconds. The wait before each retry is this multiplied by the attempts already made
+RETRY_INTERVAL = 10
+# In seconds. The queue is also checked when jobs are added by this process
+POLL_INTERVAL = 5
+# In seconds. A job claimed for longer than that was being done by a process that died
+CLAIM_TIMEOUT = 30 * 60
+# In seconds. The jobs of a station whose server wasn't seen for longer than that are done by the
+# multiclient servers
+SERVER_TIMEOUT = 12 * POLL_INTERVAL
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id bigserial PRIMARY KEY,
+        station_id text NOT NULL,
+        kind text NOT NULL,
+        args text NOT NULL,
+        status text NOT NULL DEFAULT 'pending',
+        attempts integer NOT NULL DEFAULT 0,
+        error text,
+        next_attempt_at timestamp NOT NULL DEFAULT NOW(),
+        claimed_at timestamp,
+        created_at timestamp NOT NULL DEFAULT NOW());
+    CREATE INDEX IF NOT EXISTS {table}_status_idx ON {table} (status, id)
+"""
+
+_CREATE_SERVERS_TABLE = """
+    CREATE TABLE IF NOT EXISTS stoqserver_station_server (
+        station_id text PRIMARY KEY,
+        seen_at timestamp NOT NULL DEFAULT NOW())
+"""
+register_table(_CREATE_SERVERS_TABLE)
+
+Job = collections.namedtuple('Job', ['id', 'station_id', 'kind', 'args', 'attempts'])
+
+
+class JobCancelled(Exception):
+    """Raised by the handlers when trying the job again would not help"""
+
+
+class JobQueue:
+    """A persistent queue of jobs of the stations
+
+    :param name: used to name the table and the metrics of the queue
+    :param event_type: the type of the events telling the station about the jobs
+    :param decorators: applied to the handlers, to acquire the locks of the devices they need
+    :param ordered: if the jobs of a station must be done in the order they were added. A job
+        being retried holds the ones after it until it is done or given up
+    """
+
+    def __init__(self, name, event_type, decorators=(), ordered=False,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.name = name
+        self.table = 'stoqserver_{}_job'.format(name)
+        self.event_type = event_type
+        self.ordered = ordered
+        self.max_attempts = max_attempts
+        # The functions that do each kind of job
+        self.handlers = {}
+        self._decorators = decorators
+        self._wakeup = Event()
+        register_table(_CREATE_TABLE.format(table=self.table))
+
+        self.jobs_added = registry.counter('{}_queue_added'.format(name),
+                                           'Jobs added to the {} queue'.format(name))
+        self.jobs_done = registry.counter('{}_queue_done'.format(name),
+                                          'Jobs of the {} queue done'.format(name))
+        self.jobs_retried = registry.counter(
+            '{}_queue_retried'.format(name),
+            'Jobs of the {} queue that failed and will be retried'.format(name))
+        self.jobs_failed = registry.counter(
+            '{}_queue_failed'.format(name),
+            'Jobs of the {} queue given up'.format(name))
+        self.job_time = registry.histogram(
+            '{}_queue_job_seconds'.format(name),
+            'How long each job of the {} queue took, including its locks'.format(name))
+
+    def handler(self, kind):
+        """Register the decorated function as the one that does the jobs of *kind*
+
+        It is called with a store, the station of the job and the arguments the job was added
+        with.
+        """
+        def decorator(func):
+            wrapped = func
+            for lock_decorator in reversed(self._decorators):
+                wrapped = lock_decorator(wrapped)
+            self.handlers[kind] = wrapped
+            return func
+        return decorator
+
+    def add(self, store, station, kind, **kwargs):
+        """Add a job, that will be done after *store* is committed
+
+        *kwargs* must be serializable by :class:`stoqserver.utils.JsonEncoder`.
+
+        :returns: the id of the job
+        """
+        assert kind in self.handlers, kind
+        args = json.dumps(kwargs, cls=JsonEncoder)
+        job_id = store.execute(
+            "INSERT INTO {} (station_id, kind, args) VALUES (?, ?, ?) "
+            "RETURNING id".format(self.table), (str(station.id), kind, args)).get_one()[0]
+        self.jobs_added.inc()
+
+        if has_request_context():
+            # The request store is only committed after the response is ready
+            @after_this_request
+            def wakeup(response):
+                self._wakeup.set()
+                return response
+        else:
+            self._wakeup.set()
+        return job_id
+
+    def get_next_job(self, store, station=None):
+        """Claim the job that should be done now, or get ``None``
+
+        The claim is only seen by the other processes after *store* is committed.
+
+        :param station: the station whose jobs are claimed. If ``None``, the jobs of the
+            stations without a server of their own are
+        """
+        query = ("SELECT id, station_id, kind, args, attempts FROM {table} AS job "
+                 " WHERE ((status = ? AND next_attempt_at <= NOW()) OR "
+                 "        (status = ? AND claimed_at < NOW() - ? * INTERVAL '1 second')) ")
+        params = (PENDING, RUNNING, CLAIM_TIMEOUT)
+        if station is not None:
+            query += " AND station_id = ? "
+            params += (str(station.id), )
+        else:
+            query += (" AND station_id NOT IN ("
+                      "     SELECT station_id FROM stoqserver_station_server "
+                      "      WHERE seen_at > NOW() - ? * INTERVAL '1 second') ")
+            params += (SERVER_TIMEOUT, )
+        if self.ordered:
+            # A job being retried holds the ones after it
+            query += (" AND NOT EXISTS (SELECT 1 FROM {table} AS previous "
+                      "                  WHERE previous.station_id = job.station_id "
+                      "                    AND previous.id < job.id "
+                      "                    AND previous.status IN (?, ?)) ")
+            params += (PENDING, RUNNING)
+        query += " ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"
+        row = store.execute(query.format(table=self.table), params).get_one()
+        if row is None:
+            return None
+
+        job_id, station_id, kind, args, attempts = row
+        store.execute("UPDATE {} SET status = ?, claimed_at = NOW() WHERE id = ?".format(
+            self.table), (RUNNING, job_id))
+        return Job(job_id, station_id, kind, json.loads(args), attempts)
+
+    def run(self, station=None):
+        """Do the jobs forever
+
+        :param station: the station this server runs for, or ``None`` in multiclient mode. See
+            :meth:`get_next_job`
+        """
+        while True:
+            try:
+                if station is not None:
+                    self._register_server(station)
+                self.process_pending(station)
+            except Exception:
+                log.exception('Failed to process the %s queue', self.name)
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+
+    def process_pending(self, station=None):
+        """Do all the jobs that should be done now"""
+        while True:
+            with api.new_store() as store:
+                job = self.get_next_job(store, station)
+            if job is None:
+                return
+            self.do_job(job)
+
+    def do_job(self, job):
+        try:
+            with self.job_time.time():
+                self._run_handler(job)
+        except Exception as e:
+            log.exception('Failed to do job %s (%s) of the %s queue', job.id, job.kind, self.name)
+            attempts = job.attempts + 1
+            if attempts >= self.max_attempts or isinstance(e, JobCancelled):
+                status = FAILED
+                self.jobs_failed.inc()
+            else:
+                status = PENDING
+                self.jobs_retried.inc()
+            with api.new_store() as store:
+                store.execute(
+                    "UPDATE {} "
+                    "   SET attempts = ?, status = ?, error = ?, "
+                    "       next_attempt_at = NOW() + ? * INTERVAL '1 second' "
+                    " WHERE id = ?".format(self.table),
+                    (attempts, status, str(e), attempts * RETRY_INTERVAL, job.id))
+            self._notify(job, status, error=str(e))
+            return
+
+        with api.new_store() as store:
+            store.execute("DELETE FROM {} WHERE id = ?".format(self.table), (job.id, ))
+        self.jobs_done.inc()
+        self._notify(job, DONE)
+
+    def _run_handler(self, job):
+        with api.new_store() as store:
+            try:
+                station = store.get(BranchStation, job.station_id)
+                self.handlers[job.kind](store, station, **job.args)
+            except Exception:
+                store.retval = False
+                raise
+
+    def _register_server(self, station):
+        # Tell the multiclient servers to leave the jobs of the station to this one
+        with api.new_store() as store:
+            store.execute(
+                "INSERT INTO stoqserver_station_server (station_id) VALUES (?) "
+                "ON CONFLICT (station_id) DO UPDATE SET seen_at = NOW()", (str(station.id), ))
+
+    def _notify(self, job, status, error=None):
+        with api.new_store() as store:
+            station = store.get(BranchStation, job.station_id)
+            try:
+                EventStream.add_event({
+                    'type': self.event_type,
+                    'job_id': job.id,
+                    'kind': job.kind,
+                    'args': job.args,
+                    'status': status,
+                    'attempts': job.attempts + (status != DONE),
+                    'error': error,
+                }, station=station)
+            except EventStreamUnconnectedStation:
+                pass
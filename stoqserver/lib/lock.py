@@ -22,15 +22,168 @@
 # Author(s): Stoq Team <stoq-devel@async.com.br>
 #
 
+import heapq
+import itertools
 import logging
+import time
 
-from gevent.lock import Semaphore
+import gevent
+from flask import has_request_context, request
+from gevent.event import Event
 
 from stoqserver.app import is_multiclient
 
+from .metrics import registry
+
 log = logging.getLogger(__name__)
 
-printer_lock = Semaphore()
+# The priorities of the lock requests. Customer facing operations should not wait behind the
+# background checks of the devices
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+# All the device locks, by name
+locks = {}
+
+
+def _get_holder(func, priority):
+    route = None
+    if has_request_context():
+        route = '{} {}'.format(request.method, request.path)
+    return {
+        'function': func and func.__qualname__,
+        'route': route,
+        'greenlet': id(gevent.getcurrent()),
+        'priority': priority,
+    }
+
+
+class InstrumentedLock:
+    """A lock that serves its waiters by priority and keeps track of who holds it
+
+    This is what serializes the access to each device, so its metrics show how much the requests
+    are waiting for the devices. When the lock is released it is handed over to the waiter with
+    the highest priority, or to the oldest one among those with the same priority.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.holder = None
+        self._locked = False
+        self._acquired_at = None
+        # Heap of [priority, sequence, event] of the greenlets waiting for the lock
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._free = Event()
+        self._free.set()
+        self.wait_time = registry.histogram('lock_{}_wait_seconds'.format(name),
+                                            'Time waited for the {} lock'.format(name))
+        self.hold_time = registry.histogram('lock_{}_hold_seconds'.format(name),
+                                            'Time the {} lock was held'.format(name))
+        self.contended = registry.counter(
+            'lock_{}_contended'.format(name),
+            'Times the {} lock was already held when requested'.format(name))
+        registry.gauge('lock_{}_waiting'.format(name),
+                       'Greenlets waiting for the {} lock'.format(name),
+                       func=lambda: self.waiting)
+        locks[name] = self
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def locked(self):
+        return self._locked
+
+    def wait(self, timeout=None):
+        """Wait until the lock is free, without acquiring it"""
+        return self._free.wait(timeout)
+
+    def acquire(self, blocking=True, timeout=None, func=None, priority=NORMAL):
+        """Acquire the lock
+
+        :param func: the function that will hold the lock, to be shown in :meth:`dump`
+        :param priority: one of HIGH, NORMAL or LOW
+        """
+        if self._locked:
+            self.contended.inc()
+
+        start = time.monotonic()
+        acquired = self._acquire(blocking, timeout, priority)
+
+        now = time.monotonic()
+        self.wait_time.observe(now - start)
+        if acquired:
+            self._acquired_at = now
+            self.holder = _get_holder(func, priority)
+        return acquired
+
+    def _acquire(self, blocking, timeout, priority):
+        if not self._locked:
+            self._locked = True
+            self._free.clear()
+            return True
+        if not blocking:
+            return False
+
+        entry = [priority, next(self._sequence), Event()]
+        heapq.heappush(self._waiters, entry)
+        try:
+            entry[2].wait(timeout)
+        except BaseException:
+            # We might have been killed right after the lock was handed over to us
+            if entry[2].is_set():
+                self._release()
+            else:
+                self._remove_waiter(entry)
+            raise
+
+        if entry[2].is_set():
+            return True
+        self._remove_waiter(entry)
+        return False
+
+    def _remove_waiter(self, entry):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+
+    def release(self):
+        if self._acquired_at is not None:
+            self.hold_time.observe(time.monotonic() - self._acquired_at)
+        self._acquired_at = None
+        self.holder = None
+        self._release()
+
+    def _release(self):
+        if self._waiters:
+            # The lock stays locked, now for the next waiter
+            heapq.heappop(self._waiters)[2].set()
+        else:
+            self._locked = False
+            self._free.set()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def dump(self):
+        held_for = None
+        if self._acquired_at is not None:
+            held_for = time.monotonic() - self._acquired_at
+        return {
+            'locked': self.locked(),
+            'holder': self.holder,
+            'held_for': held_for,
+            'waiting': self.waiting,
+            'waiting_priorities': sorted(entry[0] for entry in self._waiters),
+        }
+
+
+printer_lock = InstrumentedLock('printer')
 
 
 class LockFailedException(Exception):
@@ -41,20 +194,30 @@ class base_lock_decorator:
     """Decorator to handle pinpad access locking.
 
     This will make sure that only one callsite is using the sat at a time.
+
+    :param block: if we should wait for the lock. LockFailedException is raised when we don't
+        get it
+    :param timeout: for how long to wait for the lock, in seconds
+    :param priority: one of HIGH, NORMAL or LOW
     """
     lock = None
 
-    def __init__(self, block):
+    def __init__(self, block, timeout=None, priority=NORMAL):
         assert self.lock is not None
         self._block = block
+        self._timeout = timeout
+        self._priority = priority
 
     def __call__(self, func):
 
         def new_func(*args, **kwargs):
             if not is_multiclient:
+                if self.lock.locked() and self._block:
+                    log.info('Waiting %s lock release in func %s', self.lock.name, func)
                 # Only acquire the lock if running in single client mode. Multi client mode cannot
                 # have any locks in the requests
-                acquired = self.lock.acquire(blocking=self._block)
+                acquired = self.lock.acquire(blocking=self._block, timeout=self._timeout,
+                                             func=func, priority=self._priority)
                 if not acquired:
                     log.info('Failed %s in func %s', type(self).__name__, func)
                     raise LockFailedException()
@@ -68,30 +231,25 @@ class base_lock_decorator:
 
 
 class lock_pinpad(base_lock_decorator):
-    lock = Semaphore()
+    lock = InstrumentedLock('pinpad')
 
 
 class lock_sat(base_lock_decorator):
-    lock = Semaphore()
+    lock = InstrumentedLock('sat')
 
 
-def lock_printer(func):
-    """Decorator to handle printer access locking.
-
-    This will make sure that only one callsite is using the printer at a time.
-    """
-    def new_func(*args, **kwargs):
+class _lock_printer(base_lock_decorator):
+    lock = printer_lock
 
-        if not is_multiclient:
-            if printer_lock.locked():
-                log.info('Waiting printer lock release in func %s', func)
-            # Only acquire the lock if running in single client mode. Multi client mode cannot
-            # have any locks in the requests
-            printer_lock.acquire()
 
-        try:
-            return func(*args, **kwargs)
-        finally:
-            printer_lock.release()
+def lock_printer(func=None, *, block=True, timeout=None, priority=NORMAL):
+    """Decorator to handle printer access locking.
 
-    return new_func
+    This will make sure that only one callsite is using the printer at a time. It can be used
+    directly or with the arguments of :class:`base_lock_decorator`, like
+    ``@lock_printer(priority=HIGH)``.
+    """
+    decorator = _lock_printer(block, timeout=timeout, priority=priority)
+    if func is None:
+        return decorator
+    return decorator(func)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""Simple in-process metrics
+
+The metrics are kept in the memory of the process that collects them and are exposed by the
+``/metrics`` resource.
+"""
+
+import bisect
+import contextlib
+import time
+
+# Upper bounds, in seconds, of the buckets of the histograms
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dump(self):
+        return {'type': 'counter', 'description': self.description, 'value': self.value}
+
+
+class Gauge:
+    """A value that can go up and down
+
+    :param func: if given, it is called to get the value when the gauge is dumped
+    """
+
+    def __init__(self, name, description, func=None):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def dump(self):
+        value = self._func() if self._func else self.value
+        return {'type': 'gauge', 'description': self.description, 'value': value}
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        # The last one is for the values bigger than all the buckets
+        self._counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        """Observe how long the with block took to run"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+    def dump(self):
+        # Cumulative counts, like prometheus does
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self._counts):
+            total += count
+            buckets[str(bound)] = total
+
+        return {'type': 'histogram', 'description': self.description, 'count': self.count,
+                'sum': self.sum, 'max': self.max, 'buckets': buckets}
+
+
+class MetricsRegistry:
+    """All the metrics of the process, by name"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _get_or_create(self, klass, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = klass(name, *args, **kwargs)
+        assert isinstance(metric, klass), (name, metric)
+        return metric
+
+    def counter(self, name, description):
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name, description, func=None):
+        return self._get_or_create(Gauge, name, description, func=func)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, description, buckets=buckets)
+
+    def dump(self):
+        return {name: metric.dump() for name, metric in sorted(self._metrics.items())}
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""The queue of the print jobs
+
+Printing is slow and the printer does one thing at a time, so what doesn't need to be printed
+before answering a request is added to this queue and printed in the background by the server,
+holding the printer lock. The station is told about each job with ``PRINT_JOB_STATUS`` events.
+"""
+
+import logging
+
+from stoqlib.domain.sale import Sale
+
+from ..signals import PrintKitchenCouponEvent
+from .jobqueue import JobCancelled, JobQueue
+from .lock import lock_printer
+
+log = logging.getLogger(__name__)
+
+print_queue = JobQueue('print', 'PRINT_JOB_STATUS', decorators=[lock_printer])
+
+
+@print_queue.handler('kitchen_coupon')
+def _print_kitchen_coupon(store, station, sale_id, order_number):
+    sale = store.get(Sale, sale_id)
+    if sale.station != station:
+        raise JobCancelled('Sale {} is not from station {}'.format(sale_id, station.id))
+    log.info('emitting event PrintKitchenCouponEvent {}'.format(order_number))
+    PrintKitchenCouponEvent.send(sale, order_number=order_number)
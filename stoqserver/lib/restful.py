@@ -27,10 +27,9 @@ import decimal
 import functools
 import json
 import logging
-import psycopg2
 import io
-import select
 import requests
+from contextlib import suppress
 from typing import Dict, Optional
 
 import gevent
@@ -70,18 +69,35 @@ from stoqlib.lib.translation import dgettext
 from stoqlib.lib.pluginmanager import get_plugin_manager
 from stoqlib.lib.validators import validate_cpf
 from storm.expr import Desc, LeftJoin, Join, And, Eq, Ne, Coalesce
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import quote_etag
 
 from stoqserver.app import is_multiclient
+from stoqserver.lib.auth import revoke_token
 from stoqserver.lib.baseresource import BaseResource
-from stoqserver.lib.eventstream import EventStream, EventStreamBrokenException
+from stoqserver.lib.catalog import (CACHE_TABLES, CatalogSnapshot, SaleSellableLoader,
+                                    SellableDataLoader, can_send_delta, catalog_cache,
+                                    format_version, get_catalog_version,
+                                    get_changed_category_ids, get_changed_sellable_ids,
+                                    get_ids_for_changes, get_te_signature, parse_version)
+from stoqserver.lib.changes import change_listener
+from stoqserver.lib.devicehealth import DEFAULT_MAX_AGE
+from stoqserver.lib.drawer import drawer_poller
+from stoqserver.lib.emissionqueue import emission_queue
+from stoqserver.lib.idempotency import idempotent, submit
+from stoqserver.lib.jobqueue import JobCancelled
+from stoqserver.lib.printqueue import print_queue
+from stoqserver.lib.eventstream import (EventStream, EventStreamBrokenException,
+                                        EventStreamUnconnectedStation)
 from .checks import check_drawer, check_pinpad, check_sat
 from .constants import PROVIDER_MAP
-from .lock import lock_pinpad, lock_printer, lock_sat, printer_lock, LockFailedException
+from .lock import HIGH, lock_pinpad, lock_printer, lock_sat, LockFailedException
 from ..api.decorators import login_required, store_provider
+from ..utils import is_stream_requested, make_json_stream_response, write_behind
 from ..signals import (GenerateAdvancePaymentReceiptPictureEvent,
                        GenerateInvoicePictureEvent, GenerateTillClosingReceiptImageEvent,
                        GrantLoyaltyPointsEvent, PrintAdvancePaymentReceiptEvent,
-                       PrintKitchenCouponEvent, FinishExternalOrderEvent,
+                       FinishExternalOrderEvent,
                        SearchForPassbookUsersByDocumentEvent, StartPassbookSaleEvent,
                        TefPrintReceiptsEvent, StartExternalOrderEvent,
                        CancelExternalOrderEvent, GenerateExternalOrderReceiptImageEvent,
@@ -89,6 +105,8 @@ from ..signals import (GenerateAdvancePaymentReceiptPictureEvent,
 
 from stoqserver.api.resources.sellable import SellableResource
 from stoqserver.api.resources.branch import BranchResource
+from stoqserver.api.resources.metrics import MetricsResource
+from stoqserver.api.resources.locks import LocksResource
 
 # This needs to be imported to workaround a storm limitation
 PurchaseOrder, PaymentRenegotiation
@@ -99,6 +117,8 @@ Dict
 # Resources
 SellableResource
 BranchResource
+MetricsResource
+LocksResource
 
 _ = functools.partial(dgettext, 'stoqserver')
 PDV_VERSION = None
@@ -175,37 +195,57 @@ class DataResource(BaseResource):
     routes = ['/data']
     method_decorators = [login_required, store_provider]
 
+    # How many sellables are read from the database at once when streaming the catalog
+    STREAM_PAGE_SIZE = 500
+
     # All the tables get_data uses (directly or indirectly)
     watch_tables = ['sellable', 'product', 'storable', 'product_stock_item', 'branch_station',
                     'branch', 'login_user', 'sellable_category', 'client_category_price',
-                    'payment_method', 'credit_provider']
+                    'payment_method', 'credit_provider', 'sellable_branch_override',
+                    'product_branch_override', 'image']
 
-    # Disabled @worker for now while testing gevent instead of threads
-    def _postgres_listen(station):
-        store = api.new_store()
-        conn = store._connection._raw_connection
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        cursor = store._connection.build_raw_cursor()
-        cursor.execute("LISTEN update_te;")
+    # The tables the station data depends on. The person and address tables are left out, since
+    # they are big and the station data only shows the names and the state of a few of them
+    station_tables = ['branch_station', 'branch', 'login_user', 'context', 'payment_method',
+                      'credit_provider', 'client_category', 'parameter_data']
+    # The config options the station data depends on
+    station_config = [('Twilio', 'sid'), ('Discounts', 'iti'), ('Hotjar', 'id'),
+                      ('Payments', 'credit_providers')]
 
-        message = False
-        while True:
-            if select.select([conn], [], [], 5) != ([], [], []):
-                conn.poll()
-                while conn.notifies:
-                    notify = conn.notifies.pop(0)
-                    te_id, table = notify.payload.split(',')
-                    # Update the data the client has when one of those changes
-                    message = message or table in DataResource.watch_tables
-
-            if message:
-                EventStream.add_event({
-                    'type': 'SERVER_UPDATE_DATA',
-                    'data': DataResource.get_data(store)
-                })
-                message = False
-
-    def _get_sellable_data(self, store, station):
+    # Above this many changed rows, the stations are told to fetch the whole catalog again instead
+    # of the changed sellables
+    MAX_CHANGED_ROWS = 500
+
+    @classmethod
+    def _on_database_changes(cls, changes):
+        # Nothing to tell when no station is connected, or when we don't know what changed
+        if not changes or not EventStream.has_streams():
+            return
+
+        tables = set(changes) & set(cls.watch_tables)
+        if not tables:
+            return
+
+        # The stations can ask for only what changed, instead of the whole /data
+        event = {
+            'type': 'DATA_CHANGED',
+            'tables': sorted(tables),
+            'sellables': None,
+            'categories': None,
+        }
+        if sum(len(changes[table]) for table in tables) <= cls.MAX_CHANGED_ROWS:
+            with api.new_store() as store:
+                sellable_ids, category_ids = get_ids_for_changes(store, changes)
+            event['sellables'] = sorted(sellable_ids)
+            event['categories'] = sorted(category_ids)
+
+        # Every worker listens to the changes, so this only needs to reach the local streams
+        EventStream.add_local_event(event)
+
+    def _is_auto_station(self, station):
+        return bool(station.type and station.type.name == 'auto')
+
+    def _get_sellable_data(self, store, station, *conditions):
         tables = [
             Sellable,
             Join(Product, Product.id == Sellable.id),
@@ -228,39 +268,43 @@ class DataResource(BaseResource):
 
         query = Eq(Coalesce(SellableBranchOverride.status, Sellable.status), "available")
         # XXX: This should be modified for accepting generic keywords
-        if station.type and station.type.name == 'auto':
+        if self._is_auto_station(station):
             query = And(query, Sellable.keywords.like('%auto%'))
 
-        return store.using(*tables).find((Sellable, Product, Storable, Image.id), query)
+        return store.using(*tables).find((Sellable, Product, Storable, Image.id),
+                                         And(query, *conditions))
 
-    def _dump_sellable(self, category_prices, sellable, branch, image_id):
+    def _dump_sellable(self, loader, category_prices, sellable, product, storable, image_id):
         return {
             'id': sellable.id,
             'code': sellable.code,
             'barcode': sellable.barcode,
             'description': sellable.description,
             'short_description': sellable.short_description,
-            'price': str(sellable.get_price(branch)),
-            'order': str(sellable.product.height),  # TODO: There is a sort_order now in the domain
-            'color': sellable.product.part_number,
+            'price': str(loader.get_price(sellable)),
+            'order': str(product.height),  # TODO: There is a sort_order now in the domain
+            'color': product.part_number,
             'category_prices': category_prices,
-            'requires_kitchen_production': sellable.get_requires_kitchen_production(branch),
+            'requires_kitchen_production': loader.get_requires_kitchen_production(sellable),
             'has_image': image_id is not None,
-            'availability': (
-                sellable.product and sellable.product.storable and
-                {
-                    si.branch.id: str(si.quantity)
-                    for si in sellable.product.storable.get_stock_items()
-                }
-            ),
+            'availability': loader.get_availability(storable),
         }
 
-    def _get_categories(self, store, station):
+    def _get_category_prices(self, store, sellable_ids=None):
         # Pre-create sellable category prices to avoid multiple queries inside the sellable loop
+        query = []
+        if sellable_ids is not None:
+            query.append(ClientCategoryPrice.sellable_id.is_in(sellable_ids))
+
         sellable_category_prices = {}
-        for item in store.find(ClientCategoryPrice):
+        for item in store.find(ClientCategoryPrice, *query):
             cat_prices = sellable_category_prices.setdefault(item.sellable_id, {})
             cat_prices[item.category_id] = str(item.price)
+        return sellable_category_prices
+
+    def _build_categories(self, store, station):
+        sellable_category_prices = self._get_category_prices(store)
+        loader = SellableDataLoader(store, station.branch)
 
         categories_dict = {}  # type: Dict[str, Dict]
         # Build list of products inside each category
@@ -269,7 +313,7 @@ class DataResource(BaseResource):
 
             categories_dict.setdefault(sellable.category_id, {'children': [], 'products': []})
             categories_dict[sellable.category_id]['products'].append(
-                self._dump_sellable(category_prices, sellable, station.branch, image))
+                self._dump_sellable(loader, category_prices, sellable, product, storable, image))
 
         # Build tree of categories
         for c in store.find(SellableCategory):
@@ -279,14 +323,127 @@ class DataResource(BaseResource):
             parent = categories_dict.setdefault(c.category_id, {'children': [], 'products': []})
             parent['children'].append(cat_dict)
 
+        # FIXME: Remove categories that have no products inside them
+        return categories_dict[None]['children']  # None is the root category
+
+    def _get_catalog_key(self, station):
+        # Besides the catalog itself, the categories tree depends only on those
+        return (station.branch_id, self._is_auto_station(station),
+                bool(api.sysparam.get_bool('REQUIRE_PRODUCT_BRANCH_OVERRIDE')))
+
+    def _get_extra_categories(self, station):
         # Get any extra categories plugins might want to add
         responses = signal('GetAdvancePaymentCategoryEvent').send(station)
-        for response in responses:
-            if response[1]:
-                categories_dict[None]['children'].append(response[1])
+        return [response[1] for response in responses if response[1]]
 
-        # FIXME: Remove categories that have no products inside them
-        return categories_dict[None]['children']  # None is the root category
+    def _get_catalog_snapshot(self, store, station):
+        def build():
+            # Read before the catalog, so that a change committed while it is built makes the
+            # snapshot look older than it is, never newer
+            signature = get_te_signature(store, sorted(CACHE_TABLES))
+            version = get_catalog_version(store)
+            return CatalogSnapshot(signature, version, self._build_categories(store, station))
+
+        # Stations with the same key share the same snapshot
+        return catalog_cache.get(self._get_catalog_key(station), build)
+
+    def _get_catalog_state(self, store, station, since, stream):
+        """Get the signature and the version of the catalog that will be sent
+
+        :returns: a tuple with them and the cached snapshot to be sent, or ``None`` if what is
+            sent is read from the database after this
+        """
+        version = get_catalog_version(store)
+        if stream or can_send_delta(since, version):
+            return get_te_signature(store, sorted(CACHE_TABLES)), version, None
+
+        snapshot = self._get_catalog_snapshot(store, station)
+        return snapshot.signature, snapshot.version, snapshot
+
+    def _iter_sellables(self, store, station, *conditions):
+        # Paginate by id so that only a chunk of the sellables is in memory at a time
+        last_id = None
+        while True:
+            query = list(conditions)
+            if last_id is not None:
+                query.append(Sellable.id > last_id)
+            data = list(self._get_sellable_data(store, station, *query)
+                        .order_by(Sellable.id)[:self.STREAM_PAGE_SIZE])
+            if not data:
+                break
+
+            sellable_ids = [sellable.id for (sellable, product, storable, image) in data]
+            sellable_category_prices = self._get_category_prices(store, sellable_ids)
+            loader = SellableDataLoader(store, station.branch, sellable_ids)
+            for (sellable, product, storable, image) in data:
+                category_prices = sellable_category_prices.get(sellable.id, {})
+                yield self._dump_sellable(loader, category_prices, sellable, product, storable,
+                                          image)
+
+            last_id = sellable_ids[-1]
+
+    def _iter_categories(self, station_id, extra_categories):
+        """The same as :meth:`_build_categories`, but producing the products while they are read
+
+        This runs after the request returned, so it uses its own store.
+        """
+        with api.new_store() as store:
+            # Nothing should be changed here
+            store.retval = False
+            station = store.get(BranchStation, station_id)
+
+            children = {}  # type: Dict[Optional[str], list]
+            for c in store.find(SellableCategory):
+                children.setdefault(c.category_id, []).append(c)
+
+            def dump_category(category):
+                return {
+                    'id': category.id,
+                    'description': category.description,
+                    'order': category.sort_order,
+                    'children': (dump_category(c) for c in children.get(category.id, [])),
+                    'products': self._iter_sellables(store, station,
+                                                     Sellable.category_id == category.id),
+                }
+
+            for c in children.get(None, []):  # None is the root category
+                yield dump_category(c)
+
+            yield from extra_categories
+
+    def _get_catalog_delta(self, store, station, since):
+        """Get only what changed in the catalog after the version *since*
+
+        Sellables that are not available anymore (e.g. they were closed, deleted or their branch
+        override was removed) are sent as tombstones in ``removed_sellables``, and the deleted
+        categories in ``removed_categories``. A sellable that only had a row like a category price
+        deleted is sent again, with what it has now.
+        """
+        sellable_ids = get_changed_sellable_ids(store, since)
+        sellable_category_prices = self._get_category_prices(store, sellable_ids)
+        loader = SellableDataLoader(store, station.branch, sellable_ids)
+
+        sellables = []
+        data = self._get_sellable_data(store, station, Sellable.id.is_in(sellable_ids))
+        for (sellable, product, storable, image) in data:
+            category_prices = sellable_category_prices.get(sellable.id, {})
+            sellable_data = self._dump_sellable(loader, category_prices, sellable, product,
+                                                storable, image)
+            sellable_data['category_id'] = sellable.category_id
+            sellables.append(sellable_data)
+
+        categories = []
+        category_ids = get_changed_category_ids(store, since)
+        for c in store.find(SellableCategory, SellableCategory.id.is_in(category_ids)):
+            categories.append({'id': c.id, 'description': c.description, 'order': c.sort_order,
+                               'parent_id': c.category_id})
+
+        return {
+            'sellables': sellables,
+            'removed_sellables': list(sellable_ids - {s['id'] for s in sellables}),
+            'categories': categories,
+            'removed_categories': list(category_ids - {c['id'] for c in categories}),
+        }
 
     def _get_payment_methods(self, store):
         # PaymentMethod data
@@ -355,7 +512,7 @@ class DataResource(BaseResource):
         payments_list = config.get("Payments", "credit_providers") or ''
         return [i.strip() for i in payments_list.split(',')]
 
-    def get_data(self, store):
+    def get_data(self, store, since=None, stream=False):
         """Returns all data the POS needs to run
 
         This includes:
@@ -365,8 +522,33 @@ class DataResource(BaseResource):
         - What categories it has
             - What sellables those categories have
                 - The stock amount for each sellable (if it controls stock)
+
+        If the POS informs the catalog version it already has in *since*, only what changed
+        after it will be sent in ``catalog_delta`` instead of the full ``categories`` tree.
+
+        When *stream* is ``True``, the categories tree is returned as a generator that reads the
+        catalog while it is consumed. See :func:`stoqserver.utils.iter_json`.
         """
         station = self.get_current_station(store)
+        retval = self._get_station_data(store, station)
+        since = parse_version(since)
+        version, snapshot = self._get_catalog_state(store, station, since, stream)[1:]
+        self._add_catalog_data(store, station, retval, version, since,
+                               self._get_extra_categories(station), stream, snapshot)
+        return retval
+
+    def _add_catalog_data(self, store, station, retval, version, since, extra_categories,
+                          stream=False, snapshot=None):
+        retval['catalog_version'] = format_version(version)
+        if can_send_delta(since, version):
+            retval['catalog_delta'] = self._get_catalog_delta(store, station, since)
+        elif stream:
+            retval['categories'] = self._iter_categories(station.id, extra_categories)
+        else:
+            # Don't modify the cached list
+            retval['categories'] = snapshot.categories + extra_categories
+
+    def _get_station_data(self, store, station):
         user = self.get_current_user(store)
         staff_category = store.find(ClientCategory, ClientCategory.name == 'Staff').one()
         branch = station.branch
@@ -393,7 +575,11 @@ class DataResource(BaseResource):
             except LockFailedException:
                 pinpad_status = True
 
-            printer_status = None if check_drawer() is None else True
+            try:
+                printer_status = None if check_drawer(max_age=DEFAULT_MAX_AGE) is None else True
+            except LockFailedException:
+                # Someone is using the printer
+                printer_status = True
 
         # Current branch data
         retval = dict(
@@ -421,7 +607,6 @@ class DataResource(BaseResource):
                 profile_id=user.profile_id,
             ),
             parameters=self._get_parameters(),
-            categories=self._get_categories(store, station),
             payment_methods=self._get_payment_methods(store),
             providers=self._get_card_providers(store),
             scrollable_list=self._get_scrollable_items(config),
@@ -440,8 +625,56 @@ class DataResource(BaseResource):
 
         return retval
 
+    def _get_station_version(self, store, station):
+        """Get what the station data depends on, without building it
+
+        The device statuses are left out, since checking the devices is what makes building the
+        station data expensive. Their changes are sent to the stations by the event stream.
+        """
+        user = self.get_current_user(store)
+        config = get_config()
+        return (station.id, user and user.id, get_te_signature(store, self.station_tables),
+                [config.get(section, name) for section, name in self.station_config],
+                get_plugin_manager().active_plugins_names)
+
     def get(self, store):
-        return self.get_data(store)
+        station = self.get_current_station(store)
+        since = parse_version(request.args.get('since'))
+        extra_categories = self._get_extra_categories(station)
+        stream = is_stream_requested(request)
+        station_version = self._get_station_version(store, station)
+
+        def get_etag(signature, version):
+            return self.get_etag(
+                station_version, signature, self._get_catalog_key(station), extra_categories,
+                format_version(since) if can_send_delta(since, version) else None)
+
+        # The catalog and the station data are the expensive parts, so check if the client already
+        # has them before building them. The signature also changes when rows are deleted, unlike
+        # the version
+        version = get_catalog_version(store)
+        etag = get_etag(get_te_signature(store, sorted(CACHE_TABLES)), version)
+        if self.is_not_modified(etag):
+            return self.make_not_modified_response(etag)
+
+        # A cached snapshot is described by the signature it was built at, which the client might
+        # have too
+        signature, version, snapshot = self._get_catalog_state(store, station, since, stream)
+        etag = get_etag(signature, version)
+        if self.is_not_modified(etag):
+            return self.make_not_modified_response(etag)
+
+        retval = self._get_station_data(store, station)
+        self._add_catalog_data(store, station, retval, version, since, extra_categories, stream,
+                               snapshot)
+        if stream:
+            response = make_json_stream_response(retval)
+            response.set_etag(etag)
+            return response
+        return retval, 200, {'ETag': quote_etag(etag)}
+
+
+change_listener.subscribe(DataResource._on_database_changes)
 
 
 class DrawerResource(BaseResource):
@@ -463,6 +696,7 @@ class DrawerResource(BaseResource):
             raise UnhandledMisconfiguration('Printer not configured in this station')
 
         api.device_manager.printer.open_drawer()
+        drawer_poller.wake()
         return 'success', 200
 
 
@@ -477,7 +711,7 @@ class PingResource(BaseResource):
 
 class TillClosingReceiptResource(BaseResource):
     routes = ['/till/<uuid:till_id>/closing_receipt']
-    method_decorators = [login_required]
+    method_decorators = [login_required, store_provider]
 
     @classmethod
     def get_till_closing_receipt_image(cls, till):
@@ -488,8 +722,8 @@ class TillClosingReceiptResource(BaseResource):
 
         return image
 
-    def get(self, till_id):
-        till = api.get_default_store().get(Till, till_id)
+    def get(self, store, till_id):
+        till = store.get(Till, till_id)
 
         if not till:
             abort(404)
@@ -506,6 +740,8 @@ class TillClosingReceiptResource(BaseResource):
 class TillResource(BaseResource):
     """Till RESTful resource."""
     routes = ['/till', '/till/<uuid:till_id>']
+    # Each method opens the request store, since post must only open it after getting the printer.
+    # The login is checked before that, so that unauthenticated requests don't wait for it
     method_decorators = [login_required]
 
     def _handle_open_till(self, store, last_till, initial_cash_amount=0):
@@ -613,39 +849,46 @@ class TillResource(BaseResource):
 
     @lock_printer
     def post(self):
-        data = self.get_json()
-        with api.new_store() as store:
-            till = Till.get_last(store, self.get_current_station(store))
+        # The store is only opened after getting the printer and committed before releasing it,
+        # so that the next request sees the till opened or closed by this one
+        return store_provider(self._post)()
 
-            # Provide responsible
-            if data['operation'] == 'open_till':
-                till = self._handle_open_till(store, till, data['initial_cash_amount'])
-            elif data['operation'] == 'close_till':
-                self._handle_close_till(store, till, data['till_summaries'],
-                                        data['include_receipt_image'])
-            elif data['operation'] in ['debit_entry', 'credit_entry']:
-                self._add_credit_or_debit_entry(store, till, data)
-            else:
-                raise AssertionError('Unkown till operation %r' % data['operation'])
+    def _post(self, store):
+        data = self.get_json()
+        till = Till.get_last(store, self.get_current_station(store))
+
+        # Provide responsible
+        if data['operation'] == 'open_till':
+            till = self._handle_open_till(store, till, data['initial_cash_amount'])
+        elif data['operation'] == 'close_till':
+            self._handle_close_till(store, till, data['till_summaries'],
+                                    data['include_receipt_image'])
+        elif data['operation'] in ['debit_entry', 'credit_entry']:
+            self._add_credit_or_debit_entry(store, till, data)
+        else:
+            raise AssertionError('Unkown till operation %r' % data['operation'])
 
-            return self._get_till_data(store, till, data.get('include_receipt_image'))
+        return self._get_till_data(store, till, data.get('include_receipt_image'))
 
     def get(self, till_id=None):
-        with api.new_store() as store:
-            if not till_id:
-                till = Till.get_last(store, self.get_current_station(store))
-            else:
-                till = store.get(Till, till_id)
+        return store_provider(self._get)(till_id)
 
-            if not till:
-                abort(404)
+    def _get(self, store, till_id=None):
+        if not till_id:
+            till = Till.get_last(store, self.get_current_station(store))
+        else:
+            till = store.get(Till, till_id)
 
-            return self._get_till_data(store, till)
+        if not till:
+            abort(404)
+
+        return self._get_till_data(store, till)
 
 
 class ClientResource(BaseResource):
     """Client RESTful resource."""
     routes = ['/client']
+    method_decorators = [login_required, store_provider]
 
     @classmethod
     def create_address(cls, person, address):
@@ -748,21 +991,18 @@ class ClientResource(BaseResource):
         client = Client(person=person, store=store)
         return client
 
-    @login_required
-    def get(self):
+    def get(self, store):
         doc = request.args.get('doc')
         name = request.args.get('name')
         category_name = request.args.get('category_name')
 
-        with api.new_store() as store:
-            if doc:
-                return self._get_by_doc(store, {'doc': doc, 'name': name}, doc)
-            if category_name:
-                return self._get_by_category(store, category_name)
+        if doc:
+            return self._get_by_doc(store, {'doc': doc, 'name': name}, doc)
+        if category_name:
+            return self._get_by_category(store, category_name)
         return {'doc': doc, 'name': name}
 
-    @login_required
-    def post(self):
+    def post(self, store):
         data = self.get_json()
 
         client_name = data.get('client_name')
@@ -788,14 +1028,13 @@ class ClientResource(BaseResource):
             log.error('no address provided: %s', data)
             return {'message': 'no address provided'}, 400
 
-        with api.new_store() as store:
-            client = self.create_client(store, client_name, client_document, address)
-            if not client:
-                log.error('client with cpf %s already exists', client_document)
-                return {'message': 'a client with CPF {} already exists'.format(
-                    client_document)}, 409
+        client = self.create_client(store, client_name, client_document, address)
+        if not client:
+            log.error('client with cpf %s already exists', client_document)
+            return {'message': 'a client with CPF {} already exists'.format(
+                client_document)}, 409
 
-            return {'message': 'client {} created'.format(client.id)}, 201
+        return {'message': 'client {} created'.format(client.id)}, 201
 
 
 class ExternalClientResource(BaseResource):
@@ -860,6 +1099,7 @@ class LogoutResource(BaseResource):
         if not token:
             abort(401)
 
+        revoke_token(token)
         token = AccessToken.get_by_token(store=store, token=token)
         if not token:
             abort(403, "invalid token")
@@ -897,7 +1137,7 @@ class TefResource(BaseResource):
     routes = ['/tef/<signal_name>']
     method_decorators = [login_required, store_provider]
 
-    @lock_printer
+    @lock_printer(priority=HIGH)
     def _print_callback(self, lib, holder, merchant):
         printer = api.device_manager.printer
         if not printer:
@@ -931,7 +1171,7 @@ class TefResource(BaseResource):
             raise EventStreamBrokenException()
         return reply
 
-    @lock_pinpad(block=True)
+    @lock_pinpad(block=True, priority=HIGH)
     def post(self, store, signal_name):
         station = self.get_current_station(store)
         if signal_name not in ['StartTefSaleSummaryEvent', 'StartTefAdminEvent']:
@@ -942,8 +1182,8 @@ class TefResource(BaseResource):
         try:
             # Only lock printer in single client mode
             if not is_multiclient:
-                with printer_lock:
-                    self.ensure_printer(station)
+                # The same priority as the rest of the TEF operation
+                lock_printer(priority=HIGH)(self.ensure_printer)(station)
         except Exception:
             EventStream.add_event({
                 'type': 'TEF_OPERATION_FINISHED',
@@ -1020,23 +1260,34 @@ class ImageResource(BaseResource):
     """Image RESTful resource."""
 
     routes = ['/image/<id>']
+    method_decorators = [store_provider]
 
-    def get(self, id):
+    def get(self, store, id):
         is_main = bool(request.args.get('is_main', None))
         keyword_filter = request.args.get('keyword')
         # FIXME: The images should store tags so they could be requested by that tag and
         # product_id. At the moment, we simply check if the image is main or not and
         # return the first one.
-        with api.new_store() as store:
-            images = store.find(Image, sellable_id=id, is_main=is_main)
-            if keyword_filter:
-                images = images.find(Image.keywords.like('%{}%'.format(keyword_filter)))
-            image = images.any()
-            if image:
-                return send_file(io.BytesIO(image.image), mimetype='image/png')
-            else:
-                response = make_response(_("Image not found."), 404)
-                return response
+        query = [Image.sellable_id == id, Eq(Image.is_main, is_main)]
+        if keyword_filter:
+            query.append(Image.keywords.like('%{}%'.format(keyword_filter)))
+        # Don't load the image itself until we know the client doesn't have it already
+        image_data = store.find((Image.id, Image.te_id), *query).any()
+        if not image_data:
+            response = make_response(_("Image not found."), 404)
+            return response
+
+        image_id, te_id = image_data
+        te_time = store.execute('SELECT te_time FROM transaction_entry WHERE id = ?',
+                                params=[te_id]).get_one()[0]
+        etag = self.get_etag(image_id, te_time)
+        if self.is_not_modified(etag):
+            return self.make_not_modified_response(etag)
+
+        image = store.get(Image, image_id)
+        response = send_file(io.BytesIO(image.image), mimetype='image/png')
+        response.set_etag(etag)
+        return response
 
 
 class SaleResourceMixin:
@@ -1163,27 +1414,32 @@ class SaleResourceMixin:
                 if not money_payment or payment_value > money_payment.value:
                     money_payment = p_list[0]
             elif method.method_name == 'card':
+                card_type = p['card_type']
+                # This card_type does not exist in stoq. Change it to 'credit'.
+                if card_type not in CreditCardData.types:
+                    log.info('Invalid card type %s. changing to credit', card_type)
+                    card_type = 'credit'
+                # FIXME Stoq already have the voucher concept, but we should keep this for a
+                # little while for backwars compatibility
+                elif card_type == 'voucher':
+                    card_type = 'debit'
+
+                # The same for all the installments
+                provider = self._get_provider(store, p['provider'])
+                if tef_data:
+                    device = self._get_card_device(store, tef_data.get('authorizer', 'TEF'))
+                else:
+                    device = self._get_card_device(store, 'POS')
+
+                # The card data is looked up by a query, which might be inside a write_behind. This
+                # also writes the provider and the device, if they were just created, so that the
+                # next payments find them instead of creating them again
+                store.flush()
                 for payment in p_list:
                     card_data = method.operation.get_card_data_by_payment(payment)
-
-                    card_type = p['card_type']
-                    # This card_type does not exist in stoq. Change it to 'credit'.
-                    if card_type not in CreditCardData.types:
-                        log.info('Invalid card type %s. changing to credit', card_type)
-                        card_type = 'credit'
-                    # FIXME Stoq already have the voucher concept, but we should keep this for a
-                    # little while for backwars compatibility
-                    elif card_type == 'voucher':
-                        card_type = 'debit'
-                    provider = self._get_provider(store, p['provider'])
-
                     if tef_data:
                         card_data.nsu = tef_data['nsu']
                         card_data.auth = tef_data['auth']
-                        authorizer = tef_data.get('authorizer', 'TEF')
-                        device = self._get_card_device(store, authorizer)
-                    else:
-                        device = self._get_card_device(store, 'POS')
 
                     card_data.update_card_data(device, provider, card_type, installments)
                     card_data.te.metadata = tef_data
@@ -1338,14 +1594,74 @@ class SaleResource(BaseResource, SaleResourceMixin):
             log.error('Invalid order number: %s', order_number)
             abort(400, "Invalid order number")
 
-        log.info('emitting event PrintKitchenCouponEvent {}'.format(order_number))
-        PrintKitchenCouponEvent.send(sale, order_number=order_number)
+        # Printed in the background, so that the sale doesn't wait for the kitchen printer
+        return print_queue.add(sale.store, sale.station, 'kitchen_coupon', sale_id=sale.id,
+                               order_number=order_number)
 
-    @lock_printer
-    @lock_sat(block=True)
+    @staticmethod
+    def _get_sellable_ids(products):
+        return [p['id'] for p in products if currency(p['price'])]
+
+    def _add_products(self, store, sale, delivery, products, loader=None):
+        if loader is None:
+            loader = SaleSellableLoader(store, self._get_sellable_ids(products))
+        for p in products:
+            if not currency(p['price']):
+                continue
+
+            sellable = loader.get_sellable(p['id'])
+            if sellable is None:
+                log.error('Sellable %s does not exist', p)
+                abort(400, 'Sellable {} doesn\'t exist'.format(p['id']))
+
+            product = sellable.product
+            if product and product.is_package:
+                # External orders might send a different price for a package, and we must adjust the
+                # children prices to make them match
+                diff = decimal.Decimal(p['price']) - sellable.price
+
+                parent = sale.add_sellable(sellable, price=0,
+                                           quantity=decimal.Decimal(p['quantity']))
+                parent.delivery = delivery
+                # XXX: Maybe this should be done in sale.add_sellable automatically, but this would
+                # require refactoring stoq as well.
+                for child in loader.get_components(product):
+                    quantity = child.quantity * decimal.Decimal(p['quantity'])
+                    price = child.price
+                    if diff:
+                        price = price + quantize(diff * price / sellable.price)
+
+                    item = sale.add_sellable(child.component.sellable, price=price,
+                                             quantity=quantity, parent=parent)
+                    # FIXME: The same comment bellow applies
+                    item.base_price = item.price
+                    item.delivery = delivery
+            else:
+                item = sale.add_sellable(sellable, price=currency(p['price']),
+                                         quantity=decimal.Decimal(p['quantity']))
+                item.delivery = delivery
+
+                # FIXME: There seems to be a parameter in the nfce plugin to handle exactly this. We
+                # should duplicate the behaviour for the sat plugin and remove this code
+                # XXX: bdil has requested that when there is a special discount, the discount does
+                # not appear on the coupon. Instead, the item wil be sold using the discount price
+                # as the base price. Maybe this should be a parameter somewhere
+                item.base_price = item.price
+
+    @idempotent('sale')
+    @lock_printer(priority=HIGH)
+    @lock_sat(block=True, priority=HIGH)
     def post(self, store):
+        # The drawer might be opened after the sale is paid
+        drawer_poller.wake()
+        return self._create_sale(store, self.get_json())
+
+    def _create_sale(self, store, data, loader=None):
+        """Create and confirm the sale of *data*
+
+        :param loader: a :class:`SaleSellableLoader` that already has the sellables of the sale
+        """
         # FIXME: Check branch state and force fail if no override for that product is present.
-        data = self.get_json()
         products = data['products']
         client_category_id = data.get('price_table')
         should_print_receipts = data.get('print_receipts', True)
@@ -1398,49 +1714,9 @@ class SaleResource(BaseResource, SaleResourceMixin):
                 context_id=context_id,
             )
 
-        # Add products
-        for p in products:
-            if not currency(p['price']):
-                continue
-
-            sellable = store.get(Sellable, p['id'])
-            if sellable is None:
-                log.error('Sellable %s does not exist', p)
-                abort(400, 'Sellable {} doesn\'t exist'.format(p['id']))
-
-            product = sellable.product
-            if product and product.is_package:
-                # External orders might send a different price for a package, and we must adjust the
-                # children prices to make them match
-                diff = decimal.Decimal(p['price']) - sellable.price
-
-                parent = sale.add_sellable(sellable, price=0,
-                                           quantity=decimal.Decimal(p['quantity']))
-                parent.delivery = delivery
-                # XXX: Maybe this should be done in sale.add_sellable automatically, but this would
-                # require refactoring stoq as well.
-                for child in product.get_components():
-                    quantity = child.quantity * decimal.Decimal(p['quantity'])
-                    price = child.price
-                    if diff:
-                        price = price + quantize(diff * price / sellable.price)
-
-                    item = sale.add_sellable(child.component.sellable, price=price,
-                                             quantity=quantity, parent=parent)
-                    # FIXME: The same comment bellow applies
-                    item.base_price = item.price
-                    item.delivery = delivery
-            else:
-                item = sale.add_sellable(sellable, price=currency(p['price']),
-                                         quantity=decimal.Decimal(p['quantity']))
-                item.delivery = delivery
-
-                # FIXME: There seems to be a parameter in the nfce plugin to handle exactly this. We
-                # should duplicate the behaviour for the sat plugin and remove this code
-                # XXX: bdil has requested that when there is a special discount, the discount does
-                # not appear on the coupon. Instead, the item wil be sold using the discount price
-                # as the base price. Maybe this should be a parameter somewhere
-                item.base_price = item.price
+        # Add products. They are only inserted when all of them are ready
+        with write_behind(store):
+            self._add_products(store, sale, delivery, products, loader)
 
         # Add payments
         config = get_config()
@@ -1455,8 +1731,9 @@ class SaleResource(BaseResource, SaleResourceMixin):
                 p['card_type'] = 'credit'
                 p['provider'] = 'IFOOD'
 
-        self._create_payments(store, group, branch, station,
-                              sale.get_total_sale_amount(), data['payments'])
+        sale_total = sale.get_total_sale_amount()
+        with write_behind(store):
+            self._create_payments(store, group, branch, station, sale_total, data['payments'])
 
         if (discount_value > 0 and passbook_client and 'stamps' in passbook_client.get('type', [])
                 and decimal.Decimal(passbook_client['points']) >= passbook_client['stamps_limit']):
@@ -1490,20 +1767,28 @@ class SaleResource(BaseResource, SaleResourceMixin):
 
         GrantLoyaltyPointsEvent.send(sale, document=(client_document or coupon_document))
 
-        if has_nfe:
-            NfeProgressEvent.connect(self._nfe_progress_event)
-            NfeWarning.connect(self._nfe_warning_event)
-            NfeSuccess.connect(self._nfe_success_event)
+        emission_job_id = None
+        if postpone_emission:
+            # The fiscal document is emitted in the background, after the sale is committed
+            invoice_data = None
+            emission_job_id = emission_queue.add(
+                store, station, 'sale', sale_id=sale.id, coupon_document=coupon_document,
+                should_print_receipts=should_print_receipts)
+        else:
+            if has_nfe:
+                NfeProgressEvent.connect(self._nfe_progress_event)
+                NfeWarning.connect(self._nfe_warning_event)
+                NfeSuccess.connect(self._nfe_success_event)
 
-        # Fiscal plugins will connect to this event and "do their job"
-        # It's their responsibility to raise an exception in case of any error
-        try:
-            invoice_data = SaleConfirmedRemoteEvent.emit(sale, coupon_document,
-                                                         should_print_receipts, postpone_emission)
-        except (NfePrinterException, SatPrinterException):
-            return self._handle_coupon_printing_fail(sale)
-        except NfeRejectedException as e:
-            return self._handle_nfe_coupon_rejected(sale, e.reason)
+            # Fiscal plugins will connect to this event and "do their job"
+            # It's their responsibility to raise an exception in case of any error
+            try:
+                invoice_data = SaleConfirmedRemoteEvent.emit(sale, coupon_document,
+                                                             should_print_receipts, False)
+            except (NfePrinterException, SatPrinterException):
+                return self._handle_coupon_printing_fail(sale)
+            except NfeRejectedException as e:
+                return self._handle_nfe_coupon_rejected(sale, e.reason)
 
         if sale.station.has_kps_enabled and sale.get_kitchen_items() and not external_order_id:
             self._print_kps(data, sale)
@@ -1513,8 +1798,50 @@ class SaleResource(BaseResource, SaleResourceMixin):
             'client_id': client and client.id,
             'invoice_data': invoice_data
         }
+        if emission_job_id is not None:
+            retval['emission_job_id'] = emission_job_id
         return retval, 201
 
+    @staticmethod
+    def _emit_postponed(store, station, sale_id, coupon_document, should_print_receipts):
+        sale = store.get(Sale, sale_id)
+        # The document must be emitted by the devices of the station that sold it
+        if sale.station != station:
+            raise JobCancelled('Sale {} is not from station {}'.format(sale_id, station.id))
+
+        def send_event(event):
+            with suppress(EventStreamUnconnectedStation):
+                EventStream.add_event(event, station=station)
+
+        def progress(message):
+            send_event({'type': 'NFE_PROGRESS', 'message': message})
+
+        def warning(message, details):
+            send_event({'type': 'NFE_WARNING', 'message': message, 'details': details})
+
+        def success(message, details=None):
+            send_event({'type': 'NFE_SUCCESS', 'message': message, 'details': details})
+
+        if has_nfe:
+            NfeProgressEvent.connect(progress)
+            NfeWarning.connect(warning)
+            NfeSuccess.connect(success)
+        try:
+            SaleConfirmedRemoteEvent.emit(sale, coupon_document, should_print_receipts, False)
+        except (NfePrinterException, SatPrinterException):
+            # The document was emitted and only printing it failed. Trying again would emit it
+            # a second time
+            log.exception('Failed to print the coupon of sale %s', sale.identifier)
+            warning(_('Failed to print the coupon of sale {sale_identifier}').format(
+                sale_identifier=sale.identifier), None)
+        except NfeRejectedException as e:
+            raise JobCancelled(e.reason)
+        finally:
+            if has_nfe:
+                NfeProgressEvent.disconnect(progress)
+                NfeWarning.disconnect(warning)
+                NfeSuccess.disconnect(success)
+
     def get(self, store, sale_id):
         sale = store.get(Sale, sale_id)
         if not sale:
@@ -1540,12 +1867,104 @@ class SaleResource(BaseResource, SaleResourceMixin):
         signal('SaleAbortedEvent').send(sale_id)
 
 
+emission_queue.handler('sale')(SaleResource._emit_postponed)
+
+
+class SaleBatchResource(BaseResource):
+    """Create the sales a station queued while it was offline
+
+    The sales are created in chunks, each one in a single transaction and sharing the prefetched
+    sellables, and their fiscal documents are emitted later by the emission queue. A sale that
+    fails is rolled back alone, unless what it left behind can't be discarded, when its whole chunk
+    is. The result of each sale is returned in the order they were sent.
+    """
+
+    routes = ['/sale/batch']
+    method_decorators = [login_required]
+
+    # How many sales are created in each transaction
+    CHUNK_SIZE = 20
+
+    def post(self):
+        sales = self.get_json()['sales']
+        sale_resource = SaleResource()
+        results = []
+        for i in range(0, len(sales), self.CHUNK_SIZE):
+            chunk = sales[i:i + self.CHUNK_SIZE]
+            with api.new_store() as store:
+                loader = SaleSellableLoader(store, [
+                    sellable_id for data in chunk
+                    for sellable_id in SaleResource._get_sellable_ids(data.get('products', []))])
+                chunk_results = []
+                for data in chunk:
+                    result, chunk_rolled_back = self._create_sale(store, sale_resource, loader,
+                                                                  data)
+                    if chunk_rolled_back:
+                        # The sales created before it in this chunk were rolled back too
+                        chunk_results = [
+                            self._get_result(r['sale_id'], 500, result['response'])
+                            if r['status'] < 300 else r for r in chunk_results]
+                    chunk_results.append(result)
+                results.extend(chunk_results)
+
+        return {'results': results}, 200
+
+    @lock_printer
+    def _create_sale(self, store, sale_resource, loader, data):
+        """Create a sale of the batch in a savepoint of *store*
+
+        :returns: the result of the sale and if the whole transaction of *store* was rolled back
+        """
+        # The fiscal documents are emitted in the background, after the chunk is committed
+        sale_data = dict(data, postpone_emission=True)
+        store.savepoint('batch_sale')
+        try:
+            response, status_code = submit(
+                store, 'sale', data, lambda: sale_resource._create_sale(store, sale_data, loader))
+        except HTTPException as e:
+            response, status_code = {'message': e.description}, e.code
+        except Exception as e:
+            log.exception('Failed to create sale %s of the batch', data.get('sale_id'))
+            response, status_code = {'message': str(e)}, 500
+        else:
+            return self._get_result(data.get('sale_id'), status_code, response), False
+
+        chunk_rolled_back = self._rollback_sale(store)
+        return self._get_result(data.get('sale_id'), status_code, response), chunk_rolled_back
+
+    def _rollback_sale(self, store):
+        """Roll back the sale that failed, returning if the whole transaction had to be rolled back
+
+        The sale might have left objects pending, like the ones created inside a write_behind,
+        which would be written after the rollback otherwise, referencing a sale that doesn't exist.
+        They are written first, so that they are rolled back too. When they can't be written, the
+        only way to discard them is rolling back the whole transaction.
+        """
+        try:
+            store.flush()
+        except Exception:
+            log.exception('Failed to write the objects of the failed sale. Rolling back the chunk')
+            store.rollback(close=False)
+            return True
+
+        store.rollback_to_savepoint('batch_sale')
+        return False
+
+    def _get_result(self, sale_id, status_code, response):
+        return {
+            'sale_id': sale_id,
+            'status': status_code,
+            'response': response,
+        }
+
+
 class AdvancePaymentResource(BaseResource, SaleResourceMixin):
 
     routes = ['/advance_payment']
     method_decorators = [login_required, store_provider]
 
-    @lock_printer
+    @idempotent('advance_payment')
+    @lock_printer(priority=HIGH)
     def post(self, store):
         # We need to delay this import since the plugin will only be in the path after stoqlib
         # initialization
@@ -1584,7 +2003,9 @@ class AdvancePaymentResource(BaseResource, SaleResourceMixin):
             responsible=user)
 
         # Add payments
-        self._create_payments(store, group, branch, station, advance.total_value, data['payments'])
+        with write_behind(store):
+            self._create_payments(store, group, branch, station, advance.total_value,
+                                  data['payments'])
         till = Till.get_last(store, station)
         if not till or till.status != Till.STATUS_OPEN:
             raise TillError(_('There is no till open'))
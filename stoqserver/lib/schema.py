@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2020 Stoq Tecnologia <https://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <stoq-devel@async.com.br>
+#
+
+"""The tables of stoqserver itself
+
+Stoq's schema doesn't know about them, so they are created by :func:`create_schema` when the flask
+server starts, before it forks its workers and before any request, instead of by the code that
+uses them.
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Any number, as long as nothing else uses it for an advisory lock
+SCHEMA_LOCK_ID = 0x5709
+
+_statements = []
+
+
+def register_table(statement):
+    """Register the statement that creates a table, which must do nothing if it already exists"""
+    _statements.append(statement)
+
+
+def create_schema(store):
+    """Create the tables registered by the modules imported so far"""
+    # Other servers using the same database might be starting too
+    store.execute('SELECT pg_advisory_xact_lock(?)', (SCHEMA_LOCK_ID, ))
+    for statement in _statements:
+        store.execute(statement)
+    log.info('Created %s stoqserver tables', len(_statements))
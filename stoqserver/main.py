@@ -255,7 +255,7 @@ class StoqServerCmdHandler(object):
         if platform.system() != 'Windows':
             signal.signal(signal.SIGQUIT, _exit)
 
-        start_flask_server(options.debug, options.multiclient)
+        start_flask_server(options.debug, options.multiclient, options.workers)
 
     def opt_flask(self, parser, group):
         """Options for command flask"""
@@ -263,6 +263,12 @@ class StoqServerCmdHandler(object):
                          action='store_true',
                          dest='multiclient',
                          help="Make flask API prepared to serve multiple clients")
+        group.add_option('', '--workers',
+                         action='store',
+                         type='int',
+                         default=1,
+                         dest='workers',
+                         help="Number of processes serving the API in multiclient mode")
 
     def cmd_backup_database(self, options, *args):
         """Backup the Stoq database"""
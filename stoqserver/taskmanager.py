@@ -27,6 +27,7 @@ import logging
 import multiprocessing
 import os
 import platform
+import queue
 import signal
 import sys
 import threading
@@ -345,6 +346,86 @@ class TaskManager(threading.Thread):
                 pass
 
 
+class TaskPool(object):
+    """Keep a number of copies of a task running.
+
+    Copies that die for any reason, including being killed by a signal,
+    are restarted with the same backoff used by :class:`TaskManager`.
+    Unlike it, this doesn't block waiting for errors, so it can be
+    used by a process patched by gevent (e.g. the flask server).
+    """
+
+    CHECK_INTERVAL = 1
+
+    def __init__(self, name, size, func, *args, **kwargs):
+        self._error_queue = multiprocessing.Queue()
+        self._tasks = [Task('%s_%d' % (name, i), func, *args, **kwargs)
+                       for i in range(size)]
+        # Index of the dead tasks -> when they should be restarted
+        self._restart_at = {}
+
+    #
+    #  Public API
+    #
+
+    def start(self):
+        for task in self._tasks:
+            task.start(self._error_queue)
+
+    def check_tasks(self):
+        """Restart the tasks that died, respecting their backoff."""
+        self._drain_error_queue()
+        now = time.monotonic()
+
+        for i, task in enumerate(self._tasks):
+            if task.is_alive():
+                continue
+
+            restart_at = self._restart_at.get(i)
+            if restart_at is None:
+                backoff_value = TaskManager.BACKOFF_FACTOR ** min(task.errors, 12)
+                task.errors += 1
+                logger.warning("Task %s died (exit code %s). Restarting again "
+                               "in %s seconds...", task.name, task.exitcode,
+                               backoff_value)
+                self._restart_at[i] = now + backoff_value
+            elif now >= restart_at:
+                logger.info("Restarting task %s", task.name)
+                del self._restart_at[i]
+                new_task = task.clone()
+                self._tasks[i] = new_task
+                new_task.start(self._error_queue)
+
+    def run(self):
+        """Start the tasks and keep them running.
+
+        Note that this will block the code execution.
+        """
+        self.start()
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            self.check_tasks()
+
+    def stop(self):
+        self._restart_at.clear()
+        for task in self._tasks:
+            if task.is_alive():
+                task.stop()
+
+    #
+    #  Private
+    #
+
+    def _drain_error_queue(self):
+        # The crashes are detected by the tasks dying, but the queue
+        # still needs to be emptied so the tasks don't block writing to it
+        while True:
+            try:
+                self._error_queue.get_nowait()
+            except queue.Empty:
+                break
+
+
 class Worker(object):
     """Worker responsible to run tasks and execute actions.
 
@@ -152,7 +152,7 @@ def start_xmlrpc_server(pipe_conn):
     run_xmlrpcserver(pipe_conn, port)
 
 
-def start_flask_server(debug=False, multiclient=False):
+def start_flask_server(debug=False, multiclient=False, workers=1):
     # We need to delay importing so that the plugin infrastructure gets setup correcly
     # XXX: is this still needed?
     from stoqserver.app import run_flaskserver
@@ -164,9 +164,59 @@ def start_flask_server(debug=False, multiclient=False):
     # XXX: Is flaskport a good name for this?
     port = int(config.get('General', 'flaskport') or SERVER_FLASK_PORT)
 
+    # Before forking the workers, so that they don't race to create the tables
+    _create_schema()
+
+    if workers > 1:
+        # The devices of a station can only be used by one process, and the reloader
+        # would restart the master only
+        if multiclient and not debug:
+            return _start_flask_workers(port, workers)
+        logger.warning("Ignoring --workers: it can only be used in multiclient mode "
+                       "without debug")
+
     run_flaskserver(port, debug, multiclient)
 
 
+def _create_schema():
+    # Import the modules that register tables
+    from stoqserver.lib import catalog, emissionqueue, eventbus, idempotency, printqueue
+    from stoqserver.lib.schema import create_schema
+
+    catalog, emissionqueue, eventbus, idempotency, printqueue
+    with api.new_store() as store:
+        create_schema(store)
+
+
+def _start_flask_worker(port, listener):
+    from stoqserver.app import run_flaskserver
+
+    _setup_signal_termination()
+    run_flaskserver(port, multiclient=True, listener=listener)
+
+
+def _start_flask_workers(port, workers):
+    from gevent.pywsgi import WSGIServer
+    from stoqserver.taskmanager import TaskPool
+
+    # Bind the port here so that all the workers accept connections from the same socket
+    listener = WSGIServer.get_listener(('0.0.0.0', port))
+    logger.info("Starting %s flask workers on port %s", workers, port)
+
+    pool = TaskPool('flask_worker', workers, _start_flask_worker, port, listener)
+
+    def _sigterm_handler(_signal, _stack_frame):
+        pool.stop()
+        os._exit(0)
+
+    pool.start()
+    # Set this after starting the workers, since they inherit the signal handlers
+    signal.signal(signal.SIGTERM, _sigterm_handler)
+    while True:
+        time.sleep(pool.CHECK_INTERVAL)
+        pool.check_tasks()
+
+
 def start_server():
     _setup_signal_termination()
     logger.info("Starting stoq server")
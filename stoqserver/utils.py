@@ -22,12 +22,22 @@
 # Author(s): Stoq Team <stoq-devel@async.com.br>
 #
 
+import collections.abc
+import contextlib
 import datetime
 import decimal
 import json
+import zlib
 from hashlib import md5
 
+from flask import Response, stream_with_context
+
 from stoqlib.api import api
+from stoqlib.lib.configparser import get_config
+
+# Try to send at least this much data at once when streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
 
 
 class JsonEncoder(json.JSONEncoder):
@@ -41,5 +51,118 @@ class JsonEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+@contextlib.contextmanager
+def write_behind(store):
+    """Keep the objects created and changed in the block in memory until it ends
+
+    Storm flushes the pending objects before each query, so objects that do queries while being
+    built, like the sale items, end up inserted half-done and then updated once or twice. Inside
+    this block they are written only once, when it ends.
+
+    Queries made inside the block don't see the objects created in it, unless ``store.flush()``
+    is called explicitly.
+    """
+    store.block_implicit_flushes()
+    try:
+        yield
+    finally:
+        store.unblock_implicit_flushes()
+    store.flush()
+
+
+def get_cors_headers(origin):
+    """Get the CORS headers the POS needs to have its ajax requests accepted by the browser"""
+    return [
+        ('Access-Control-Allow-Origin', origin),
+        ('Access-Control-Allow-Methods', 'POST, GET, OPTIONS, DELETE'),
+        ('Access-Control-Allow-Headers', 'Authorization, Content-Type'),
+        ('Access-Control-Allow-Credentials', 'true'),
+    ]
+
+
 def get_user_hash():
     return md5(api.sysparam.get_string('USER_HASH').encode('UTF-8')).hexdigest()
+
+
+def get_int_config(name, default):
+    """Get an integer from the General section of the config, or *default* if it is not set"""
+    value = get_config().get('General', name)
+    return int(value) if value else default
+
+
+def _encode_key(encoder, key):
+    # The same conversions json.dumps does for non string keys
+    if isinstance(key, str):
+        return encoder.encode(key)
+    if key is None or isinstance(key, bool):
+        return '"{}"'.format(encoder.encode(key))
+    return encoder.encode(str(key))
+
+
+def _iter_json(obj, encoder):
+    if isinstance(obj, dict):
+        yield '{'
+        for i, (key, value) in enumerate(obj.items()):
+            if i:
+                yield ', '
+            yield _encode_key(encoder, key)
+            yield ': '
+            yield from _iter_json(value, encoder)
+        yield '}'
+    elif isinstance(obj, (list, tuple, collections.abc.Iterator)):
+        yield '['
+        for i, value in enumerate(obj):
+            if i:
+                yield ', '
+            yield from _iter_json(value, encoder)
+        yield ']'
+    else:
+        yield encoder.encode(obj)
+
+
+def iter_json(obj, chunk_size=STREAM_CHUNK_SIZE):
+    """Encode obj as JSON, yielding the result in chunks
+
+    Generators and other iterators inside obj are encoded as lists while they are consumed,
+    so the whole document never needs to be in memory at once.
+    """
+    chunk = []
+    size = 0
+    for piece in _iter_json(obj, JsonEncoder()):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield ''.join(chunk)
+
+
+def make_json_stream_response(obj, status=200):
+    """Create a response that streams obj as JSON. See :func:`iter_json`"""
+    return Response(stream_with_context(iter_json(obj)), status=status,
+                    mimetype='application/json')
+
+
+def is_stream_requested(request):
+    """Check if the client asked for the response to be streamed"""
+    return request.args.get('stream') in ['1', 'true']
+
+
+def iter_gzip(chunks):
+    """Compress the chunks of a streamed response with gzip
+
+    Each chunk is flushed, so the client gets it right away instead of waiting for the compressor
+    to fill a block.
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def is_gzip_requested(request):
+    """Check if the client asked for a gzip compressed response, and accepts it"""
+    return request.args.get('gzip') in ['1', 'true'] and 'gzip' in request.accept_encodings
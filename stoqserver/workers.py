@@ -46,7 +46,8 @@ from stoqlib.lib.pluginmanager import get_plugin_manager
 
 from . import __version__ as stoqserver_version
 from .lib.checks import check_drawer, check_pinpad, check_sat
-from .lib.lock import LockFailedException
+from .lib.drawer import drawer_poller, polls_skipped
+from .lib.lock import LockFailedException, printer_lock
 from .lib.eventstream import EventStream, DeviceType
 from .signals import CheckSatStatusEvent
 
@@ -70,10 +71,18 @@ def check_drawer_loop(station):
     # default value of is_open
     is_open = ''
 
-    # Check every second if it is opened.
+    # Check if it is opened, more often when it is likely to change.
     # Alert only if changes.
     while True:
-        new_is_open = check_drawer()
+        try:
+            new_is_open = drawer_poller.poll(check_drawer)
+        except LockFailedException:
+            # Don't compete with the print jobs for the printer. They might open the drawer, so
+            # check it often after they finish.
+            polls_skipped.inc()
+            printer_lock.wait()
+            drawer_poller.wake()
+            continue
 
         if is_open != new_is_open:
             printer_status = None if new_is_open is None else True
@@ -83,7 +92,7 @@ def check_drawer_loop(station):
 
             is_open = new_is_open
 
-        gevent.sleep(1)
+        drawer_poller.wait(is_open)
 
 
 @worker
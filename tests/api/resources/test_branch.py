@@ -13,3 +13,13 @@ def test_get_branch(client):
     assert "id" in res["data"][0]
     assert "is_active" in res["data"][0]
     assert "name" in res["data"][0]
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_branch_not_modified(client):
+    response = client.get("/branch")
+    etag = response.headers['ETag']
+
+    response = client.get("/branch", environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
@@ -0,0 +1,19 @@
+from stoqserver.lib.lock import printer_lock
+
+
+def test_get_locks(client):
+    response = client.get('/locks')
+
+    assert response.status_code == 200
+    assert response.json['printer'] == {'locked': False, 'holder': None, 'held_for': None,
+                                        'waiting': 0, 'waiting_priorities': []}
+    assert set(response.json) >= {'printer', 'pinpad', 'sat'}
+
+
+def test_get_locks_held(client):
+    with printer_lock:
+        response = client.get('/locks')
+
+    assert response.json['printer']['locked'] is True
+    assert response.json['printer']['holder']['function'] is None
+    assert response.json['printer']['held_for'] >= 0
@@ -0,0 +1,10 @@
+from stoqserver.lib.metrics import registry
+
+
+def test_get_metrics(client):
+    registry.counter('test_counter', 'A counter').inc()
+
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.json['test_counter']['value'] >= 1
@@ -234,3 +234,40 @@ def test_sellable_get_all(client, example_creator):
     assert response.status_code == 200
     assert len(res['data']) >= 3
     assert set(("description", "id", "image_id", "barcode", "notes")) == res['data'][0].keys()
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_get_all_stream(client, example_creator):
+    sellables = [example_creator.create_sellable(description=d) for d in ('S1', 'S2', 'S3')]
+    img = example_creator.create_image()
+    img.sellable_id = sellables[0].id
+
+    response = client.get('/sellable', query_string={'stream': '1'})
+    res = json.loads(response.data.decode('utf-8'))
+    assert response.status_code == 200
+    data = {s['id']: s for s in res['data']}
+    assert data[sellables[0].id]['image_id'] == img.id
+    assert data[sellables[1].id] == {
+        'id': sellables[1].id,
+        'description': 'S2',
+        'barcode': sellables[1].barcode,
+        'notes': sellables[1].notes,
+        'image_id': None,
+    }
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_get_not_modified(client, example_creator):
+    sellable = example_creator.create_sellable(description='S1')
+
+    for endpoint in ['/sellable', '/sellable/' + sellable.id]:
+        response = client.get(endpoint)
+        etag = response.headers['ETag']
+
+        response = client.get(endpoint, environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+        assert response.status_code == 304
+
+        sellable.description = sellable.description + ' changed'
+        response = client.get(endpoint, environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
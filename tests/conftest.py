@@ -6,7 +6,10 @@ import pytest
 from flask.testing import FlaskClient
 
 from stoqlib.lib.decorators import cached_property
+from storm.tracer import install_tracer, remove_tracer
+
 from stoqserver.app import bootstrap_app
+from stoqserver.lib.schema import create_schema
 
 
 class StoqTestClient(FlaskClient):
@@ -50,6 +53,27 @@ class StoqTestClient(FlaskClient):
         return self._request('put', *args, **kwargs)
 
 
+@pytest.fixture
+def schema(store):
+    """Create the stoqserver tables, that the server creates when it starts"""
+    create_schema(store)
+
+
+@pytest.fixture
+def query_counter():
+    """Count the queries sent to the database"""
+    class QueryCounter:
+        count = 0
+
+        def connection_raw_execute(self, connection, raw_cursor, statement, params):
+            self.count += 1
+
+    counter = QueryCounter()
+    install_tracer(counter)
+    yield counter
+    remove_tracer(counter)
+
+
 # This is flask test client according to boilerplate:
 # https://flask.palletsprojects.com/en/1.0.x/testing/
 @pytest.fixture
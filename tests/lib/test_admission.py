@@ -0,0 +1,70 @@
+import gevent
+import pytest
+from gevent.event import Event
+
+from stoqserver.lib.admission import NORMAL, PRIORITY, AdmissionControl, get_request_class
+
+
+@pytest.mark.parametrize('path, request_class', (
+    ('/ping', None),
+    ('/stream', None),
+    ('/sale', PRIORITY),
+    ('/sale/123/coupon', PRIORITY),
+    ('/sale/batch', NORMAL),
+    ('/tef/StartTefSaleEvent', PRIORITY),
+    ('/data', NORMAL),
+    ('/sellable', NORMAL),
+    ('/salesman', NORMAL),
+))
+def test_get_request_class(path, request_class):
+    assert get_request_class(path) == request_class
+
+
+@pytest.fixture
+def release_event():
+    return Event()
+
+
+@pytest.fixture
+def middleware(release_event):
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        if environ['PATH_INFO'] == '/data/slow':
+            release_event.wait()
+        return [b'ok']
+
+    return AdmissionControl(app, max_requests=1, max_priority_requests=1, max_queued=0,
+                            queue_timeout=0.01)
+
+
+def request(middleware, path):
+    statuses = []
+
+    def start_response(status, headers):
+        statuses.append((status, dict(headers)))
+
+    response = middleware({'PATH_INFO': path}, start_response)
+    body = b''.join(response)
+    getattr(response, 'close', lambda: None)()
+    return statuses[0][0], statuses[0][1], body
+
+
+def test_admission_control(middleware, release_event):
+    slow = gevent.spawn(request, middleware, '/data/slow')
+    gevent.sleep(0)
+
+    status, headers, body = request(middleware, '/data')
+    assert status.startswith('503')
+    assert headers['Retry-After']
+    # The browser only lets the POS read it with those
+    assert headers['Access-Control-Allow-Origin'] == '*'
+    assert headers['Access-Control-Allow-Credentials'] == 'true'
+
+    # Other classes and exempt requests don't wait for the slow one
+    assert request(middleware, '/sale')[0] == '200 OK'
+    assert request(middleware, '/ping')[0] == '200 OK'
+
+    release_event.set()
+    assert slow.get()[0] == '200 OK'
+    # The slot is released when the response is closed
+    assert request(middleware, '/data')[0] == '200 OK'
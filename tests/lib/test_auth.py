@@ -0,0 +1,92 @@
+from unittest import mock
+
+import pytest
+from stoqlib.domain.token import AccessToken
+
+from stoqserver.lib.auth import TokenCache, TokenIdentity, get_identity_for_token
+
+
+@pytest.fixture
+def identity():
+    return TokenIdentity(token='token', user_id='user', station_id='station', branch_id='branch',
+                         expires_at=None)
+
+
+def test_token_cache(identity):
+    cache = TokenCache()
+    assert cache.get(identity.token) is None
+
+    cache.add(identity)
+    assert cache.get(identity.token) == identity
+
+
+@mock.patch('stoqserver.lib.auth.time.monotonic')
+def test_token_cache_expires(monotonic, identity):
+    cache = TokenCache(ttl=10)
+    monotonic.return_value = 100
+    cache.add(identity)
+
+    monotonic.return_value = 109
+    assert cache.get(identity.token) == identity
+
+    monotonic.return_value = 110
+    assert cache.get(identity.token) is None
+
+
+def test_token_cache_invalidate(identity):
+    cache = TokenCache()
+    other = identity._replace(token='other token')
+    cache.add(identity)
+    cache.add(other)
+
+    cache.invalidate(identity.token)
+    assert cache.get(identity.token) is None
+    assert cache.get(other.token) == other
+
+    cache.invalidate()
+    assert cache.get(other.token) is None
+
+
+@mock.patch('stoqserver.lib.auth.time.time')
+@mock.patch('stoqserver.lib.auth.time.monotonic')
+def test_token_cache_token_expiration(monotonic, time, identity):
+    cache = TokenCache(ttl=60)
+    time.return_value = 1577836800
+    monotonic.return_value = 100
+    cache.add(identity._replace(expires_at=1577836800 + 10))
+
+    monotonic.return_value = 109
+    assert cache.get(identity.token) is not None
+
+    # The token expired before the cache TTL
+    monotonic.return_value = 110
+    assert cache.get(identity.token) is None
+
+    cache.add(identity._replace(expires_at=1577836800))
+    assert cache.get(identity.token) is None
+
+
+def test_token_cache_max_size(identity):
+    cache = TokenCache(max_size=2)
+    for token in ['first', 'second', 'third']:
+        cache.add(identity._replace(token=token))
+
+    assert cache.get('first') is None
+    assert cache.get('second') is not None
+    assert cache.get('third') is not None
+
+
+def test_get_identity_for_token(store, current_user, current_station):
+    access_token = AccessToken.get_or_create(store, current_user, current_station)
+
+    identity = get_identity_for_token(access_token)
+
+    assert identity.token == access_token.token
+    assert identity.user_id == current_user.id
+    assert identity.station_id == current_station.id
+    assert identity.branch_id == current_station.branch_id
+    assert identity.expires_at == access_token.payload.get('exp')
+
+    cache = TokenCache()
+    cache.add(identity)
+    assert cache.get(access_token.token) == identity
@@ -0,0 +1,188 @@
+import datetime
+import uuid
+from unittest import mock
+
+import gevent
+import pytest
+from stoqlib.lib.dateutils import localnow
+
+from stoqserver.lib.catalog import (SIGNATURE_MAX_AGE, CatalogCache, SaleSellableLoader,
+                                    SellableDataLoader, TableStateCache)
+
+
+@pytest.fixture
+def cache():
+    cache = CatalogCache()
+    cache.enabled = True
+    return cache
+
+
+def test_catalog_cache_disabled():
+    cache = CatalogCache()
+    build = mock.Mock(return_value=[])
+
+    cache.get('key', build)
+    cache.get('key', build)
+
+    assert build.call_count == 2
+
+
+def test_catalog_cache_get(cache):
+    build = mock.Mock(return_value=[])
+
+    assert cache.get('key', build) is cache.get('key', build)
+    assert build.call_count == 1
+
+    cache.get('other key', build)
+    assert build.call_count == 2
+
+
+def test_catalog_cache_invalidate(cache):
+    build = mock.Mock(return_value=[])
+    cache.get('key', build)
+
+    cache.invalidate()
+    cache.get('key', build)
+
+    assert build.call_count == 2
+
+
+def test_catalog_cache_single_flight(cache):
+    calls = []
+
+    def build():
+        calls.append(1)
+        gevent.sleep(0.01)
+        return []
+
+    greenlets = [gevent.spawn(cache.get, 'key', build) for i in range(5)]
+    gevent.joinall(greenlets)
+
+    assert len(calls) == 1
+    assert len(set(id(g.value) for g in greenlets)) == 1
+
+
+def test_catalog_cache_invalidated_while_building(cache):
+    def build():
+        cache.invalidate()
+        return []
+
+    cache.get('key', build)
+
+    build = mock.Mock(return_value=[])
+    cache.get('key', build)
+    assert build.call_count == 1
+
+
+@pytest.fixture
+def state_cache():
+    cache = TableStateCache()
+    cache.enabled = True
+    return cache
+
+
+def test_table_state_cache_get(state_cache):
+    read = mock.Mock(return_value='signature')
+
+    assert state_cache.get('key', ['sellable'], read) == 'signature'
+    assert state_cache.get('key', ['sellable'], read) == 'signature'
+    assert read.call_count == 1
+
+
+def test_table_state_cache_invalidate_tables(state_cache):
+    read = mock.Mock(return_value='signature')
+    state_cache.get('sellable', ['sellable', 'image'], read)
+    state_cache.get('branch', ['branch'], read)
+
+    state_cache.invalidate({'image'})
+    state_cache.get('sellable', ['sellable', 'image'], read)
+    state_cache.get('branch', ['branch'], read)
+
+    assert read.call_count == 3
+
+
+@mock.patch('stoqserver.lib.catalog.time.monotonic')
+def test_table_state_cache_max_age(monotonic, state_cache):
+    read = mock.Mock(return_value='signature')
+    monotonic.return_value = 0
+    state_cache.get('key', ['sellable'], read)
+
+    # Deleted rows are not notified, so the value is read again after a while
+    monotonic.return_value = SIGNATURE_MAX_AGE
+    state_cache.get('key', ['sellable'], read)
+
+    assert read.call_count == 2
+
+
+def test_sale_sellable_loader(store, example_creator, query_counter):
+    def count_queries(products):
+        store.flush()
+        store.invalidate()
+        query_counter.count = 0
+        loader = SaleSellableLoader(store, [product.id for product in products])
+        for product in products:
+            sellable = loader.get_sellable(product.id)
+            for child in loader.get_components(sellable.product):
+                child.component.sellable.price
+        return query_counter.count
+
+    def create_package():
+        package = example_creator.create_product(is_package=True)
+        for i in range(3):
+            example_creator.create_product_component(
+                product=package, component=example_creator.create_product())
+        return package
+
+    products = [create_package(), example_creator.create_product()]
+    count = count_queries(products)
+
+    products.extend(create_package() for i in range(5))
+    products.extend(example_creator.create_product() for i in range(5))
+    assert count_queries(products) == count
+
+
+def test_sale_sellable_loader_missing(store):
+    sellable_id = str(uuid.uuid4())
+    loader = SaleSellableLoader(store, [sellable_id])
+
+    assert loader.get_sellable(sellable_id) is None
+
+
+@pytest.fixture
+def branch_category(example_creator, current_branch):
+    current_branch.default_client_category = example_creator.create_client_category()
+    return current_branch.default_client_category
+
+
+def test_sellable_data_loader_price(store, example_creator, current_branch, branch_category):
+    sellable = example_creator.create_sellable(price=10)
+    example_creator.create_client_category_price(category=branch_category, sellable=sellable,
+                                                 price=20)
+
+    loader = SellableDataLoader(store, current_branch, [sellable.id])
+
+    assert loader.get_price(sellable) == 20
+
+
+@pytest.mark.usefixtures('branch_category')
+def test_sellable_data_loader_price_not_in_category(store, example_creator, current_branch):
+    sellable = example_creator.create_sellable(price=10)
+
+    loader = SellableDataLoader(store, current_branch, [sellable.id])
+
+    assert loader.get_price(sellable) == 10
+
+
+def test_sellable_data_loader_price_on_sale(store, example_creator, current_branch,
+                                            branch_category):
+    sellable = example_creator.create_sellable(price=10)
+    example_creator.create_client_category_price(category=branch_category, sellable=sellable,
+                                                 price=20)
+    sellable.on_sale_price = 5
+    sellable.on_sale_start_date = localnow() - datetime.timedelta(days=1)
+    sellable.on_sale_end_date = localnow() + datetime.timedelta(days=1)
+
+    loader = SellableDataLoader(store, current_branch, [sellable.id])
+
+    # The sale price wins over the category one, like in the domain
+    assert loader.get_price(sellable) == 5
@@ -0,0 +1,64 @@
+import socket
+from unittest import mock
+
+import pytest
+
+from stoqserver.lib.changes import ChangeListener
+
+
+class _StopLoop(Exception):
+    pass
+
+
+class _FakeConnection:
+    def __init__(self, payloads):
+        self._payloads = list(payloads)
+        self.notifies = []
+
+    def fileno(self):
+        return 1
+
+    def poll(self):
+        self.notifies.extend(mock.Mock(payload=payload) for payload in self._payloads.pop(0))
+
+
+@pytest.fixture
+def listener():
+    listener = ChangeListener()
+    listener.handler = mock.Mock()
+    listener.subscribe(listener.handler)
+    return listener
+
+
+def test_change_listener_coalesces_bursts(listener):
+    conn = _FakeConnection([['1,sellable', '2,sellable'], ['3,product', '2,sellable']])
+
+    with mock.patch('stoqserver.lib.changes.wait_read',
+                    side_effect=[None, None, socket.timeout, _StopLoop]):
+        with pytest.raises(_StopLoop):
+            listener._loop(conn)
+
+    listener.handler.assert_called_once_with({'sellable': {1, 2}, 'product': {3}})
+
+
+def test_change_listener_max_delay(listener):
+    conn = _FakeConnection([['1,sellable'], ['2,sellable']])
+
+    # The notifications never stop arriving, but the changes can't be held forever
+    with mock.patch('stoqserver.lib.changes.wait_read', side_effect=[None, None, _StopLoop]), \
+            mock.patch('stoqserver.lib.changes.time.monotonic', side_effect=[0, 0.1, 0.9, 1]):
+        with pytest.raises(_StopLoop):
+            listener._loop(conn)
+
+    listener.handler.assert_called_once_with({'sellable': {1, 2}})
+
+
+def test_change_listener_handler_failure(listener):
+    other_handler = mock.Mock()
+    listener.handler.side_effect = Exception
+    listener.subscribe(other_handler)
+
+    # A broken subscriber should not affect the others
+    listener._dispatch({'sellable': {1}})
+
+    other_handler.assert_called_once_with({'sellable': {1}})
@@ -0,0 +1,105 @@
+from unittest import mock
+
+import gevent
+import psycopg2.extensions
+import pytest
+
+from stoqserver.lib.dbpool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
+        self.cursor = mock.Mock()
+        self.rollback = mock.Mock()
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def pool():
+    return ConnectionPool(FakeConnection, min_size=1, max_size=2, idle_timeout=10, timeout=0.01)
+
+
+def test_pool_reuses_connections(pool):
+    conn = pool.acquire()
+    assert pool.owns(conn)
+    pool.release(conn)
+    conn.rollback.assert_called_once_with()
+    assert not pool.owns(conn)
+
+    assert pool.acquire() is conn
+    assert pool.size == 1
+
+
+def test_pool_max_size(pool):
+    conns = [pool.acquire(), pool.acquire()]
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    pool.release(conns[0])
+    assert pool.acquire() is conns[0]
+
+
+def test_pool_reclaims_closed_connections(pool):
+    pool.timeout = 30
+    conns = [pool.acquire(), pool.acquire()]
+    conns[0].close()
+
+    # The closed connection is reclaimed before waiting for the timeout
+    with gevent.Timeout(1):
+        conn = pool.acquire()
+    assert conn not in conns
+    assert not pool.owns(conns[0])
+
+
+def test_pool_discards_modified_connections(pool):
+    conn = pool.acquire()
+    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+    pool.release(conn)
+
+    assert conn.closed
+    assert pool.size == 0
+    assert pool.acquire() is not conn
+
+
+@mock.patch('stoqserver.lib.dbpool.time.monotonic')
+def test_pool_health_check(monotonic, pool):
+    monotonic.return_value = 0
+    conn = pool.acquire()
+    pool.release(conn)
+
+    monotonic.return_value = 100
+    conn.cursor.return_value.execute.side_effect = psycopg2.OperationalError
+    assert pool.acquire() is not conn
+    assert conn.closed
+
+
+@mock.patch('stoqserver.lib.dbpool.time.monotonic')
+def test_pool_close_idle(monotonic, pool):
+    monotonic.return_value = 0
+    conns = [pool.acquire(), pool.acquire()]
+    for conn in conns:
+        pool.release(conn)
+
+    monotonic.return_value = 5
+    pool.close_idle(keep=1)
+    assert pool.size == 2
+
+    monotonic.return_value = 10
+    pool.close_idle(keep=1)
+    assert pool.size == 1
+    assert conns[0].closed
+    assert not conns[1].closed
+
+
+def test_pool_fill(pool):
+    pool.fill()
+    assert pool.size == 1
+    pool.fill()
+    assert pool.size == 1
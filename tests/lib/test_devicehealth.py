@@ -0,0 +1,58 @@
+from unittest import mock
+
+import pytest
+from serial.serialutil import SerialException
+
+from stoqserver.lib.devicehealth import DEFAULT_MAX_AGE, MAX_RECONNECT_INTERVAL, PrinterHealth
+from stoqserver.lib.drawer import MAX_POLL_INTERVAL
+
+
+def test_printer_health_unknown():
+    health = PrinterHealth()
+
+    assert health.ok is None
+    assert not health.is_fresh(5)
+    assert health.can_reconnect()
+
+
+def test_printer_health_success():
+    health = PrinterHealth()
+
+    health.record_success(True)
+
+    assert health.ok
+    assert health.is_fresh(5)
+    assert not health.is_fresh(0)
+    assert health.get() is True
+
+
+def test_printer_health_max_age():
+    # The requests would check the printer themselves between the checks of the poller
+    assert DEFAULT_MAX_AGE > MAX_POLL_INTERVAL
+
+
+def test_printer_health_failure():
+    health = PrinterHealth()
+
+    health.record_failure(SerialException('Timeout'))
+
+    assert health.ok is False
+    with pytest.raises(SerialException):
+        health.get()
+
+
+@mock.patch('stoqserver.lib.devicehealth.time.monotonic')
+def test_printer_health_reconnect_backoff(monotonic):
+    monotonic.return_value = 100
+    health = PrinterHealth()
+
+    intervals = []
+    for i in range(8):
+        health.record_failure(SerialException())
+        assert not health.can_reconnect()
+        intervals.append(health._next_reconnect_at - 100)
+
+    assert intervals == [1, 2, 4, 8, 16, 32, MAX_RECONNECT_INTERVAL, MAX_RECONNECT_INTERVAL]
+
+    health.record_success(False)
+    assert health.can_reconnect()
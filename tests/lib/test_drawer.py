@@ -0,0 +1,49 @@
+from unittest import mock
+
+import pytest
+
+from stoqserver.lib.drawer import DrawerPoller, MAX_POLL_INTERVAL, MIN_POLL_INTERVAL
+
+
+@pytest.fixture
+def poller():
+    poller = DrawerPoller()
+    poller._woken = mock.Mock()
+    return poller
+
+
+def test_drawer_poller_backoff(poller):
+    intervals = []
+    for i in range(8):
+        poller.wait(False)
+        intervals.append(poller.interval)
+
+    assert intervals == [2, 4, 8, 16, MAX_POLL_INTERVAL, MAX_POLL_INTERVAL, MAX_POLL_INTERVAL,
+                         MAX_POLL_INTERVAL]
+
+
+def test_drawer_poller_open_drawer(poller):
+    poller.interval = MAX_POLL_INTERVAL
+
+    poller.wait(True)
+
+    assert poller.interval == MIN_POLL_INTERVAL
+
+
+def test_drawer_poller_wake(poller):
+    poller.interval = MAX_POLL_INTERVAL
+
+    poller.wake()
+    poller._woken.set.assert_called_once_with()
+
+    # It keeps polling fast for a while, even if nothing changes
+    poller.wait(False)
+    poller.wait(False)
+    assert poller.interval == MIN_POLL_INTERVAL
+
+
+def test_drawer_poller_poll(poller):
+    check = mock.Mock(return_value=True)
+
+    assert poller.poll(check) is True
+    poller._woken.clear.assert_called_once_with()
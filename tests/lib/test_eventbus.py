@@ -0,0 +1,75 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from stoqserver.lib import eventbus
+
+
+@pytest.fixture
+def handler():
+    handler = mock.Mock()
+    eventbus.subscribe('test', handler)
+    yield handler
+    eventbus._handlers['test'].remove(handler)
+
+
+@pytest.fixture
+def transport():
+    transport = mock.Mock(spec=eventbus.Transport)
+    eventbus.set_transport(transport)
+    yield transport
+    eventbus.set_transport(eventbus.PostgresTransport())
+
+
+def test_publish(transport):
+    eventbus.publish('test', [1])
+
+    transport.send.assert_called_once_with(
+        ['{"origin": %d, "messages": [{"kind": "test", "data": [1]}]}' % os.getpid()])
+
+
+def test_publish_failure(transport):
+    transport.send.side_effect = Exception
+
+    # This should not break whoever is publishing
+    eventbus.publish('test', [1])
+
+
+@mock.patch('stoqserver.lib.eventbus._batching', True)
+def test_publish_batch(transport):
+    eventbus.publish('test', [1])
+    eventbus.publish('test', [2])
+    transport.send.assert_not_called()
+
+    eventbus.flush()
+    payloads = transport.send.call_args[0][0]
+    assert len(payloads) == 1
+    assert json.loads(payloads[0])['messages'] == [{'kind': 'test', 'data': [1]},
+                                                   {'kind': 'test', 'data': [2]}]
+
+
+def test_pack():
+    messages = [json.dumps({'kind': 'test', 'data': 'x' * 3000}) for i in range(5)]
+
+    payloads = eventbus.pack(messages)
+
+    assert len(payloads) == 3
+    assert all(len(payload) < eventbus.MAX_PAYLOAD_SIZE for payload in payloads)
+    assert sum(len(json.loads(payload)['messages']) for payload in payloads) == 5
+
+
+def test_dispatch(handler):
+    eventbus.dispatch(json.dumps({'origin': os.getpid() + 1,
+                                  'messages': [{'kind': 'test', 'data': [1]},
+                                               {'kind': 'other', 'data': [2]}]}))
+
+    handler.assert_called_once_with([1])
+
+
+def test_dispatch_ignores_own_messages(handler):
+    eventbus.dispatch(json.dumps({'origin': os.getpid(),
+                                  'messages': [{'kind': 'test', 'data': [1]}]}))
+
+    handler.assert_not_called()
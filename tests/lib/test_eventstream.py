@@ -5,7 +5,8 @@ from gevent.event import Event
 from gevent.queue import Queue
 import pytest
 
-from stoqserver.lib.eventstream import DeviceType, EventStream, EventStreamBrokenException
+from stoqserver.lib.eventstream import (REPLAY_BUFFER_SIZE, DeviceType, EventQueue, EventStream,
+                                        EventStreamBrokenException, EventStreamUnconnectedStation)
 
 
 @pytest.fixture
@@ -123,3 +124,141 @@ def test_get_event_stream(
     assert response.status_code == 200
     stream = event_stream._streams[connected_station.id]
     mock_loop.assert_called_once_with(stream, connected_station.id)
+
+
+def test_add_event_to_unconnected_station(event_stream, unconnected_station):
+    with pytest.raises(EventStreamUnconnectedStation):
+        event_stream.add_event({'type': 'CLEAR_SALE'}, station=unconnected_station)
+
+
+@mock.patch('stoqserver.lib.eventstream.eventbus.has_peers', mock.Mock(return_value=True))
+@mock.patch('stoqserver.lib.eventstream.eventbus.publish')
+def test_add_event_to_station_in_other_worker(mock_publish, event_stream, unconnected_station):
+    event_stream.add_event({'type': 'CLEAR_SALE'}, station=unconnected_station)
+
+    mock_publish.assert_called_once_with(
+        'event', {'station_id': unconnected_station.id, 'data': {'type': 'CLEAR_SALE'}})
+
+
+def test_bus_event(event_stream, connected_station):
+    event_stream._on_bus_event({'station_id': connected_station.id, 'data': {'type': 'CLEAR_SALE'}})
+
+    assert event_stream._streams[connected_station.id].get() == {'type': 'CLEAR_SALE'}
+
+
+def test_bus_event_reply(event_stream, connected_station):
+    event_stream._replies[connected_station.id] = Queue()
+    event_stream._waiting_reply[connected_station.id] = Event()
+    event_stream._waiting_reply[connected_station.id].set()
+
+    event_stream._on_bus_event_reply({'station_id': connected_station.id, 'reply': 'yes'})
+
+    assert event_stream._replies[connected_station.id].get() == 'yes'
+
+
+def test_bus_stream_established(event_stream, connected_station):
+    event_stream._replies[connected_station.id] = Queue()
+    event_stream._waiting_reply[connected_station.id] = Event()
+    event_stream._waiting_reply[connected_station.id].set()
+
+    event_stream._on_bus_stream_established({'station_id': connected_station.id})
+
+    assert connected_station.id not in event_stream._streams
+    assert EventStreamBrokenException in event_stream._replies[connected_station.id]
+    assert not event_stream._waiting_reply[connected_station.id].is_set()
+
+
+def test_loop_coalesces_events(event_stream, connected_station):
+    stream = event_stream._streams[connected_station.id]
+    stream.put({'type': 'DRAWER_ALERT_OPEN'})
+    stream.put({'type': 'DEVICE_STATUS_CHANGED', 'device': 'printer', 'status': False})
+    stream.put({'type': 'TEF_DISPLAY_MESSAGE', 'message': 'Processing'})
+    stream.put({'type': 'DRAWER_ALERT_CLOSE'})
+    stream.put({'type': 'DEVICE_STATUS_CHANGED', 'device': 'printer', 'status': True})
+
+    chunk = next(event_stream()._loop(stream, connected_station.id))
+
+    assert chunk == ''.join('data: ' + json.dumps(data) + '\n\n' for data in [
+        {'type': 'TEF_DISPLAY_MESSAGE', 'message': 'Processing'},
+        {'type': 'DRAWER_ALERT_CLOSE'},
+        {'type': 'DEVICE_STATUS_CHANGED', 'device': 'printer', 'status': True},
+    ])
+
+
+def test_event_queue_drops_oldest():
+    queue = EventQueue(2)
+    for i in range(3):
+        queue.put({'type': 'TEF_DISPLAY_MESSAGE', 'message': str(i)})
+
+    assert [data['message'] for data in queue.queue] == ['1', '2']
+
+
+def test_event_queue_coalesces():
+    queue = EventQueue(2)
+    queue.put({'type': 'DRAWER_ALERT_OPEN'})
+    queue.put({'type': 'TEF_DISPLAY_MESSAGE'})
+    queue.put({'type': 'DRAWER_ALERT_CLOSE'})
+
+    assert list(queue.queue) == [{'type': 'DRAWER_ALERT_CLOSE'}, {'type': 'TEF_DISPLAY_MESSAGE'}]
+
+
+def test_event_queue_disconnects(event_stream, connected_station):
+    queue = EventQueue(1)
+    queue.put({'type': 'TEF_DISPLAY_MESSAGE'})
+    queue.put({'type': 'SERVER_UPDATE_DATA'})
+    queue.put({'type': 'TEF_DISPLAY_MESSAGE'})
+
+    assert queue.disconnected
+    assert list(event_stream()._loop(queue, connected_station.id)) == []
+
+
+@mock.patch('stoqserver.lib.eventstream.EventStream._loop')
+def test_get_event_stream_replays_missed_events(
+    mock_loop, event_stream, connected_station, client, stream_token
+):
+    mock_loop.return_value = json.dumps({})
+    event_stream.add_event({'type': 'TEF_DISPLAY_MESSAGE', 'message': '1'},
+                           station=connected_station)
+    last_event = event_stream._streams[connected_station.id].get()
+    event_stream.add_event({'type': 'TEF_DISPLAY_MESSAGE', 'message': '2'},
+                           station=connected_station)
+
+    response = client.get('/stream', query_string={'token': stream_token,
+                                                   'last_event_id': last_event.event_id})
+
+    assert response.status_code == 200
+    stream = event_stream._streams[connected_station.id]
+    assert list(stream.queue)[1:] == [
+        {'type': 'TEF_DISPLAY_MESSAGE', 'message': '2'},
+        {'type': 'EVENT_STREAM_RESUMED', 'missed': 1},
+    ]
+
+
+def test_missed_events_skip_questions(event_stream, connected_station):
+    event_stream.add_event({'type': 'TEF_DISPLAY_MESSAGE'}, station=connected_station)
+    last_event = event_stream._streams[connected_station.id].get()
+    event_stream.add_event({'type': 'TEF_ASK_QUESTION', 'data': {}}, station=connected_station)
+    event_stream.add_event({'type': 'CLEAR_SALE'}, station=connected_station)
+
+    missed = event_stream._get_missed_events(connected_station.id, last_event.event_id)
+    assert missed == [{'type': 'CLEAR_SALE'}]
+
+
+def test_missed_events_lost(event_stream, connected_station):
+    event_stream.add_event({'type': 'TEF_DISPLAY_MESSAGE'}, station=connected_station)
+    last_event = event_stream._streams[connected_station.id].get()
+    for i in range(REPLAY_BUFFER_SIZE):
+        event_stream.add_event({'type': 'TEF_DISPLAY_MESSAGE'}, station=connected_station)
+
+    assert event_stream._get_missed_events(connected_station.id, last_event.event_id) is None
+    assert event_stream._get_missed_events(connected_station.id, 'unknown-1') is None
+
+
+def test_loop_sends_event_ids(event_stream, connected_station):
+    event_stream.add_event({'type': 'CLEAR_SALE'}, station=connected_station)
+    stream = event_stream._streams[connected_station.id]
+    event_id = stream.queue[0].event_id
+
+    chunk = next(event_stream()._loop(stream, connected_station.id))
+
+    assert chunk == 'id: {}\ndata: {{"type": "CLEAR_SALE"}}\n\n'.format(event_id)
@@ -0,0 +1,23 @@
+from unittest import mock
+
+from stoqserver.lib.idempotency import (SUBMISSION_MAX_AGE, get_request_hash, get_request_options,
+                                        submission_index)
+
+
+def test_get_request_hash_options():
+    data = {'sale_id': 'x', 'products': [{'id': 'y', 'quantity': 1}]}
+    retry = dict(data, print_receipts=False, postpone_emission=True)
+
+    assert get_request_hash(retry) == get_request_hash(data)
+    assert get_request_hash(dict(data, discount_value=1)) != get_request_hash(data)
+    assert get_request_options(retry) != get_request_options(data)
+
+
+def test_remove_old():
+    store = mock.Mock()
+
+    submission_index.remove_old(store)
+
+    query, params = store.execute.call_args[0]
+    assert query.startswith('DELETE')
+    assert params == (SUBMISSION_MAX_AGE, )
@@ -0,0 +1,133 @@
+from unittest import mock
+
+import pytest
+
+from stoqserver.lib.jobqueue import (DEFAULT_MAX_ATTEMPTS, DONE, FAILED, PENDING, RUNNING,
+                                     SERVER_TIMEOUT, Job, JobCancelled, JobQueue)
+
+
+@pytest.fixture
+def queue():
+    return JobQueue('test', 'TEST_JOB_STATUS')
+
+
+@pytest.fixture
+def handler(queue):
+    handler = mock.Mock()
+    queue.handler('test')(handler)
+    return handler
+
+
+@pytest.fixture
+def new_store():
+    store = mock.MagicMock()
+    with mock.patch('stoqserver.lib.jobqueue.api.new_store', return_value=store):
+        yield store.__enter__.return_value
+
+
+@pytest.fixture
+def add_event():
+    with mock.patch('stoqserver.lib.jobqueue.EventStream.add_event') as add_event:
+        yield add_event
+
+
+@pytest.mark.usefixtures('new_store')
+def test_do_job(queue, handler, add_event, new_store):
+    job = Job(1, 'station', 'test', {'sale_id': 'x'}, 0)
+
+    queue.do_job(job)
+
+    handler.assert_called_once_with(new_store, new_store.get.return_value, sale_id='x')
+    event = add_event.call_args[0][0]
+    assert event['type'] == 'TEST_JOB_STATUS'
+    assert event['status'] == DONE
+
+
+@pytest.mark.parametrize('attempts, status', ((0, PENDING), (DEFAULT_MAX_ATTEMPTS - 1, FAILED)))
+def test_do_job_failure(queue, handler, add_event, new_store, attempts, status):
+    handler.side_effect = Exception('Out of paper')
+    job = Job(1, 'station', 'test', {}, attempts)
+
+    queue.do_job(job)
+
+    params = new_store.execute.call_args[0][1]
+    assert params[:3] == (attempts + 1, status, 'Out of paper')
+    event = add_event.call_args[0][0]
+    assert event['status'] == status
+    assert event['error'] == 'Out of paper'
+
+
+@pytest.mark.usefixtures('add_event')
+def test_do_job_cancelled(queue, handler, new_store):
+    handler.side_effect = JobCancelled('Rejected')
+
+    queue.do_job(Job(1, 'station', 'test', {}, 0))
+
+    assert new_store.execute.call_args[0][1][:2] == (1, FAILED)
+
+
+def test_handler_decorators():
+    calls = []
+
+    def decorator(name):
+        def wrap(func):
+            def wrapper(*args, **kwargs):
+                calls.append(name)
+                return func(*args, **kwargs)
+            return wrapper
+        return wrap
+
+    queue = JobQueue('test_decorators', 'TEST_JOB_STATUS',
+                     decorators=[decorator('outer'), decorator('inner')])
+    queue.handler('test')(lambda store: calls.append('handler'))
+
+    queue.handlers['test'](None)
+    assert calls == ['outer', 'inner', 'handler']
+
+
+@pytest.mark.parametrize('ordered', (True, False))
+def test_get_next_job(ordered):
+    queue = JobQueue('test_ordered', 'TEST_JOB_STATUS', ordered=ordered)
+    store = mock.Mock()
+    store.execute.return_value.get_one.return_value = (2, 'station', 'test', '{"a": 1}', 1)
+
+    job = queue.get_next_job(store)
+
+    assert job == Job(2, 'station', 'test', {'a': 1}, 1)
+    (query, _), (update, params) = [c[0] for c in store.execute.call_args_list]
+    # Other processes skip the job being claimed
+    assert query.endswith('FOR UPDATE SKIP LOCKED')
+    # Only the ordered queue holds the jobs after one being retried
+    assert ('NOT EXISTS' in query) is ordered
+    assert update.startswith('UPDATE')
+    assert params == (RUNNING, 2)
+
+
+def test_get_next_job_station(queue):
+    store = mock.Mock()
+    store.execute.return_value.get_one.return_value = None
+    station = mock.Mock(id='station')
+
+    queue.get_next_job(store, station)
+    query, params = store.execute.call_args[0]
+    assert 'station_id = ?' in query
+    assert params[-1] == 'station'
+
+    # In multiclient mode, the jobs of the stations with a server of their own are left to it
+    queue.get_next_job(store)
+    query, params = store.execute.call_args[0]
+    assert 'stoqserver_station_server' in query
+    assert params[-1] == SERVER_TIMEOUT
+
+
+def test_get_next_job_empty(queue):
+    store = mock.Mock()
+    store.execute.return_value.get_one.return_value = None
+
+    assert queue.get_next_job(store) is None
+    assert store.execute.call_count == 1
+
+
+def test_add_unknown_kind(queue):
+    with pytest.raises(AssertionError):
+        queue.add(mock.Mock(), mock.Mock(), 'unknown')
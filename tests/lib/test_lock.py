@@ -0,0 +1,90 @@
+import gevent
+
+from stoqserver.lib.lock import HIGH, LOW, NORMAL, InstrumentedLock
+
+
+def test_instrumented_lock_holder():
+    lock = InstrumentedLock('test')
+
+    def func():
+        pass
+
+    assert lock.acquire(func=func)
+    assert lock.holder['function'] == 'test_instrumented_lock_holder.<locals>.func'
+    assert lock.holder['route'] is None
+    assert lock.dump()['locked'] is True
+
+    lock.release()
+    assert lock.holder is None
+    assert lock.hold_time.count == 1
+
+
+def test_instrumented_lock_contention():
+    lock = InstrumentedLock('test_contention')
+    lock.acquire()
+
+    waiter = gevent.spawn(lock.acquire)
+    gevent.sleep(0)
+    assert lock.waiting == 1
+    assert lock.contended.value == 1
+
+    lock.release()
+    waiter.join()
+    assert lock.waiting == 0
+    assert lock.wait_time.count == 2
+    lock.release()
+
+
+def test_instrumented_lock_non_blocking():
+    lock = InstrumentedLock('test_non_blocking')
+    lock.acquire()
+
+    assert not lock.acquire(blocking=False)
+    assert lock.holder['greenlet'] == id(gevent.getcurrent())
+    lock.release()
+
+
+def test_instrumented_lock_priority():
+    lock = InstrumentedLock('test_priority')
+    lock.acquire()
+
+    order = []
+
+    def waiter(name, priority):
+        lock.acquire(priority=priority)
+        order.append(name)
+        lock.release()
+
+    greenlets = [gevent.spawn(waiter, 'low', LOW), gevent.spawn(waiter, 'normal', NORMAL),
+                 gevent.spawn(waiter, 'high', HIGH), gevent.spawn(waiter, 'high2', HIGH)]
+    gevent.sleep(0)
+    assert lock.dump()['waiting_priorities'] == [HIGH, HIGH, NORMAL, LOW]
+
+    lock.release()
+    gevent.joinall(greenlets)
+    assert order == ['high', 'high2', 'normal', 'low']
+    assert not lock.locked()
+
+
+def test_instrumented_lock_timeout():
+    lock = InstrumentedLock('test_timeout')
+    lock.acquire()
+
+    assert not lock.acquire(timeout=0.01, priority=LOW)
+    assert lock.waiting == 0
+
+    lock.release()
+    assert not lock.locked()
+
+
+def test_instrumented_lock_killed_waiter():
+    lock = InstrumentedLock('test_killed')
+    lock.acquire()
+
+    waiter = gevent.spawn(lock.acquire)
+    gevent.sleep(0)
+    waiter.kill()
+
+    assert lock.waiting == 0
+    lock.release()
+    assert not lock.locked()
@@ -0,0 +1,24 @@
+from stoqserver.lib.metrics import MetricsRegistry
+
+
+def test_histogram():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('wait', 'Wait time', buckets=(1, 5))
+    for value in [0.5, 1, 3, 10]:
+        histogram.observe(value)
+
+    assert registry.histogram('wait', 'Wait time') is histogram
+    assert registry.dump() == {'wait': {
+        'type': 'histogram',
+        'description': 'Wait time',
+        'count': 4,
+        'sum': 14.5,
+        'max': 10,
+        'buckets': {'1': 2, '5': 3, '+Inf': 4},
+    }}
+
+
+def test_gauge_with_func():
+    registry = MetricsRegistry()
+    registry.gauge('size', 'Size', func=lambda: 42)
+    assert registry.dump()['size']['value'] == 42
@@ -1,4 +1,5 @@
 import requests
+import uuid
 from unittest import mock
 
 import pytest
@@ -6,18 +7,25 @@ import pytest
 from kiwi.currency import currency
 from stoqifood.domain import ExternalOrder
 from stoqlib.domain.overrides import ProductBranchOverride
-from stoqlib.domain.sale import Sale
+from stoqlib.domain.payment.card import CardPaymentDevice, CreditCardData, CreditProvider
+from stoqlib.domain.sale import Sale, SaleItem
+from stoqlib.domain.sellable import Sellable
 from stoqlib.domain.person import Individual
 from stoqlib.domain.till import Till
 from storm.expr import Desc
 
 from stoqserver.lib import restful
+from stoqserver.lib.emissionqueue import emission_queue
+from stoqserver.lib.jobqueue import JobCancelled
+from stoqserver.lib.printqueue import print_queue
 
 
 # We must import restful if we want to run some tests individually. Otherwise, only patches that
 # mock stoqlib.lib.restful work when running pytest with -k
 restful
 
+pytestmark = pytest.mark.usefixtures('schema')
+
 
 @pytest.fixture
 def sellable(example_creator):
@@ -255,7 +263,7 @@ def ifood_order(store, order_details):
                          foreign_id=order_details['id'])
 
 
-@mock.patch('stoqserver.lib.restful.PrintKitchenCouponEvent.send')
+@mock.patch('stoqserver.lib.printqueue.PrintKitchenCouponEvent.send')
 @pytest.mark.parametrize('order_number', ('0', '', None))
 @pytest.mark.usefixtures('kps_station', 'open_till', 'mock_new_store')
 def test_kps_sale_with_invalid_order_number(
@@ -270,7 +278,7 @@ def test_kps_sale_with_invalid_order_number(
     assert response.status_code == 400
 
 
-@mock.patch('stoqserver.lib.restful.PrintKitchenCouponEvent.send')
+@mock.patch('stoqserver.lib.printqueue.PrintKitchenCouponEvent.send')
 @pytest.mark.usefixtures('current_station', 'open_till', 'mock_new_store')
 def test_kps_sale_with_kps_station_disabled(mock_kps_event_send, client, sale_payload):
     response = client.post('/sale', json=sale_payload)
@@ -279,7 +287,7 @@ def test_kps_sale_with_kps_station_disabled(mock_kps_event_send, client, sale_pa
     assert response.status_code == 201
 
 
-@mock.patch('stoqserver.lib.restful.PrintKitchenCouponEvent.send')
+@mock.patch('stoqserver.lib.printqueue.PrintKitchenCouponEvent.send')
 @pytest.mark.usefixtures('open_till', 'kps_station', 'mock_new_store')
 def test_kps_sale_without_kitchen_items(mock_kps_event_send, client, sale_payload):
     response = client.post('/sale', json=sale_payload)
@@ -288,14 +296,21 @@ def test_kps_sale_without_kitchen_items(mock_kps_event_send, client, sale_payloa
     assert response.status_code == 201
 
 
-@mock.patch('stoqserver.lib.restful.PrintKitchenCouponEvent.send')
-@pytest.mark.usefixtures('kps_station', 'open_till', 'mock_new_store')
-def test_kps_sale(mock_kps_event_send, client, sale_payload, sellable):
+@mock.patch('stoqserver.lib.printqueue.PrintKitchenCouponEvent.send')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_kps_sale(mock_kps_event_send, client, sale_payload, sellable, store, kps_station):
     sellable.requires_kitchen_production = True
 
     response = client.post('/sale', json=sale_payload)
 
     assert response.status_code == 201
+    # The kitchen coupon is printed in the background
+    assert mock_kps_event_send.call_count == 0
+    job = print_queue.get_next_job(store, kps_station)
+    assert job.kind == 'kitchen_coupon'
+    assert job.station_id == kps_station.id
+    print_queue.handlers[job.kind](store, kps_station, **job.args)
+
     assert mock_kps_event_send.call_count == 1
     args, kwargs = mock_kps_event_send.call_args_list[0]
     assert len(args) == 1
@@ -304,6 +319,20 @@ def test_kps_sale(mock_kps_event_send, client, sale_payload, sellable):
     assert kwargs == {'order_number': 69}
 
 
+@mock.patch('stoqserver.lib.printqueue.PrintKitchenCouponEvent.send')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_kps_sale_other_station(mock_kps_event_send, client, sale_payload, sellable, store,
+                                kps_station):
+    sellable.requires_kitchen_production = True
+    response = client.post('/sale', json=sale_payload)
+    assert response.status_code == 201
+
+    job = print_queue.get_next_job(store, kps_station)
+    with pytest.raises(JobCancelled):
+        print_queue.handlers[job.kind](store, mock.Mock(id='other'), **job.args)
+    assert mock_kps_event_send.call_count == 0
+
+
 @pytest.mark.usefixtures('kps_station', 'open_till', 'mock_new_store')
 def test_sale_with_discount(client, sale_payload, store):
     sale_payload['products'][0]['quantity'] = 10
@@ -319,6 +348,134 @@ def test_sale_with_discount(client, sale_payload, store):
     assert sale.discount_value == currency('25')
 
 
+@mock.patch('stoqserver.lib.restful.SaleConfirmedRemoteEvent.emit')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_with_postponed_emission(mock_emit, client, sale_payload, store, current_station):
+    sale_payload['postpone_emission'] = True
+
+    response = client.post('/sale', json=sale_payload)
+
+    assert response.status_code == 201
+    assert response.json['invoice_data'] is None
+    # The document is emitted in the background
+    assert mock_emit.call_count == 0
+    job = emission_queue.get_next_job(store)
+    assert job.id == response.json['emission_job_id']
+    assert job.station_id == current_station.id
+
+    emission_queue.handlers[job.kind](store, current_station, **job.args)
+
+    sale = store.get(Sale, response.json['sale_id'])
+    mock_emit.assert_called_once_with(sale, mock.ANY, True, False)
+
+
+@mock.patch('stoqserver.lib.restful.SaleConfirmedRemoteEvent.emit')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_postponed_emission_station(mock_emit, client, sale_payload, store, current_station):
+    sale_payload['postpone_emission'] = True
+    response = client.post('/sale', json=sale_payload)
+    assert response.status_code == 201
+
+    # The server of the station only claims its own jobs
+    assert emission_queue.get_next_job(store, mock.Mock(id='other')) is None
+    job = emission_queue.get_next_job(store, current_station)
+    assert job.id == response.json['emission_job_id']
+
+    with pytest.raises(JobCancelled):
+        emission_queue.handlers[job.kind](store, mock.Mock(id='other'), **job.args)
+    assert mock_emit.call_count == 0
+
+
+@mock.patch('stoqserver.lib.restful.signal')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_retried(mock_signal, client, sale_payload, store):
+    sale_payload['sale_id'] = str(uuid.uuid4())
+
+    response = client.post('/sale', json=sale_payload)
+    assert response.status_code == 201
+
+    retry = client.post('/sale', json=sale_payload)
+
+    # The saved response is sent without asking the plugins if the coupon was transmitted
+    assert retry.status_code == 201
+    assert retry.json == response.json
+    mock_signal.assert_not_called()
+    assert store.find(Sale, id=sale_payload['sale_id']).count() == 1
+
+
+@mock.patch('stoqserver.lib.restful.signal')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_retried_without_printing(mock_signal, client, sale_payload, store):
+    sale_payload['sale_id'] = str(uuid.uuid4())
+    response = client.post('/sale', json=sale_payload)
+    assert response.status_code == 201
+
+    # Like after the printer failed. The plugins are asked about the coupon, as before the sales
+    # were idempotent
+    mock_signal.return_value.send.return_value = [(None, True)]
+    sale_payload['print_receipts'] = False
+    retry = client.post('/sale', json=sale_payload)
+
+    assert retry.status_code == 200
+    assert retry.json == {'sale_id': sale_payload['sale_id']}
+    assert store.find(Sale, id=sale_payload['sale_id']).count() == 1
+
+
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_retried_with_different_data(client, sale_payload):
+    sale_payload['sale_id'] = str(uuid.uuid4())
+    response = client.post('/sale', json=sale_payload)
+    assert response.status_code == 201
+
+    sale_payload['products'][0]['quantity'] = 2
+    response = client.post('/sale', json=sale_payload)
+
+    assert response.status_code == 409
+
+
+@mock.patch('stoqserver.lib.restful.SaleConfirmedRemoteEvent.emit')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_batch(mock_emit, client, sale_payload, store, current_station):
+    sale = dict(sale_payload, sale_id=str(uuid.uuid4()))
+    invalid_sale = dict(sale_payload, sale_id=str(uuid.uuid4()),
+                        products=[dict(sale_payload['products'][0], id=str(uuid.uuid4()))])
+    sales = [sale, invalid_sale, sale]
+
+    response = client.post('/sale/batch', json={'sales': sales})
+
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [r['sale_id'] for r in results] == [s['sale_id'] for s in sales]
+    assert [r['status'] for r in results] == [201, 400, 201]
+    # The sale sent twice is created once
+    assert results[2]['response'] == results[0]['response']
+    assert store.find(Sale, id=sale['sale_id']).count() == 1
+    assert store.get(Sale, invalid_sale['sale_id']) is None
+    # The fiscal document is emitted in the background
+    assert mock_emit.call_count == 0
+    job = emission_queue.get_next_job(store)
+    assert job.args['sale_id'] == sale['sale_id']
+    assert job.station_id == current_station.id
+
+
+@mock.patch('stoqserver.lib.restful.SaleConfirmedRemoteEvent.emit')
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_batch_invalid_second_product(mock_emit, client, sale_payload, store):
+    product = sale_payload['products'][0]
+    # The item of the first product is created before the second one fails
+    invalid_sale = dict(sale_payload, sale_id=str(uuid.uuid4()),
+                        products=[product, dict(product, id=str(uuid.uuid4()))])
+    sale = dict(sale_payload, sale_id=str(uuid.uuid4()))
+
+    response = client.post('/sale/batch', json={'sales': [invalid_sale, sale]})
+
+    assert response.status_code == 200
+    assert [r['status'] for r in response.json['results']] == [400, 201]
+    assert store.get(Sale, invalid_sale['sale_id']) is None
+    assert store.find(SaleItem, sale_id=invalid_sale['sale_id']).is_empty()
+    assert store.get(Sale, sale['sale_id']).get_items().count() == 1
+
+
 @mock.patch('stoqserver.lib.restful.StartPassbookSaleEvent.send')
 @pytest.mark.usefixtures('open_till', 'mock_new_store')
 def test_remove_passbook_stamps(
@@ -735,6 +892,175 @@ def test_data_resource_with_branch_price_table(client, sellable, example_creator
         assert False, 'Sellable category is not present in the response'
 
 
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_catalog_delta(client, sellable, example_creator):
+    sellable.category = example_creator.create_sellable_category()
+    response = client.get('/data')
+    version = response.json['catalog_version']
+    assert version is not None
+    assert 'catalog_delta' not in response.json
+
+    sellable.description = 'Changed description'
+    response = client.get('/data', query_string={'since': version})
+    assert 'categories' not in response.json
+    delta = response.json['catalog_delta']
+    changed = {s['id']: s for s in delta['sellables']}
+    assert changed[sellable.id]['description'] == 'Changed description'
+    assert changed[sellable.id]['category_id'] == sellable.category.id
+    assert sellable.id not in delta['removed_sellables']
+
+    sellable.status = Sellable.STATUS_CLOSED
+    response = client.get('/data', query_string={'since': version})
+    delta = response.json['catalog_delta']
+    assert sellable.id not in [s['id'] for s in delta['sellables']]
+    assert sellable.id in delta['removed_sellables']
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_catalog_delta_deletions(client, sellable, example_creator, current_station,
+                                               store):
+    sellable.category = example_creator.create_sellable_category()
+    client_category = example_creator.create_client_category()
+    current_station.branch.default_client_category = client_category
+    price = example_creator.create_client_category_price(category=client_category,
+                                                         sellable=sellable, price=20)
+    category = example_creator.create_sellable_category()
+    response = client.get('/data')
+    version = response.json['catalog_version']
+
+    # Nothing references the sellable or the category after those are deleted
+    store.remove(price)
+    store.remove(category)
+    response = client.get('/data', query_string={'since': version})
+
+    delta = response.json['catalog_delta']
+    changed = {s['id']: s for s in delta['sellables']}
+    assert changed[sellable.id]['price'] == '10'
+    assert category.id in delta['removed_categories']
+
+
+@pytest.mark.parametrize('since', ('invalid', '20000101000000000000'))
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_catalog_delta_fallback(client, since):
+    response = client.get('/data', query_string={'since': since})
+    assert 'catalog_delta' not in response.json
+    assert 'categories' in response.json
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_stream(client, sellable, example_creator, monkeypatch):
+    monkeypatch.setattr(restful.DataResource, 'STREAM_PAGE_SIZE', 1)
+    sellable.category = example_creator.create_sellable_category()
+    other = example_creator.create_sellable()
+    other.category = sellable.category
+
+    response = client.get('/data')
+    streamed_response = client.get('/data', query_string={'stream': '1'})
+    assert streamed_response.status_code == 200
+    assert streamed_response.json.keys() == response.json.keys()
+
+    def find_products(response):
+        for cat in response.json['categories']:
+            if cat['id'] == sellable.category.id:
+                return {p['id']: p for p in cat['products']}
+
+    assert find_products(streamed_response) == find_products(response)
+    assert {sellable.id, other.id} <= find_products(streamed_response).keys()
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_not_modified(client, sellable):
+    response = client.get('/data')
+    etag = response.headers['ETag']
+
+    response = client.get('/data', environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    sellable.description = 'Changed description'
+    response = client.get('/data', environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_not_modified_before_station_data(client):
+    response = client.get('/data')
+    etag = response.headers['ETag']
+
+    with mock.patch.object(restful.DataResource, '_get_station_data') as get_station_data:
+        response = client.get('/data', environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+
+    assert response.status_code == 304
+    get_station_data.assert_not_called()
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_cached_snapshot(client, sellable, monkeypatch):
+    monkeypatch.setattr(restful.catalog_cache, 'enabled', True)
+    restful.catalog_cache.invalidate()
+    response = client.get('/data')
+    etag = response.headers['ETag']
+
+    # The change listener didn't hear about this yet, so the cached catalog is still sent, and
+    # it must be described by the version and ETag it was built at
+    sellable.description = 'Changed description'
+    response = client.get('/data', environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+    assert response.status_code == 304
+
+    restful.catalog_cache.invalidate()
+    response = client.get('/data', environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_image_resource_not_modified(client, sellable, example_creator):
+    img = example_creator.create_image()
+    img.image = b'foobar'
+    img.sellable_id = sellable.id
+    img.is_main = True
+
+    response = client.get('/image/' + sellable.id, query_string={'is_main': '1'})
+    assert response.status_code == 200
+    assert response.data == b'foobar'
+    etag = response.headers['ETag']
+
+    response = client.get('/image/' + sellable.id, query_string={'is_main': '1'},
+                          environ_overrides={'HTTP_IF_NONE_MATCH': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_data_resource_query_count_does_not_grow(store, example_creator, current_station,
+                                                 query_counter):
+    def count_queries():
+        store.flush()
+        query_counter.count = 0
+        restful.DataResource()._build_categories(store, current_station)
+        return query_counter.count
+
+    for i in range(2):
+        example_creator.create_product(storable=True, stock=5)
+    count = count_queries()
+
+    for i in range(10):
+        example_creator.create_product(storable=True, stock=5)
+    assert count_queries() == count
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_logout_invalidates_cached_token(client):
+    assert client.get('/data').status_code == 200
+
+    response = client.post('/logout', json={'token': client.auth_token})
+    assert response.status_code == 200
+
+    response = client.get('/data')
+    assert response.status_code == 403
+
+
 @pytest.mark.parametrize('query_string', ({}, {'partial_document': None}, {'partial_document': ''}))
 def test_passbook_users_get_missing_parameter(client, query_string):
     response = client.get('/passbook/users', query_string=query_string)
@@ -812,6 +1138,18 @@ def test_till_get_closing_receipt_with_open_till(client, open_till):
     assert not response.json
 
 
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store', 'open_till')
+def test_till_get_opens_a_single_store(client):
+    # Login before counting, since it has a request of its own
+    client.auth_token
+    restful.api.new_store.reset_mock()
+
+    response = client.get('/till')
+
+    assert response.status_code == 200
+    assert restful.api.new_store.call_count == 1
+
+
 @mock.patch('stoqserver.lib.restful.GenerateTillClosingReceiptImageEvent.send')
 @pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
 def test_till_get_closing_receipt_with_close_till(mock_get_receipt, client, close_till):
@@ -909,6 +1247,38 @@ def test_sale_hack_money_as_ifood(get_config_mock, client, sale_payload):
     assert 'client_id' in response.json
 
 
+@pytest.mark.usefixtures('open_till', 'mock_new_store')
+def test_sale_card_installments_new_provider(client, sale_payload, store):
+    card_name = 'CARD {}'.format(uuid.uuid4())
+    devices = store.find(CardPaymentDevice, description='POS').count()
+    sale_payload['payments'] = [{
+        'method': 'card',
+        'card_type': 'credit',
+        'provider': card_name,
+        'installments': installments,
+        'value': '5',
+    } for installments in (3, 2)]
+
+    response = client.post('/sale', json=sale_payload)
+
+    assert response.status_code == 201
+    # Created once, even though each payment and each of its installments look them up
+    provider = store.find(CreditProvider, provider_id=card_name).one()
+    assert provider is not None
+    assert store.find(CardPaymentDevice, description='POS').count() <= devices + 1
+
+    sale = store.get(Sale, response.json['sale_id'])
+    payments = list(sale.group.payments)
+    assert len(payments) == 5
+    card_data = list(store.find(CreditCardData,
+                                CreditCardData.payment_id.is_in([p.id for p in payments])))
+    assert len(card_data) == 5
+    assert len({c.device for c in card_data}) == 1
+    assert {(c.provider, c.card_type) for c in card_data} == {
+        (provider, CreditCardData.TYPE_CREDIT)}
+    assert sorted(c.installments for c in card_data) == [2, 2, 3, 3, 3]
+
+
 @pytest.mark.usefixtures('open_till', 'mock_new_store')
 def test_client_post(client):
     payload = {}
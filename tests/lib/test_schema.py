@@ -0,0 +1,18 @@
+from unittest import mock
+
+from stoqserver.lib import schema
+
+
+def test_create_schema(monkeypatch):
+    monkeypatch.setattr(schema, '_statements', [])
+    schema.register_table('CREATE TABLE IF NOT EXISTS a (id integer)')
+    schema.register_table('CREATE TABLE IF NOT EXISTS b (id integer)')
+    store = mock.Mock()
+
+    schema.create_schema(store)
+
+    statements = [c[0][0] for c in store.execute.call_args_list]
+    # Concurrent servers wait for each other before creating the tables
+    assert 'pg_advisory_xact_lock' in statements[0]
+    assert statements[1:] == ['CREATE TABLE IF NOT EXISTS a (id integer)',
+                              'CREATE TABLE IF NOT EXISTS b (id integer)']
@@ -1,7 +1,7 @@
 import pytest
 from unittest import mock
 
-from stoqserver.taskmanager import Worker
+from stoqserver.taskmanager import TaskPool, Worker
 
 
 @pytest.fixture
@@ -107,3 +107,21 @@ def test_start_tasks_with_server_task_on_server_station(
             task_was_run = True
 
     assert task_was_run
+
+
+@mock.patch('stoqserver.taskmanager.Task')
+def test_task_pool_restarts_dead_tasks(mock_task):
+    dead_task = mock.Mock(errors=0)
+    dead_task.is_alive.return_value = False
+    mock_task.return_value = dead_task
+
+    pool = TaskPool('test_task', 1, mock.Mock())
+    pool.check_tasks()
+    assert dead_task.errors == 1
+    dead_task.clone.assert_not_called()
+
+    # Pretend the backoff is over
+    pool._restart_at[0] = 0
+    pool.check_tasks()
+    dead_task.clone.assert_called_once_with()
+    dead_task.clone.return_value.start.assert_called_once_with(pool._error_queue)
@@ -0,0 +1,73 @@
+import datetime
+import decimal
+import json
+import zlib
+from unittest import mock
+
+import pytest
+
+from stoqserver.utils import iter_gzip, iter_json, write_behind
+
+
+@pytest.mark.parametrize('obj', (
+    {},
+    [],
+    {'a': 1, 'b': [1, 2, {'c': None}], 'd': 'e"f', 'g': True},
+    {None: 1, 1: 2, False: 3},
+))
+def test_iter_json(obj):
+    assert json.loads(''.join(iter_json(obj))) == json.loads(json.dumps(obj))
+
+
+def test_iter_json_with_generators():
+    obj = {'data': ({'id': i, 'children': (j for j in range(i))} for i in range(3))}
+    assert json.loads(''.join(iter_json(obj))) == {'data': [
+        {'id': 0, 'children': []},
+        {'id': 1, 'children': [0]},
+        {'id': 2, 'children': [0, 1]},
+    ]}
+
+
+def test_iter_json_with_custom_types():
+    obj = {'date': datetime.datetime(2020, 1, 2, 3, 4, 5), 'value': decimal.Decimal('1.50')}
+    assert json.loads(''.join(iter_json(obj))) == {'date': '2020-01-02T03:04:05',
+                                                   'value': '1.50'}
+
+
+def test_iter_json_chunks():
+    chunks = list(iter_json(list(range(1000)), chunk_size=100))
+    assert len(chunks) > 1
+    assert all(len(chunk) >= 100 for chunk in chunks[:-1])
+    assert json.loads(''.join(chunks)) == list(range(1000))
+
+
+def test_iter_gzip():
+    chunks = list(iter_gzip(['data: 1\n\n', 'data: 2\n\n']))
+
+    # Each chunk can be decompressed as soon as it arrives
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(chunks[0]) == b'data: 1\n\n'
+    assert decompressor.decompress(b''.join(chunks[1:])) == b'data: 2\n\n'
+
+
+def test_write_behind():
+    store = mock.Mock()
+
+    with write_behind(store):
+        store.block_implicit_flushes.assert_called_once_with()
+        store.flush.assert_not_called()
+
+    store.unblock_implicit_flushes.assert_called_once_with()
+    store.flush.assert_called_once_with()
+
+
+def test_write_behind_error():
+    store = mock.Mock()
+
+    with pytest.raises(ValueError):
+        with write_behind(store):
+            raise ValueError
+
+    # The store is going to be rolled back anyway
+    store.unblock_implicit_flushes.assert_called_once_with()
+    store.flush.assert_not_called()